@@ -0,0 +1,138 @@
+# Microbenchmark for the pyNIDAQ scalar calls
+# Measures what binding the driver prototypes once (as DaqSession does) saves
+# on a real ctypes foreign call, and the calls/second of the module functions
+# (pyAI_Read, pyAO_Write) and of DaqSession, on one thread and on several.
+
+"""
+Usage:
+    python bench_daq.py [calls] [threads] [--hardware]
+
+The prototype comparison calls two C library functions shaped like the
+driver's scalar calls, labs (a value in, like AO_Write) and frexp (a result
+through a pointer, like AI_Read): once the way the module functions call
+the driver, converting every argument and looking the function up on every
+call, and once through a prototype bound the way DaqSession binds
+_PROTOTYPES, with preallocated result buffers. Both calls convert the same
+argument and result types, so the speedup printed is that of the binding
+alone.
+
+The driver calls run against the simulated backend in pyNIDAQ_testing
+unless --hardware is given, in which case the DAQPAD is driven through
+pyNIDAQ. The simulated calls never go through ctypes, so only their
+throughput is shown, not a speedup.
+"""
+
+import sys
+import threading
+import time
+import ctypes
+import ctypes.util
+
+c_int16 = ctypes.c_int16
+c_long = ctypes.c_long
+c_double = ctypes.c_double
+c_int = ctypes.c_int
+
+
+def time_calls(fn, calls):
+    """Returns calls/second for calling fn() calls times."""
+    starttime = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return calls/(time.perf_counter() - starttime)
+
+
+def load_libc():
+    """The C library and the function type for its calling convention."""
+    if sys.platform == 'win32':
+        return ctypes.cdll.msvcrt, ctypes.CFUNCTYPE
+    return ctypes.CDLL(ctypes.util.find_library('c')), ctypes.CFUNCTYPE
+
+
+def bench_prototypes(calls):
+    """calls/second of labs and frexp called unbound, as the module
+    functions call the driver, and through prebound prototypes, as
+    DaqSession calls it."""
+    libc, functype = load_libc()
+
+    # Unbound: the function is looked up and every argument wrapped per call.
+    # Only the result type is set, so both calls return the same Python values
+    libc.labs.restype = c_long
+    libc.frexp.restype = c_double
+    value = c_long(0)
+    exponent = c_int(0)
+    def labs_unbound():
+        value.value = -100
+        return libc.labs(value)
+    def frexp_unbound():
+        libc.frexp(c_double(1000.0), ctypes.byref(exponent))
+        return exponent.value
+
+    # Bound once, like DaqSession: functype(restype, *argtypes)((name, dll))
+    labs = functype(c_long, c_long)(('labs', libc))
+    frexp = functype(c_double, c_double, ctypes.POINTER(c_int))(('frexp', libc))
+    result = c_int(0)
+    pResult = ctypes.pointer(result)
+    def frexp_bound():
+        frexp(1000.0, pResult)
+        return result.value
+
+    return [
+        ("labs unbound",  time_calls(labs_unbound, calls)),
+        ("labs bound",    time_calls(lambda: labs(-100), calls)),
+        ("frexp unbound", time_calls(frexp_unbound, calls)),
+        ("frexp bound",   time_calls(frexp_bound, calls)),
+    ]
+
+
+def bench_threads(daq, calls, nthreads):
+    """Total calls/second of nthreads threads, each reading through its own session."""
+    def worker():
+        session = daq.thread_session(1)
+        for _ in range(calls):
+            session.AI_Read(0, 1)
+
+    threads = [threading.Thread(target=worker) for k in range(nthreads)]
+    starttime = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return calls*nthreads/(time.perf_counter() - starttime)
+
+
+def main(argv):
+    args = [a for a in argv if not a.startswith('--')]
+    calls = int(args[0]) if len(args) > 0 else 200000
+    nthreads = int(args[1]) if len(args) > 1 else 4
+
+    if '--hardware' in argv:
+        import pyNIDAQ as daq
+    else:
+        import pyNIDAQ_testing as daq
+
+    prototypes = bench_prototypes(calls)
+    print("ctypes foreign calls:")
+    for name, rate in prototypes:
+        print("%-34s %12.0f calls/s" % (name, rate))
+    print("bound labs speedup:  %.2fx" % (prototypes[1][1]/prototypes[0][1]))
+    print("bound frexp speedup: %.2fx" % (prototypes[3][1]/prototypes[2][1]))
+
+    session = daq.DaqSession(1)
+
+    results = [
+        ("pyAI_Read",          time_calls(lambda: daq.pyAI_Read(1, 0, 1), calls)),
+        ("DaqSession.AI_Read", time_calls(lambda: session.AI_Read(0, 1), calls)),
+        ("pyAO_Write",         time_calls(lambda: daq.pyAO_Write(1, 0, 100), calls)),
+        ("DaqSession.AO_Write", time_calls(lambda: session.AO_Write(0, 100), calls)),
+        ("DaqSession.AI_Read x%d threads" % nthreads, bench_threads(daq, calls//nthreads, nthreads)),
+    ]
+
+    print("backend: ", daq.__name__)
+    for name, rate in results:
+        print("%-34s %12.0f calls/s" % (name, rate))
+    if daq.__name__ == 'pyNIDAQ':
+        print("AI_Read speedup:  %.2fx" % (results[1][1]/results[0][1]))
+        print("AO_Write speedup: %.2fx" % (results[3][1]/results[2][1]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
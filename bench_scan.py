@@ -0,0 +1,241 @@
+# End-to-end acquisition benchmark on the simulated DAQ
+# Measures the scan loop at every Run scan preset, the display conversion,
+# saving and recording throughput and how long reconfiguring the scan takes,
+# and writes the results to a JSON file that later runs can be compared with.
+
+"""
+Usage:
+    python bench_scan.py [results.json] [--compare old.json] [--mode point|buffered]
+                         [--seconds S] [--call-latency S] [--sample-latency S]
+
+Runs the scan generator from scanner against the simulated backend in
+pyNIDAQ_testing, without opening the window. --call-latency and
+--sample-latency set the simulated seconds per driver call and per sample
+(SIM_CALL_LATENCY and SIM_SAMPLE_LATENCY), to model the DAQPAD's driver
+overhead and sample clock.
+
+Results are written as {"meta": {...}, "results": {name: value}}. Names
+ending in _per_second are better higher, names ending in _ms are better
+lower. With --compare every result more than TOLERANCE worse than in the
+old file is reported as a regression and the exit status is 1.
+"""
+
+import sys
+import os
+import io
+import json
+import time
+import platform
+import tempfile
+import contextlib
+
+import numpy
+
+import pyNIDAQ_testing
+import scanner
+from framestore import FrameStore, write_tiff
+from renderer import FrameRenderer
+from pyramid import ImagePyramid
+from recorder import FrameRecorder
+
+TOLERANCE = 0.10    # fraction a result may get worse before it counts as a regression
+DISPLAY_SIZES = (256, 1024, 2048, 4096)
+SAVE_SIZES = (1024, 2048)
+RECORD_FRAMES = 32
+DISPLAY_SIZE = 1024     # the viewer's DISPLAY_SIZE
+# meta entries that have to match for two runs to be comparable
+SETTINGS = ('scan_mode', 'buffer_lines', 'scan_rate', 'call_latency', 'sample_latency')
+MODES = ('point', 'buffered')   # values of scanner.SCAN_MODE
+
+
+def quiet():
+    """Swallow the scan generator's per-frame printing."""
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def bench_scan(scangen, seconds):
+    """Pixels/second of continuous scanning at every Run scan preset."""
+    results = {}
+    for i, (res, dwell) in sorted(scanner.RUN_SCANS.items()):
+        with quiet():
+            scangen.set_resolution([FrameStore(res, res)], res, res, dwell).wait()
+            scangen.release_retired()
+            scangen.continuous()
+            time.sleep(min(0.2, seconds/4))    # past the first lines
+            pixels = scangen.pixels_scanned
+            starttime = time.perf_counter()
+            time.sleep(seconds)
+            pixels = scangen.pixels_scanned - pixels
+            elapsed = time.perf_counter() - starttime
+            scangen.pause().wait()
+        results['scan.preset%d.pixels_per_second' % i] = pixels/elapsed
+        print("Run scan %d (%dx%d, dwell %d): %12.0f pixels/s" % (i, res, res, dwell, pixels/elapsed))
+    return results
+
+
+def bench_display(frames=8):
+    """Cost of converting a whole frame for the display, as update_map does it:
+    the renderer's table lookup and histogram plus the pyramid levels."""
+    results = {}
+    rng = numpy.random.default_rng(0)
+    for res in DISPLAY_SIZES:
+        store = FrameStore(res, res)
+        renderer = FrameRenderer(store, max_size=DISPLAY_SIZE)
+        pyramid = ImagePyramid(renderer.display)
+        block = rng.integers(-2048, 2048, (16, res), dtype=numpy.int16)
+        elapsed = 0.0
+        for f in range(frames):
+            for j in range(0, res, 16):
+                store.publish_lines(j, block)
+            starttime = time.perf_counter()
+            pyramid.update(renderer.update())
+            elapsed += time.perf_counter() - starttime
+        results['display.%d.frame_ms' % res] = 1000*elapsed/frames
+        print("display %dx%d: %8.2f ms/frame" % (res, res, 1000*elapsed/frames))
+    return results
+
+
+def bench_save(directory):
+    """MB/s of writing a frame to TIFF, as SAVE does for record frames."""
+    results = {}
+    rng = numpy.random.default_rng(0)
+    for res in SAVE_SIZES:
+        frame = rng.integers(-2048, 2048, (res, res), dtype=numpy.int16)
+        path = os.path.join(directory, 'bench_%d.tif' % res)
+        starttime = time.perf_counter()
+        write_tiff(frame, path)
+        elapsed = time.perf_counter() - starttime
+        results['save.%d.MB_per_second' % res] = frame.nbytes/elapsed/1e6
+        print("save %dx%d: %8.1f MB/s" % (res, res, frame.nbytes/elapsed/1e6))
+    return results
+
+
+def bench_record(directory, res=1024):
+    """MB/s the recorder writes a stream of frames at, waiting for a free
+    buffer instead of dropping frames."""
+    frame = numpy.random.default_rng(0).integers(-2048, 2048, (res, res), dtype=numpy.int16)
+    recorder = FrameRecorder(os.path.join(directory, 'bench'), res, res)
+    starttime = time.perf_counter()
+    for f in range(RECORD_FRAMES):
+        while not recorder.submit_frame(frame, f):
+            time.sleep(0.001)
+    stats = recorder.close()
+    elapsed = time.perf_counter() - starttime
+    print("record %dx%d: %8.1f MB/s" % (res, res, stats['bytes_written']/elapsed/1e6))
+    return {'record.%d.MB_per_second' % res: stats['bytes_written']/elapsed/1e6}
+
+
+def bench_reconfigure(scangen, repeats=10):
+    """Milliseconds from posting a command to the scan applying it, while scanning."""
+    res, dwell = scanner.RUN_SCANS[2]
+    size = res//4
+    commands = {
+        'resolution': lambda: scangen.set_resolution([FrameStore(res, res)], res, res, dwell),
+        'roi': lambda: scangen.set_roi((size, size, size)),
+        'pattern': lambda: scangen.set_pattern('serpentine'),
+    }
+    results = {}
+    with quiet():
+        scangen.set_resolution([FrameStore(res, res)], res, res, dwell).wait()
+        scangen.continuous()
+        for name, post in commands.items():
+            total = 0.0
+            for r in range(repeats):
+                post().wait()
+                scangen.release_retired()
+                total += scangen.latency
+            results['reconfigure.%s_ms' % name] = 1000*total/repeats
+            scangen.set_roi(None).wait()
+            scangen.set_pattern('raster').wait()
+        scangen.pause().wait()
+    for name, value in results.items():
+        print("%s: %8.2f ms" % (name, value))
+    return results
+
+
+def compare(old, new):
+    """Names of the results in new that are more than TOLERANCE worse than in old."""
+    regressions = []
+    for name, value in new.items():
+        before = old.get(name)
+        if not before:
+            continue
+        if name.endswith('_per_second'):
+            worse = value < before*(1 - TOLERANCE)
+        else:
+            worse = value > before*(1 + TOLERANCE)
+        if worse:
+            regressions.append(name)
+            print("REGRESSION %s: %.4g -> %.4g" % (name, before, value))
+    return regressions
+
+
+def main(argv):
+    options = {}
+    args = []
+    k = 0
+    while k < len(argv):
+        if argv[k].startswith('--'):
+            options[argv[k]] = argv[k+1]
+            k += 2
+        else:
+            args.append(argv[k])
+            k += 1
+    mode = options.get('--mode', scanner.SCAN_MODE)
+    if mode not in MODES:
+        print("--mode must be one of ", ", ".join(MODES))
+        print(__doc__)
+        return 2
+    path = args[0] if args else 'bench_results.json'
+    seconds = float(options.get('--seconds', 2.0))
+    pyNIDAQ_testing.SIM_CALL_LATENCY = float(options.get('--call-latency', 0.0))
+    pyNIDAQ_testing.SIM_SAMPLE_LATENCY = float(options.get('--sample-latency', 0.0))
+    scanner.SCAN_MODE = mode
+    scanner.use_driver(simulated=True)
+
+    meta = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'machine': platform.machine(),
+        'scan_mode': scanner.SCAN_MODE,
+        'buffer_lines': scanner.BufferLines,
+        'scan_rate': scanner.MaxSampleRate,
+        'call_latency': pyNIDAQ_testing.SIM_CALL_LATENCY,
+        'sample_latency': pyNIDAQ_testing.SIM_SAMPLE_LATENCY,
+        'seconds': seconds,
+    }
+    print("backend: ", pyNIDAQ_testing.__name__, meta)
+
+    with quiet():
+        scangen = scanner.ScanGenerator(scanner.new_stores(1024, 1024), 1024, 1024)
+        scangen.start()
+    results = {}
+    results.update(bench_scan(scangen, seconds))
+    results.update(bench_reconfigure(scangen))
+    with quiet():
+        scangen.stop()
+        scangen.join(5)
+    results.update(bench_display())
+    with tempfile.TemporaryDirectory() as directory:
+        results.update(bench_save(directory))
+        results.update(bench_record(directory))
+
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1, sort_keys=True)
+    print("results written to ", path)
+
+    if '--compare' in options:
+        with open(options['--compare']) as f:
+            old = json.load(f)
+        for key in SETTINGS:
+            if old['meta'].get(key) != meta[key]:
+                print("warning: %s was %s in %s, now %s" % (key, old['meta'].get(key), options['--compare'], meta[key]))
+        if compare(old['results'], results):
+            return 1
+        print("no regressions against ", options['--compare'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,135 @@
+# Pool of reusable frame buffers for the SEM control program
+# Written for the Amray SEM control program
+
+"""
+Frame sized buffers (frame stores, integration accumulators, the scan
+generator's line buffers, the frames handed to the reconstructor and the
+registrar) are taken from a BufferPool instead of being allocated each time.
+Switching between presets or handing a frame to a background thread then
+reuses a buffer of the same shape that is no longer needed, and continuous
+scanning runs without allocating any frame sized memory once every buffer
+it needs has been made.
+
+acquire returns a Buffer handle with a reference count of one. Whoever
+hands the buffer to another thread either passes on its reference or calls
+retain for the receiver; each holder calls release when it is done, and the
+last release puts the buffer back in the pool. Buffers are aligned to ALIGN
+bytes, and views of them are passed around instead of copies.
+
+Idle buffers are kept up to MAX_IDLE bytes, beyond which released buffers
+are freed. stats reports how many buffers were allocated and reused and the
+pool's peak memory.
+"""
+
+import threading
+
+from numpy import zeros, uint8, dtype as as_dtype
+
+
+class Buffer:
+    """Reference counted handle to a pooled array."""
+
+    def __init__(self, pool, key, array):
+        self.pool = pool
+        self.key = key
+        self.array = array
+        self.refs = 1
+
+    def retain(self):
+        """Add a reference, for another holder of the buffer. Returns self."""
+        with self.pool.lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        """Drop a reference; the last one returns the buffer to the pool."""
+        self.pool._release(self)
+
+    def __enter__(self):
+        return self.array
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class BufferPool:
+
+    ALIGN = 64                  # bytes, a cache line
+    MAX_IDLE = 512*1024*1024    # bytes of idle buffers kept for reuse
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._idle = {}         # (shape, dtype): [arrays]
+        self.allocations = 0
+        self.reuses = 0
+        self.in_use = 0         # bytes handed out
+        self.idle = 0           # bytes waiting in the pool
+        self.peak = 0           # largest in_use + idle so far
+
+    def acquire(self, shape, dtype, zero=False):
+        """A Buffer holding an array of shape and dtype, zeroed if zero
+        (otherwise it holds whatever its last user left in it)."""
+        dtype = as_dtype(dtype)
+        shape = tuple(shape)
+        key = (shape, dtype.str)
+        with self.lock:
+            idle = self._idle.get(key)
+            array = idle.pop() if idle else None
+            if array is not None:
+                self.reuses += 1
+                self.idle -= array.nbytes
+            else:
+                self.allocations += 1
+            self.in_use += self._nbytes(shape, dtype)
+            self.peak = max(self.peak, self.in_use + self.idle)
+        if array is None:
+            array = self._allocate(shape, dtype)
+        elif zero:
+            array[...] = 0
+        return Buffer(self, key, array)
+
+    def _nbytes(self, shape, dtype):
+        n = dtype.itemsize
+        for s in shape:
+            n *= s
+        return n
+
+    def _allocate(self, shape, dtype):
+        nbytes = self._nbytes(shape, dtype)
+        raw = zeros(nbytes + self.ALIGN, dtype=uint8)
+        offset = -raw.ctypes.data % self.ALIGN
+        return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+    def _release(self, buffer):
+        with self.lock:
+            buffer.refs -= 1
+            if buffer.refs > 0:
+                return
+            if buffer.refs < 0:
+                raise RuntimeError('buffer released more often than acquired')
+            array = buffer.array
+            buffer.array = None
+            self.in_use -= array.nbytes
+            if self.idle + array.nbytes <= self.MAX_IDLE:
+                self._idle.setdefault(buffer.key, []).append(array)
+                self.idle += array.nbytes
+
+    def trim(self):
+        """Free every idle buffer."""
+        with self.lock:
+            self._idle = {}
+            self.idle = 0
+
+    def stats(self):
+        """Allocation counts and memory of the pool, in MB."""
+        return {
+            'allocations': self.allocations,
+            'reuses': self.reuses,
+            'in_use_MB': self.in_use/1e6,
+            'idle_MB': self.idle/1e6,
+            'peak_MB': self.peak/1e6,
+        }
+
+
+# The pool shared by the scan generator, the stores and the background threads
+POOL = BufferPool()
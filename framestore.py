@@ -0,0 +1,181 @@
+# Frame store shared by the scan generator and the display/save code
+# Written for the Amray SEM control program
+
+"""
+The scan thread fills a private line buffer and publishes each completed line
+into a FrameStore. Every publish bumps a sequence number, and every row
+remembers the sequence number it was last written at, so readers can ask for
+the rows that changed since they last looked and can take a consistent copy
+of the frame without ever blocking the scan thread.
+
+There is one writer (the scan thread) and any number of readers. Readers
+retry the rows that were written while they were copying instead of taking a
+lock.
+
+DiskFrameStore keeps the frame in a memory-mapped file instead of RAM, for
+record frames of 2048x2048 and up. The frame is stored row-major rather than
+in tiles: it is written a line at a time and read back a strip at a time
+(write_tiff) or as every step-th row and column (FrameRenderer's strided
+display reads), both of which a row-major file serves with sequential reads,
+so memory use stays bounded by what the OS keeps of the file in its page
+cache.
+
+A FrameStore given a BufferPool takes its frame from the pool, and release
+hands it back once the store has been replaced and nothing reads it any
+more (ScanGenerator.release_retired).
+"""
+
+import struct
+
+from numpy import zeros, int16, int64, nonzero, memmap
+
+
+class FrameStore:
+
+    def __init__(self, rows, cols, dtype=int16, pool=None):
+        self.rows = rows
+        self.cols = cols
+        self.buffer = None
+        if pool is not None:
+            self.buffer = pool.acquire((rows, cols), dtype, zero=True)
+            self.frame = self.buffer.array
+        else:
+            self.frame = self._allocate(dtype)
+        self.row_seq = zeros(rows, dtype=int64)    # seq at which each row was last published
+        self.seq = 0           # even when idle, odd while a line is being written
+        self.writing = (0, 0)  # rows being written while seq is odd
+        self.frames = 0        # number of completed frames
+        self.frame_seq = 0     # seq when the current frame was started
+
+    def _allocate(self, dtype):
+        return zeros((self.rows, self.cols), dtype=dtype)
+
+    # Writer side (scan thread only) ---------------------------------------
+    def publish_line(self, j, line, x0=0):
+        """Copy a completed line into row j, starting at column x0."""
+        self.writing = (j, j+1)
+        self.seq += 1
+        self.frame[j, x0:x0+len(line)] = line
+        self.row_seq[j] = self.seq + 1
+        self.seq += 1
+
+    def publish_lines(self, j, block, x0=0):
+        """Copy a block of completed lines into rows j, j+1, ... starting at column x0."""
+        jend = j + block.shape[0]
+        self.writing = (j, jend)
+        self.seq += 1
+        self.frame[j:jend, x0:x0+block.shape[1]] = block
+        self.row_seq[j:jend] = self.seq + 1
+        self.seq += 1
+
+    def end_frame(self):
+        self.frames += 1
+        self.frame_seq = self.seq
+
+    def release(self):
+        """Return a pooled frame to its pool. Only call this once no reader
+        holds the store any more, the next store of the same size reuses the frame."""
+        if self.buffer is not None:
+            self.buffer.release()
+            self.buffer = None
+
+    # Reader side -------------------------------------------------------------
+    def scanned_this_frame(self):
+        """Boolean mask of the rows published since the current frame started."""
+        return self.row_seq > self.frame_seq
+
+    def changed_rows(self, since):
+        """Indices of the rows published after sequence number since."""
+        return nonzero(self.row_seq > since)[0]
+
+    def snapshot(self, out=None):
+        """Copy the published lines into out (allocated if None) and return
+        (out, seq). Rows published while copying are copied again until the
+        copy is consistent with sequence number seq."""
+        if out is None:
+            out = zeros((self.rows, self.cols), dtype=self.frame.dtype)
+        start = self.seq
+        out[:] = self.frame
+        while True:
+            end = self.seq
+            if end == start and not (end & 1):
+                return out, end
+            rows = self.changed_rows(start)
+            if end & 1:
+                rows = list(rows) + list(range(*self.writing))
+            out[rows] = self.frame[rows]
+            start = end
+
+
+class DiskFrameStore(FrameStore):
+    """A FrameStore whose frame is a memory-mapped file at path."""
+
+    def __init__(self, path, rows, cols, dtype=int16):
+        self.path = path
+        FrameStore.__init__(self, rows, cols, dtype)
+
+    def _allocate(self, dtype):
+        return memmap(self.path, dtype=dtype, mode='w+', shape=(self.rows, self.cols))
+
+    def end_frame(self):
+        self.frame.flush()
+        FrameStore.end_frame(self)
+
+    def release(self):
+        """Flush the frame and drop the store's mapping of the file, which is
+        unmapped once no reader holds a view of it any more and can then be
+        moved or removed."""
+        if self.frame is not None:
+            self.frame.flush()
+            self.frame = None
+
+
+def iter_strips(frame, rows_per_strip):
+    """Yield (row, strip) blocks of rows_per_strip rows of frame."""
+    for j in range(0, frame.shape[0], rows_per_strip):
+        yield j, frame[j:j+rows_per_strip]
+
+
+def write_tiff(frame, path, rows_per_strip=64):
+    """Write a signed 16-bit frame to a single-page TIFF one strip at a time,
+    so a memory-mapped frame never has to be read into memory all at once."""
+    rows, cols = frame.shape
+    nstrips = -(-rows//rows_per_strip)
+    strip_bytes = [min(rows_per_strip, rows-j)*cols*2 for j in range(0, rows, rows_per_strip)]
+
+    # Layout: header, IFD, strip offsets, strip byte counts, image data
+    ntags = 10
+    ifd_offset = 8
+    offsets_at = ifd_offset + 2 + ntags*12 + 4
+    counts_at = offsets_at + 4*nstrips
+    data_at = counts_at + 4*nstrips
+    offsets = []
+    position = data_at
+    for n in strip_bytes:
+        offsets.append(position)
+        position += n
+
+    def tag(code, kind, count, value):
+        # kind 3 = SHORT, 4 = LONG
+        if kind == 3 and count == 1:
+            return struct.pack('<HHIHH', code, kind, count, value, 0)
+        return struct.pack('<HHII', code, kind, count, value)
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<2sHI', b'II', 42, ifd_offset))
+        f.write(struct.pack('<H', ntags))
+        f.write(tag(256, 4, 1, cols))               # ImageWidth
+        f.write(tag(257, 4, 1, rows))               # ImageLength
+        f.write(tag(258, 3, 1, 16))                 # BitsPerSample
+        f.write(tag(259, 3, 1, 1))                  # Compression: none
+        f.write(tag(262, 3, 1, 1))                  # Photometric: BlackIsZero
+        f.write(tag(273, 4, nstrips, offsets_at if nstrips > 1 else offsets[0]))    # StripOffsets
+        f.write(tag(277, 3, 1, 1))                  # SamplesPerPixel
+        f.write(tag(278, 4, 1, rows_per_strip))     # RowsPerStrip
+        f.write(tag(279, 4, nstrips, counts_at if nstrips > 1 else strip_bytes[0])) # StripByteCounts
+        f.write(tag(339, 3, 1, 2))                  # SampleFormat: signed integer
+        f.write(struct.pack('<I', 0))
+        f.write(struct.pack('<%dI' % nstrips, *offsets))
+        f.write(struct.pack('<%dI' % nstrips, *strip_bytes))
+        for j, strip in iter_strips(frame, rows_per_strip):
+            f.write(strip.astype('<i2').tobytes())
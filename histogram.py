@@ -0,0 +1,85 @@
+# Display histogram and brightness/contrast mapping for the SEM image
+# Written for the Amray SEM control program
+
+"""
+The display maps the 12-bit raw values to 8 bits through a 4096-entry lookup
+table. On most samples the signal only covers a small part of the raw range,
+so the table is built from the image's own histogram instead of being fixed.
+
+LineHistogram keeps a 4096-bin histogram of the displayed pixels up to date
+one line at a time: the FrameRenderer hands it the table indices of every
+row it converts, and the histogram takes the counts of the row's previous
+contents out and the new ones in. It never goes over the whole frame, and
+with a strided display only the displayed pixels are counted.
+
+percentile_lut clips the histogram at a low and a high percentile and maps
+the range in between linearly onto the display (auto brightness/contrast);
+manual_lut does the same from a brightness and contrast setting. Both give a
+table the renderer applies with a single gather per row.
+"""
+
+from numpy import zeros, arange, int64, uint8, uint16, bincount, cumsum, searchsorted, clip, rint
+
+BINS = 4096     # one bin per 12-bit raw value, raw value v is in bin v+2048
+
+
+class LineHistogram:
+
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.counts = zeros(BINS, dtype=int64)
+        self.total = 0
+        self._values = zeros((rows, cols), dtype=uint16)   # bins last counted for every row
+        self._counted = zeros(rows, dtype=bool)
+
+    def clear(self):
+        self.counts[:] = 0
+        self.total = 0
+        self._counted[:] = False
+
+    def update(self, rows, bins):
+        """Replace the counts of display rows rows with bins, the (len(rows),
+        cols) table indices those rows now hold."""
+        old = self._counted[rows]
+        if old.any():
+            self.counts -= bincount(self._values[rows[old]].ravel(), minlength=BINS)
+            self.total -= old.sum()*self.cols
+        self.counts += bincount(bins.ravel(), minlength=BINS)
+        self.total += bins.size
+        self._values[rows] = bins
+        self._counted[rows] = True
+
+    def percentile(self, p):
+        """Raw value below which p percent of the counted pixels lie."""
+        if self.total == 0:
+            return 0
+        return int(searchsorted(cumsum(self.counts), p/100.0*self.total)) - 2048
+
+    def readout(self, bins=64):
+        """The histogram summed into bins equal bins, for display."""
+        return self.counts.reshape(bins, -1).sum(axis=1)
+
+
+def linear_lut(low, high):
+    """Table mapping raw values low..high linearly onto 0..255, clipped outside."""
+    high = max(high, low + 1)
+    raw = arange(BINS) - 2048
+    return clip(rint((raw - low)*255.0/(high - low)), 0, 255).astype(uint8)
+
+
+def percentile_lut(histogram, low=0.5, high=99.5):
+    """Table stretching the low to high percentile of histogram over the display.
+    Returns the table and the raw (low, high) limits."""
+    limits = (histogram.percentile(low), histogram.percentile(high))
+    return linear_lut(*limits), limits
+
+
+def manual_lut(brightness=0.0, contrast=1.0):
+    """Table for a brightness offset (-1..1, fraction of the display range)
+    and a contrast gain (1 gives the fixed (raw+2048)/16 mapping).
+    Returns the table and the raw (low, high) limits, as percentile_lut."""
+    centre = -brightness*2048
+    half = 2048/max(contrast, 1e-3)
+    limits = (int(rint(centre - half)), int(rint(centre + half)))
+    return linear_lut(*limits), limits
@@ -0,0 +1,114 @@
+# Timing instrumentation for the scan loop and the display
+# Written for the Amray SEM control program
+
+"""
+ScanStats records what the acquisition loop and the display are doing, to
+tell whether a slow frame comes from the driver, from the Python work between
+driver calls (reducing, integrating, publishing, or waiting for the GIL while
+the display converts lines), or from the GUI.
+
+The scan generator records every block of lines into a preallocated ring
+buffer: when it started, how long the driver calls took, how long the block
+took in all, and the dwell per pixel that was actually achieved. Frame ends
+and display renders go into rings of their own. Recording is a handful of
+float stores per line; summaries (percentiles, jitter histograms, frames per
+second) are only computed when snapshot is called.
+
+The scan generator holds None instead of a ScanStats while instrumentation
+is off, so the loop pays for one attribute test per line.
+"""
+
+from numpy import zeros, float64, median, percentile, histogram, inf, array, concatenate
+
+# Edges of the jitter histograms, in seconds from the median
+JITTER_BINS = array([-inf, -1e-3, -1e-4, -1e-5, 1e-5, 1e-4, 1e-3, 1e-2, inf])
+
+
+class ScanStats:
+
+    LINES = 4096    # blocks of lines kept
+    FRAMES = 64     # frame ends kept
+    RENDERS = 256   # display updates kept
+
+    # columns of the line ring
+    START, DRIVER, TOTAL, DWELL = range(4)
+
+    def __init__(self):
+        self.lines = zeros((self.LINES, 4), dtype=float64)
+        self.frames = zeros(self.FRAMES, dtype=float64)
+        self.renders = zeros((self.RENDERS, 2), dtype=float64)   # seconds, rows converted
+        self.nlines = 0
+        self.nframes = 0
+        self.nrenders = 0
+        self.requested_dwell = 0.0   # seconds per pixel asked for
+
+    # Recording (scan thread and Tk thread) -------------------------------------
+    def record_line(self, start, driver_end, end, dwell):
+        """A block of lines that started at start, finished its driver calls
+        at driver_end and was published by end, with an achieved dwell of
+        dwell seconds per pixel."""
+        row = self.lines[self.nlines % self.LINES]
+        row[0] = start
+        row[1] = driver_end - start
+        row[2] = end - start
+        row[3] = dwell
+        self.nlines += 1
+
+    def record_frame(self, end):
+        self.frames[self.nframes % self.FRAMES] = end
+        self.nframes += 1
+
+    def record_render(self, seconds, rows):
+        row = self.renders[self.nrenders % self.RENDERS]
+        row[0] = seconds
+        row[1] = rows
+        self.nrenders += 1
+
+    # Queries -------------------------------------------------------------------
+    def _recent(self, ring, n):
+        """The n entries of ring recorded so far (all of it once it has
+        wrapped), oldest first."""
+        if n <= len(ring):
+            return ring[:n]
+        k = n % len(ring)
+        return concatenate([ring[k:], ring[:k]])
+
+    def fps(self):
+        """Frames per second over the frames kept."""
+        n = min(self.nframes, self.FRAMES)
+        if n < 2:
+            return 0.0
+        ends = self._recent(self.frames, self.nframes)
+        return (n - 1)/(ends.max() - ends.min())
+
+    def snapshot(self):
+        """Summary of everything recorded so far, as a dict of plain numbers.
+        Times are in milliseconds, dwell times in microseconds."""
+        lines = self._recent(self.lines, self.nlines)
+        renders = self._recent(self.renders, self.nrenders)
+        stats = {
+            'lines_recorded': self.nlines,
+            'fps': self.fps(),
+            'requested_dwell_us': 1e6*self.requested_dwell,
+        }
+        if len(lines):
+            total = lines[:, self.TOTAL]
+            driver = lines[:, self.DRIVER]
+            gaps = lines[1:, self.START] - (lines[:-1, self.START] + total[:-1])
+            stats.update({
+                'line_ms_median': 1e3*median(total),
+                'line_ms_p99': 1e3*percentile(total, 99),
+                'line_ms_max': 1e3*total.max(),
+                'driver_fraction': driver.sum()/max(total.sum(), 1e-12),
+                'gap_ms_max': 1e3*gaps.max() if len(gaps) else 0.0,
+                'achieved_dwell_us': 1e6*median(lines[:, self.DWELL]),
+                'line_jitter': histogram(total - median(total), JITTER_BINS)[0].tolist(),
+                'driver_jitter': histogram(driver - median(driver), JITTER_BINS)[0].tolist(),
+            })
+        if len(renders):
+            stats.update({
+                'render_ms_median': 1e3*median(renders[:, 0]),
+                'render_ms_max': 1e3*renders[:, 0].max(),
+                'render_rows_median': median(renders[:, 1]),
+            })
+        return stats
@@ -0,0 +1,102 @@
+# Frame and line integration for the SEM scan generator
+# Written for the Amray SEM control program
+
+"""
+Repeated scans of the same field are averaged instead of overwriting each
+other. The scan generator passes every block of lines through an Integrator
+before publishing it, so the FrameStore (and with it the display, the saver
+and the recorder) always holds the integrated image.
+
+The accumulators are allocated once per resolution and updated in place a
+block of lines at a time; every row keeps its own count, so partial field
+scans and the non-raster patterns integrate correctly. Given a BufferPool
+the accumulator comes from the pool and release hands it back.
+
+Modes:
+    none        no integration, every scan overwrites the last
+    frames      average of N frames, then start over (int32 sums)
+    running     exponential running average, each frame weighted 1/N
+    recursive   recursive (Kalman) average: frame k is weighted 1/k, so the
+                first N frames give their exact mean, then 1/N as running
+    lines       every line is scanned N times in a row and the N scans
+                averaged before moving on (int32 sums)
+"""
+
+from numpy import zeros, int16, int32, float32, subtract, divide, rint, minimum
+
+MODES = ('none', 'frames', 'running', 'recursive', 'lines')
+
+
+class Integrator:
+
+    def __init__(self, rows, cols, mode='none', n=4, pool=None):
+        if mode not in MODES:
+            raise ValueError('unknown integration mode %r' % (mode,))
+        self.rows = rows
+        self.cols = cols
+        self.mode = mode
+        self.n = max(1, n)
+        summed = mode in ('frames', 'lines')
+        self.buffer = None
+        if pool is not None:
+            self.buffer = pool.acquire((rows, cols), int32 if summed else float32)
+            self.acc = self.buffer.array    # no need to zero, every row starts over at count 0
+        else:
+            self.acc = zeros((rows, cols), dtype=int32 if summed else float32)
+        self.count = zeros(rows, dtype=int32)    # scans accumulated into each row
+        self._work = zeros((0, cols), dtype=float32)
+        self._out = zeros((0, cols), dtype=int16)
+
+    def reset(self):
+        """Start integrating again from the next scan of every row."""
+        self.count[:] = 0
+
+    def release(self):
+        """Return a pooled accumulator to its pool."""
+        if self.buffer is not None:
+            self.buffer.release()
+            self.buffer = None
+
+    def integrate(self, rows, pixels, x0=0):
+        """Accumulate a block of scanned lines, pixels[m] being frame row
+        rows[m] from column x0, and return the integrated lines (a view of a
+        buffer that is reused by the next call)."""
+        n, width = pixels.shape
+        if self._out.shape[0] < n:
+            self._work = zeros((n, self.cols), dtype=float32)
+            self._out = zeros((n, self.cols), dtype=int16)
+        out = self._out[:n, :width]
+        if self.mode == 'none':
+            out[:] = pixels
+        elif n == 1 or rows[-1] - rows[0] == n - 1:
+            self._block(slice(rows[0], rows[0] + n), pixels, x0, self._work[:n, :width], out)
+        else:
+            # rows are not contiguous (interlaced, progressive), one line at a time
+            for m in range(n):
+                self._block(slice(rows[m], rows[m] + 1), pixels[m:m+1], x0,
+                            self._work[m:m+1, :width], out[m:m+1])
+        return out
+
+    def _block(self, s, pixels, x0, work, out):
+        acc = self.acc[s, x0:x0 + pixels.shape[1]]
+        count = self.count[s]
+        if self.mode in ('frames', 'lines'):
+            restart = (count >= self.n) | (count == 0)
+            if restart.any():
+                acc[restart] = 0
+                count[restart] = 0
+            acc += pixels
+            count += 1
+            divide(acc, count[:, None], out=work)
+        else:
+            if self.mode == 'running':
+                weight = 1.0/self.n + (count == 0)*(1.0 - 1.0/self.n)
+            else:
+                weight = 1.0/minimum(count + 1, self.n)
+            subtract(pixels, acc, out=work)
+            work *= weight[:, None]
+            acc += work
+            count += 1
+            work[:] = acc
+        rint(work, out=work)
+        out[:] = work
@@ -0,0 +1,189 @@
+# Tiled mosaic acquisition and stitching for the SEM
+# Written for the Amray SEM control program
+
+"""
+A mosaic covers a frame too large to scan and hold in one piece by scanning
+it as a grid of overlapping square partial fields (tiles) on the frame's DAC
+grid, one after the other, and stitching them into a disk-backed mosaic.
+
+Tiles are nominally exactly where their partial field put them, but the beam
+and the specimen drift while the grid is scanned. MosaicStitcher therefore
+registers every tile with FFT phase correlation (register.phase_correlate)
+on its overlaps with the left and upper neighbours already in the mosaic,
+moves it by the sub-pixel shift found, and blends it in with weights that
+ramp from the neighbours to the new tile across the overlaps, so no seams
+are left. Each tile starts from where its neighbour ended up, so drift does
+not have to be found again on every tile.
+
+Stitching runs in its own thread while the next tile is scanned. submit
+waits for room instead of dropping tiles, and the queue holds QUEUE tiles,
+so memory use stays at a few tiles whatever the size of the mosaic; the
+mosaic itself is a DiskFrameStore.
+"""
+
+import threading
+import queue
+import time
+from math import floor
+
+from numpy import arange, minimum, clip, float32, int16, rint
+
+from framestore import DiskFrameStore
+from register import phase_correlate, shift_frame
+from bufferpool import POOL
+
+
+def tile_positions(size, tile, overlap):
+    """Offsets of tiles of tile pixels spread evenly over size pixels, the
+    first at 0 and the last at size-tile, neighbours overlapping by at
+    least overlap pixels."""
+    if tile >= size:
+        return [0]
+    n = -(-(size - tile)//max(tile - overlap, 1)) + 1
+    return [int(round(k*(size - tile)/(n - 1))) for k in range(n)]
+
+
+def tile_grid(rows, cols, tile, overlap):
+    """(row, column, ylow, xlow) of every tile covering rows x cols, in raster order."""
+    return [(r, c, ylow, xlow)
+            for r, ylow in enumerate(tile_positions(rows, tile, overlap))
+            for c, xlow in enumerate(tile_positions(cols, tile, overlap))]
+
+
+def _ramp(n, covered):
+    """Weights of the new tile along n pixels whose first covered are already
+    in the mosaic: rising across them, 1 beyond."""
+    return clip((arange(n, dtype=float32) + 1)/(covered + 1), 0, 1)
+
+
+class MosaicStitcher(threading.Thread):
+    """Background thread that registers tiles against the mosaic stitched so
+    far and blends them into it."""
+
+    QUEUE = 2         # tiles waiting to be stitched
+    MIN_PEAK = 8.0    # overlaps with a lower correlation peak (no common structure) are not used
+    MIN_OVERLAP = 8   # pixels, narrower overlaps are not registered
+
+    def __init__(self, path, rows, cols, max_shift=16, pool=POOL, verbose=True):
+        threading.Thread.__init__(self, name='MosaicStitcher')
+        self.daemon = True
+        self.store = DiskFrameStore(path, rows, cols)
+        self.max_shift = max_shift   # pixels, larger shifts are taken for mismatches and ignored
+        self.pool = pool
+        self.verbose = verbose       # print where every tile went
+        self.jobs = queue.Queue(maxsize=self.QUEUE)
+        self.nominal = {}     # (row, column): (ylow, xlow) every tile was scanned at
+        self.placed = {}      # (row, column): (y, x, size) where every tile ended up
+        self.shift = (0.0, 0.0)   # drift of the last tile from its nominal position
+        self.cost = 0.0           # seconds spent stitching all tiles
+        self.tiles = 0
+        self.start()
+
+    def submit(self, tile, row, column, ylow, xlow):
+        """Queue a copy of tile, grid tile (row, column) scanned at (ylow,
+        xlow), waiting while QUEUE tiles are already queued."""
+        buffer = self.pool.acquire(tile.shape, tile.dtype)
+        buffer.array[...] = tile
+        self.jobs.put((buffer, row, column, ylow, xlow))
+
+    def drain(self):
+        """Wait until every queued tile is in the mosaic."""
+        self.jobs.join()
+
+    def close(self):
+        """Stitch the queued tiles, end the mosaic's frame and stop. Returns the stitching statistics."""
+        self.jobs.put(None)
+        self.join()
+        self.store.end_frame()
+        return self.stats()
+
+    def stats(self):
+        return {
+            'tiles': self.tiles,
+            'last_shift': self.shift,
+            'stitch_ms_per_tile': 1000*self.cost/max(self.tiles, 1),
+        }
+
+    def register(self, tile, row, column, ylow, xlow):
+        """Position (y, x) of tile in the mosaic: its nominal position moved
+        by the drift of its neighbours and by the shift measured on its
+        overlaps with them. Tiles at the edge may be moved partly out of the
+        mosaic by drift."""
+        size = tile.shape[0]
+        rows, cols = self.store.rows, self.store.cols
+        neighbours = [n for n in ((row, column-1), (row-1, column)) if n in self.placed]
+        y, x = ylow, xlow
+        if neighbours:
+            # start from the drift of the left (or else the upper) neighbour
+            ny, nx, nsize = self.placed[neighbours[0]]
+            nominal = self.nominal[neighbours[0]]
+            y = int(round(ylow + ny - nominal[0]))
+            x = int(round(xlow + nx - nominal[1]))
+        shifts = []
+        for n in neighbours:
+            ny, nx, nsize = self.placed[n]
+            # overlap of the neighbour, the tile and the mosaic, in mosaic pixels
+            y0, x0 = max(floor(ny), y, 0), max(floor(nx), x, 0)
+            y1, x1 = min(floor(ny) + nsize, y + size, rows), min(floor(nx) + nsize, x + size, cols)
+            if y1 - y0 < self.MIN_OVERLAP or x1 - x0 < self.MIN_OVERLAP:
+                continue
+            ty, tx = y0 - y, x0 - x
+            reference = self.store.frame[y0:y1, x0:x1].astype(float32)
+            part = tile[ty:ty + y1 - y0, tx:tx + x1 - x0].astype(float32)
+            dy, dx, peak = phase_correlate(reference, part)
+            if peak >= self.MIN_PEAK and abs(dy) <= self.max_shift and abs(dx) <= self.max_shift:
+                shifts.append((dy, dx, peak))
+        y, x = float(y), float(x)
+        if shifts:
+            total = sum(peak for dy, dx, peak in shifts)
+            y += sum(dy*peak for dy, dx, peak in shifts)/total
+            x += sum(dx*peak for dy, dx, peak in shifts)/total
+        return y, x
+
+    def blend(self, tile, row, column, y, x):
+        """Blend tile into the mosaic at (y, x): moved by the fraction of a
+        pixel, then weighted against the neighbours over the overlaps. The
+        part outside the mosaic is cut off."""
+        size = tile.shape[0]
+        iy, ix = floor(y), floor(x)
+        top = left = 0
+        if (row-1, column) in self.placed:
+            ny, nx, nsize = self.placed[(row-1, column)]
+            top = min(max(floor(ny) + nsize - iy, 0), size)
+        if (row, column-1) in self.placed:
+            ny, nx, nsize = self.placed[(row, column-1)]
+            left = min(max(floor(nx) + nsize - ix, 0), size)
+        # rows and columns of the tile inside the mosaic
+        t0, t1 = max(-iy, 0), min(self.store.rows - iy, size)
+        s0, s1 = max(-ix, 0), min(self.store.cols - ix, size)
+        if t1 <= t0 or s1 <= s0:
+            return
+        moved = shift_frame(tile, y - iy, x - ix)[t0:t1, s0:s1]
+        if top or left:
+            weight = minimum(_ramp(size, top)[t0:t1, None], _ramp(size, left)[None, s0:s1])
+            old = self.store.frame[iy+t0:iy+t1, ix+s0:ix+s1]
+            moved = old + weight*(moved - old)
+        self.store.publish_lines(iy + t0, rint(moved).astype(int16), ix + s0)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            buffer, row, column, ylow, xlow = job
+            starttime = time.time()
+            tile = buffer.array
+            y, x = self.register(tile, row, column, ylow, xlow)
+            self.blend(tile, row, column, y, x)
+            buffer.release()
+            self.nominal[(row, column)] = (ylow, xlow)
+            self.placed[(row, column)] = (y, x, tile.shape[0])
+            self.shift = (y - ylow, x - xlow)
+            cost = time.time() - starttime
+            self.cost += cost
+            self.tiles += 1
+            if self.verbose:
+                print("tile (%d, %d) stitched at (%.2f, %.2f), drift (%.2f, %.2f) pixels in %.1f ms"
+                      % (row, column, y, x, self.shift[0], self.shift[1], 1000*cost))
+            self.jobs.task_done()
@@ -0,0 +1,85 @@
+# Forward/reverse line phase correction for serpentine scans
+# Written for the Amray SEM control program
+
+"""
+In a serpentine (bidirectional) scan the lines scanned right to left come
+out shifted against the lines scanned left to right, because the detector
+and beam lag the scan waveform. LinePhase estimates that shift with an FFT
+cross-correlation of neighbouring forward/reverse line pairs, vectorized over
+all the pairs at once and refined to sub-pixel precision with a parabola
+through the correlation peak, and shifts the reverse lines back into place.
+"""
+
+from numpy import arange, floor, clip, concatenate, argmax, conj, linspace, rint, diff, sqrt
+from numpy.fft import rfft, irfft
+
+
+def estimate_shift(forward, reverse, max_shift=8, min_correlation=0.2):
+    """Sub-pixel shift s such that reverse lines match forward lines after
+    shift_lines(reverse, s). forward and reverse are (pairs, width) arrays of
+    neighbouring lines, both in frame column order. Returns None when the
+    normalized correlation peak is below min_correlation (e.g. pure noise)."""
+    # Correlate the line gradients, which gives a sharper peak than the raw
+    # lines and ignores slow intensity changes along them
+    F = diff(forward, axis=1)
+    R = diff(reverse, axis=1)
+    width = F.shape[1]
+    max_shift = min(max_shift, width//2 - 1)
+    n = 2*width
+    cc = irfft((rfft(F, n)*conj(rfft(R, n))).sum(axis=0), n)
+    # cc[k] = sum over t of F[t+k]*R[t]; lags -max_shift..max_shift
+    c = concatenate([cc[-max_shift:], cc[:max_shift+1]])
+    p = int(argmax(c))
+    norm = sqrt((F*F).sum()*(R*R).sum())
+    if norm == 0 or c[p]/norm < min_correlation:
+        return None
+    offset = 0.0
+    if 0 < p < len(c) - 1:
+        denom = c[p-1] - 2*c[p] + c[p+1]
+        if denom != 0:
+            offset = 0.5*(c[p-1] - c[p+1])/denom
+    return p - max_shift + offset
+
+
+def shift_lines(lines, s):
+    """Shift every row of lines right by s pixels (out[:, t] = lines[:, t-s]),
+    interpolating linearly for fractional s and repeating the edge pixels."""
+    width = lines.shape[1]
+    x = arange(width) - s
+    i0 = floor(x)
+    f = x - i0
+    i0 = i0.astype(int)
+    a = clip(i0, 0, width - 1)
+    b = clip(i0 + 1, 0, width - 1)
+    return (1 - f)*lines[:, a] + f*lines[:, b]
+
+
+class LinePhase:
+
+    GAIN = 0.5        # fraction of each frame's residual shift applied
+    MAX_PAIRS = 64    # line pairs used per estimate
+
+    def __init__(self, max_shift=8):
+        self.max_shift = max_shift
+        self.shift = 0.0
+
+    def correct(self, pixels, reversed_lines):
+        """Shift the reverse lines of a block of published pixels in place."""
+        if self.shift != 0.0 and reversed_lines.any():
+            pixels[reversed_lines] = rint(shift_lines(pixels[reversed_lines], self.shift))
+
+    def update(self, frame, program):
+        """Refine the shift from a completed serpentine frame whose reverse
+        lines have already been corrected with the current estimate."""
+        rows = program.order
+        npairs = len(rows)//2
+        if npairs == 0:
+            return self.shift
+        pick = rint(linspace(0, npairs - 1, min(npairs, self.MAX_PAIRS))).astype(int)
+        cols = slice(program.xlow, program.xlow + program.width)
+        forward = frame[rows[2*pick], cols].astype(float)
+        reverse = frame[rows[2*pick + 1], cols].astype(float)
+        residual = estimate_shift(forward, reverse, self.max_shift)
+        if residual is not None:
+            self.shift += self.GAIN*residual
+        return self.shift
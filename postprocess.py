@@ -0,0 +1,272 @@
+# Post-processing pipeline for completed SEM frames
+# Written for the Amray SEM control program
+
+"""
+Runs a chain of post-processing stages (denoising, histogram equalization,
+sharpening, focus metrics, ...) on completed frames in a pool of worker
+processes, away from both the Tk thread and the scan thread.
+
+A PostPipeline watches a FrameStore. Whenever a frame is completed and a
+slot is free, a feeder thread takes a consistent snapshot of the frame
+straight into a multiprocessing.shared_memory slot and hands the slot's name
+to a pool worker, so no pixel data is ever pickled. The worker runs every
+stage on the frame, writes the result back into the slot and returns the
+time each stage took. The result is published to the pipeline's own
+FrameStore, out, which the viewer can show like any other store.
+
+There are only workers+1 slots. When they are all busy the frames completed
+in the meantime are skipped (and counted) and the next free slot gets the
+newest frame, so a slow stage never builds up a backlog of stale frames.
+
+set_store moves a running pipeline to another store, e.g. after a change of
+resolution, keeping the worker processes. Only the slots are reallocated,
+and only if the frame size changed; slots still being processed are freed
+when their frame comes back. Every slot holds two frames, so the pipeline is
+meant for frames held in RAM, not for disk-backed record frames.
+
+A stage is any function importable at the top level of a module that takes
+an int16 frame and returns (frame, metrics), metrics being a dict of numbers
+to report (e.g. {'focus': 0.12}). STAGES names the built-in ones.
+"""
+
+import threading
+import queue
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+from functools import partial
+
+from numpy import ndarray, int16, float32, clip, rint, bincount, cumsum, hypot, abs as absolute
+from numpy.fft import rfft2, fftfreq, rfftfreq
+
+from framestore import FrameStore
+
+
+# Stages ------------------------------------------------------------------------
+
+def _box3(frame):
+    """3x3 mean of frame with the edges repeated, as float32."""
+    f = frame.astype(float32)
+    s = f.copy()
+    s[1:] += f[:-1]
+    s[:-1] += f[1:]
+    s[0] += f[0]
+    s[-1] += f[-1]
+    t = s.copy()
+    t[:, 1:] += s[:, :-1]
+    t[:, :-1] += s[:, 1:]
+    t[:, 0] += s[:, 0]
+    t[:, -1] += s[:, -1]
+    return t/9
+
+
+def denoise(frame):
+    """3x3 mean filter."""
+    return rint(_box3(frame)).astype(int16), {}
+
+
+def sharpen(frame, amount=1.0):
+    """Unsharp mask: adds amount times the difference from the 3x3 mean."""
+    f = frame.astype(float32)
+    f += amount*(f - _box3(frame))
+    return rint(clip(f, -2048, 2047)).astype(int16), {}
+
+
+def equalize(frame):
+    """Histogram equalization over the 12-bit range."""
+    counts = bincount((clip(frame, -2048, 2047) + 2048).ravel(), minlength=4096)
+    cdf = cumsum(counts)
+    lut = rint((cdf - cdf[0])*4095.0/max(cdf[-1] - cdf[0], 1)).astype(int16) - 2048
+    return lut[clip(frame, -2048, 2047) + 2048], {}
+
+
+def focus(frame, cutoff=0.1):
+    """Focus metric: fraction of the spectral energy (DC excluded) above
+    cutoff cycles per pixel. Higher is sharper. The frame is unchanged."""
+    power = absolute(rfft2(frame - frame.mean()))**2
+    radius = hypot(fftfreq(frame.shape[0])[:, None], rfftfreq(frame.shape[1])[None, :])
+    total = power.sum()
+    return frame, {'focus': float(power[radius > cutoff].sum()/total) if total > 0 else 0.0}
+
+
+STAGES = {'denoise': denoise, 'sharpen': sharpen, 'equalize': equalize, 'focus': focus}
+
+
+# Worker process side ---------------------------------------------------------
+
+_attached = {}   # shared memory slots this worker has opened, by name: (slot, frame shape)
+
+def _process(slot, shape, stages):
+    """Run stages on the frame in slot [0] and leave the result in slot [1].
+    Returns [(stage name, seconds)] and the merged metrics."""
+    try:
+        shm = _attached[slot][0]
+    except KeyError:
+        # slots of another frame size belong to a store the pipeline has left
+        for name in [name for name, (old, oldshape) in _attached.items() if oldshape != shape]:
+            _attached.pop(name)[0].close()
+        shm = shared_memory.SharedMemory(name=slot)
+        _attached[slot] = (shm, shape)
+    frames = ndarray((2,) + shape, dtype=int16, buffer=shm.buf)
+    frame = frames[0]
+    timings = []
+    metrics = {}
+    for stage in stages:
+        starttime = time.perf_counter()
+        frame, m = stage(frame)
+        timings.append((stage.__name__, time.perf_counter() - starttime))
+        metrics.update(m)
+    frames[1] = frame
+    return timings, metrics
+
+
+# Main process side -----------------------------------------------------------
+
+class PostPipeline:
+
+    POLL = 0.01   # seconds between checks for a completed frame
+
+    def __init__(self, store, stages=('denoise',), workers=2):
+        self.stages = [STAGES[s] if isinstance(s, str) else s for s in stages]
+        self.workers = workers
+        self._lock = threading.Lock()    # held while the store or the slots change and while feeding
+        self._views = {}                 # frame arrays in every slot, by slot name
+        self._slots = []
+        self._allocate(store)
+
+        self.timings = {}     # stage name: [total seconds, frames]
+        self.metrics = {}     # the last frame's metrics
+        self.processed = 0
+        self.dropped = 0
+        self.latency = 0.0    # seconds from frame completed to processed frame published
+
+        self._pool = multiprocessing.Pool(workers)
+        self._stop = threading.Event()
+        self._feeder = threading.Thread(target=self._feed, name='PostPipeline')
+        self._feeder.daemon = True
+        self._feeder.start()
+
+    def _allocate(self, store):
+        """Follow store with a new set of workers+1 slots of its frame size."""
+        self.store = store
+        self.shape = (store.rows, store.cols)
+        self.out = FrameStore(store.rows, store.cols)    # processed frames
+        nbytes = 2*store.rows*store.cols*int16().itemsize
+        self._slots = [shared_memory.SharedMemory(create=True, size=nbytes) for k in range(self.workers + 1)]
+        for shm in self._slots:
+            self._views[shm.name] = ndarray((2,) + self.shape, dtype=int16, buffer=shm.buf)
+        self._free = queue.Queue()
+        for shm in self._slots:
+            self._free.put(shm)
+
+    def _unlink(self, shm):
+        self._views.pop(shm.name)    # the slot cannot be closed while arrays point into it
+        shm.close()
+        shm.unlink()
+
+    def _recycle(self, shm):
+        """Return a slot that is done with to the free slots, or free it if
+        it is from before the last change of frame size."""
+        with self._lock:
+            if shm in self._slots:
+                self._free.put(shm)
+            else:
+                self._unlink(shm)
+
+    def set_store(self, store):
+        """Process the frames of store from now on, keeping the worker
+        processes, and the slots too if the frame size is the same."""
+        with self._lock:
+            if (store.rows, store.cols) == self.shape:
+                self.store = store
+                return
+            free = self._free
+            self._allocate(store)
+            # the free old slots go now, the busy ones when their frame comes back
+            while True:
+                try:
+                    self._unlink(free.get_nowait())
+                except queue.Empty:
+                    break
+
+    def _feed(self):
+        store = None
+        while not self._stop.is_set():
+            with self._lock:
+                if self.store is not store:
+                    store = self.store
+                    last = store.frames
+                free = self._free
+            if store.frames == last:
+                time.sleep(self.POLL)
+                continue
+            try:
+                shm = free.get(timeout=self.POLL)
+            except queue.Empty:
+                continue    # all slots busy, try again with whatever frame is newest then
+            with self._lock:
+                if self.store is not store or shm not in self._slots:
+                    # the store changed meanwhile, start over with the new one
+                    if shm in self._slots:
+                        self._free.put(shm)
+                    else:
+                        self._unlink(shm)
+                    continue
+                frames = store.frames
+                self.dropped += frames - last - 1
+                last = frames
+                store.snapshot(self._views[shm.name][0])
+                self._pool.apply_async(_process, (shm.name, self.shape, self.stages),
+                                       callback=partial(self._done, shm, self.out, time.time()),
+                                       error_callback=partial(self._failed, shm))
+
+    def _done(self, shm, out, submitted, result):
+        # runs in the pool's result thread, the only writer of the out stores
+        timings, metrics = result
+        if out is self.out:
+            out.publish_lines(0, self._views[shm.name][1])
+            out.end_frame()
+        self._recycle(shm)
+        for name, seconds in timings:
+            total = self.timings.setdefault(name, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+        self.metrics = metrics
+        self.processed += 1
+        self.latency = time.time() - submitted
+        print("post-processing: " + ", ".join("%s %.1f ms" % (name, 1000*s) for name, s in timings)
+              + "".join(", %s %.4g" % item for item in metrics.items()))
+
+    def _failed(self, shm, error):
+        self._recycle(shm)
+        print("post-processing failed: ", error)
+
+    def queue_depth(self):
+        """Frames in the pool being processed."""
+        return len(self._slots) - self._free.qsize()
+
+    def stats(self):
+        """Mean milliseconds per stage, frames processed and dropped, and the last metrics."""
+        return {
+            'stage_ms': {name: 1000*total/n for name, (total, n) in self.timings.items()},
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'latency_ms': 1000*self.latency,
+            'metrics': self.metrics,
+        }
+
+    def stop(self):
+        """Stop feeding frames, the store is not read any more once this returns."""
+        self._stop.set()
+        self._feeder.join()
+
+    def close(self):
+        """Stop feeding, let the frames in the pool finish and free the slots."""
+        self.stop()
+        self._pool.close()
+        self._pool.join()
+        with self._lock:
+            for shm in self._slots:
+                self._unlink(shm)
+            self._slots = []
+        return self.stats()
@@ -4,6 +4,8 @@
 # Mark: this is my trying to replicate the file AIonePoint.C from the NiDaq examples
 
 import ctypes
+import threading
+import time
 import numpy
 #nidaq = ctypes.windll.nicaiu # load the DLL
 nidaq = ctypes.windll.nidaq32 # load the DLL
@@ -104,3 +106,322 @@ def pyAO_Write(pyDevice, pyChan, pyReading):
 
 
 
+# Block (array) functions ---------------------------------------------------
+# These move a whole buffer of samples per driver call. The buffers are
+# preallocated, C-contiguous numpy arrays and their memory is handed to the
+# driver directly through ndarray.ctypes, so nothing is copied and there is
+# no Python call per sample. Only local ctypes values are used, so the block
+# functions do not touch the shared module-level variables above.
+
+def _buffer(pyArray, pyType):
+    """Returns a ctypes pointer to the memory of pyArray without copying it.
+    pyArray must be a C-contiguous numpy array of dtype pyType."""
+    if not isinstance(pyArray, numpy.ndarray):
+        raise TypeError('expected a numpy array, got %s' % type(pyArray).__name__)
+    if pyArray.dtype != pyType:
+        raise TypeError('expected a %s array, got %s' % (numpy.dtype(pyType).name, pyArray.dtype.name))
+    if not pyArray.flags['C_CONTIGUOUS']:
+        raise ValueError('buffer must be C-contiguous')
+    if pyType == numpy.float64:
+        return pyArray.ctypes.data_as(ctypes.POINTER(float64))
+    return pyArray.ctypes.data_as(ctypes.POINTER(int16))
+
+def pyAI_ReadBlock(pyDevice, pyChan, pyGain, pyBuffer, pyRate):
+    """Acquires pyBuffer.size samples from one AI channel at pyRate samples
+    per second straight into the preallocated int16 array pyBuffer.
+    Returns pyBuffer once it is full."""
+    CHK( nidaq.DAQ_Op(int16(pyDevice), int16(pyChan), int16(pyGain),
+                      _buffer(pyBuffer, numpy.int16), uInt32(pyBuffer.size), float64(pyRate)) )
+    return pyBuffer
+
+def pyAI_ScanBlock(pyDevice, pyChans, pyGain, pyBuffer, pyScanRate):
+    """Acquires pyBuffer.size/len(pyChans) scans of the AI channels in pyChans
+    at pyScanRate scans per second into the preallocated int16 array pyBuffer,
+    multiplexed: one sample of every channel, in the order of pyChans, per
+    scan (shape (scans, len(pyChans))). The channels of a scan are converted
+    back to back, spread evenly over the scan interval. Returns pyBuffer."""
+    nchans = len(pyChans)
+    chanVect = (int16 * nchans)(*pyChans)
+    gainVect = (int16 * nchans)(*([pyGain]*nchans))
+
+    CHK( nidaq.SCAN_Op(int16(pyDevice), int16(nchans), chanVect, gainVect, _buffer(pyBuffer, numpy.int16),
+                       uInt32(pyBuffer.size), float64(pyScanRate*nchans), float64(pyScanRate)) )
+    return pyBuffer
+
+def pyAI_VScaleBlock(pyDevice, pyChan, pyGain, pyReadings, pyVoltages):
+    """Converts the int16 readings of pyAI_ReadBlock into volts, written into
+    the preallocated float64 array pyVoltages."""
+    if pyVoltages.size != pyReadings.size:
+        raise ValueError('voltage buffer has %d entries, expected %d' % (pyVoltages.size, pyReadings.size))
+
+    CHK( nidaq.DAQ_VScale(int16(pyDevice), int16(pyChan), int16(pyGain), float64(1.0), float64(0.0),
+                          uInt32(pyReadings.size), _buffer(pyReadings, numpy.int16),
+                          _buffer(pyVoltages, numpy.float64)) )
+    return pyVoltages
+
+def pyAO_WriteBlock(pyDevice, pyChans, pyBuffer, pyRate):
+    """Clocks the int16 waveform in pyBuffer out of the AO channels in pyChans
+    at pyRate updates per second. pyBuffer holds one value per channel for
+    every update (shape (count,) for one channel, (count, len(pyChans)) for
+    several). Returns when the waveform has been generated."""
+    chanVect = (int16 * len(pyChans))(*pyChans)
+
+    CHK( nidaq.WFM_Op(int16(pyDevice), int16(len(pyChans)), chanVect, _buffer(pyBuffer, numpy.int16),
+                      uInt32(pyBuffer.size), uInt32(1), float64(pyRate)) )
+    return 1
+
+
+# Buffered (hardware timed) waveform functions ------------------------------
+# These let a whole line or frame of the raster be clocked out of the AO
+# channels by the DAQPAD while the AI channels are sampled on the same clock,
+# instead of one AO_Write/AI_Read pair per pixel.
+#
+# The AI conversions are not timed by a clock of their own: the acquisition
+# is configured for external conversions (DAQ_Config extConv = EXT_CONV) and
+# started before the waveform, so it sits armed until the waveform starts
+# and then converts once per update of the waveform group. The update clock
+# output has to be wired to EXTCONV* on the DAQPAD's I/O connector. Every
+# sample is then taken a fixed conversion delay after the X/Y point it
+# belongs to, whatever the software latency between starting the two.
+#
+# Multiplexed channels take one conversion each, so with n channels the
+# waveform runs n times faster and repeats every X/Y point n times: each
+# point gets one update, and one conversion, per channel.
+
+WFM_GROUP = 1
+WFM_CLEAR = 0
+WFM_START = 1
+EXT_CONV = 1        # DAQ_Config: conversions on the EXTCONV* input
+INT_CONV = 0        # DAQ_Config: conversions on the internal sample clock
+SCAN_TIMEOUT = 0.5  # seconds a buffered scan may take beyond its length before it is given up
+
+def pyWFM_Group_Setup(pyDevice, pyChans, pyGroup):
+    """Assigns the AO channels in pyChans to a waveform group."""
+    chanVect = (int16 * len(pyChans))(*pyChans)
+
+    CHK( nidaq.WFM_Group_Setup(int16(pyDevice), int16(len(pyChans)), chanVect, int16(pyGroup)) )
+    return 1
+
+def pyWFM_Load(pyDevice, pyChans, pyBuffer, pyIterations):
+    """Loads an interleaved int16 waveform buffer (one value per channel in
+    pyChans for every update) for output on the next WFM_Group_Control start."""
+    chanVect = (int16 * len(pyChans))(*pyChans)
+
+    CHK( nidaq.WFM_Load(int16(pyDevice), int16(len(pyChans)), chanVect, _buffer(pyBuffer, numpy.int16),
+                        uInt32(pyBuffer.size), uInt32(pyIterations), int16(0)) )
+    return 1
+
+def pyWFM_ClockRate(pyDevice, pyGroup, pyRate):
+    """Sets the update rate (points per second) of a waveform group."""
+    timebase = int16(0)
+    interval = uInt32(0)
+
+    CHK( nidaq.WFM_Rate(float64(pyRate), int16(0), ctypes.byref(timebase), ctypes.byref(interval)) )
+    CHK( nidaq.WFM_ClockRate(int16(pyDevice), int16(pyGroup), int16(0), timebase, interval, int16(0)) )
+    return 1
+
+def pyWFM_Group_Control(pyDevice, pyGroup, pyOperation):
+    """Starts (WFM_START) or stops and clears (WFM_CLEAR) a waveform group."""
+    CHK( nidaq.WFM_Group_Control(int16(pyDevice), int16(pyGroup), int16(pyOperation)) )
+    return 1
+
+def pyAI_Start(pyDevice, pySigChan, pyGain, pyBuffer):
+    """Arms an acquisition of pyBuffer.size samples of pySigChan (or of the
+    channels in a sequence pySigChan, multiplexed) into pyBuffer, one sample
+    per conversion pulse on EXTCONV*. Returns immediately."""
+    timebase, interval = int16(1), uInt32(2)    # ignored with external conversions
+    if isinstance(pySigChan, int):
+        CHK( nidaq.DAQ_Start(int16(pyDevice), int16(pySigChan), int16(pyGain), _buffer(pyBuffer, numpy.int16),
+                             uInt32(pyBuffer.size), timebase, interval) )
+    else:
+        CHK( nidaq.SCAN_Start(int16(pyDevice), _buffer(pyBuffer, numpy.int16), uInt32(pyBuffer.size),
+                              timebase, interval, int16(0), uInt32(0)) )
+    return 1
+
+def pyAI_Wait(pyDevice, pySeconds):
+    """Waits until the acquisition armed by pyAI_Start, which takes pySeconds,
+    has filled its buffer, then clears it. Raises RuntimeError if it has not
+    SCAN_TIMEOUT seconds later (a missed trigger or clock pulse)."""
+    status = int16(0)
+    retrieved = uInt32(0)
+    starttime = time.perf_counter()
+    deadline = starttime + pySeconds + SCAN_TIMEOUT
+    try:
+        # sleep through most of the acquisition, then poll and yield
+        time.sleep(0.9*pySeconds)
+        while True:
+            CHK( nidaq.DAQ_Check(int16(pyDevice), ctypes.byref(status), ctypes.byref(retrieved)) )
+            if status.value:
+                break
+            if time.perf_counter() > deadline:
+                raise RuntimeError('acquisition timed out after %.2f s with %d samples'
+                                   % (time.perf_counter() - starttime, retrieved.value))
+            time.sleep(0)
+    finally:
+        nidaq.DAQ_Clear(int16(pyDevice))
+    return 1
+
+# (device, X, Y, signal channels, gain, rate) the waveform group and the
+# acquisition were last configured for, by pyScan_Setup
+_scan_setup = {}
+# waveforms with every point repeated once per channel, by shape
+_repeated = {}
+
+def _nchans(pySigChan):
+    return 1 if isinstance(pySigChan, int) else len(pySigChan)
+
+def _repeat_points(pyXYBuffer, nchans):
+    """pyXYBuffer with every X/Y point repeated nchans times, in a buffer kept for its shape."""
+    points = pyXYBuffer.size//2
+    out = _repeated.get(points*nchans)
+    if out is None:
+        out = _repeated[points*nchans] = numpy.empty((points, nchans, 2), dtype=numpy.int16)
+    out[...] = pyXYBuffer.reshape(points, 1, 2)
+    return out
+
+def pyScan_Setup(pyDevice, pyXChan, pyYChan, pySigChan, pyGain, pyRate):
+    """Configures a buffered scan once: X/Y waveform group, its update clock
+    at pyRate points per second times the number of signal channels, the
+    signal channels (multiplexed if there are several) and AI conversions on
+    the update clock (EXT_CONV). Calls with the same settings as the last
+    one return without touching the driver."""
+    setup = (pyXChan, pyYChan, pySigChan, pyGain, pyRate)
+    if _scan_setup.get(pyDevice) == setup:
+        return 1
+    _scan_setup.pop(pyDevice, None)
+    pyWFM_Group_Setup(pyDevice, (pyXChan, pyYChan), WFM_GROUP)
+    pyWFM_ClockRate(pyDevice, WFM_GROUP, pyRate*_nchans(pySigChan))
+    CHK( nidaq.DAQ_Config(int16(pyDevice), int16(0), int16(EXT_CONV)) )
+    if not isinstance(pySigChan, int):
+        nchans = len(pySigChan)
+        chanVect = (int16 * nchans)(*pySigChan)
+        gainVect = (int16 * nchans)(*([pyGain]*nchans))
+        CHK( nidaq.SCAN_Setup(int16(pyDevice), int16(nchans), chanVect, gainVect) )
+    _scan_setup[pyDevice] = setup
+    return 1
+
+def pyScan_Op(pyDevice, pyXChan, pyYChan, pySigChan, pyGain, pyXYBuffer, pyReadBuffer, pyRate):
+    """Clocks an interleaved X/Y raster out of pyXChan/pyYChan at pyRate
+    points per second and reads one sample of pySigChan per point into
+    pyReadBuffer (int16, one entry per X/Y pair). pySigChan may also be a
+    sequence of channels, which are read multiplexed (one entry per channel
+    per X/Y pair, from as many repeats of the point). The configuration is done by pyScan_Setup the first time
+    and whenever the settings change; per buffer only the waveform is loaded
+    and the acquisition armed before the waveform is started, so every
+    reading is converted on the update of its X/Y point. Raises
+    RuntimeError if the readings do not arrive (see pyAI_Wait)."""
+    nchans = _nchans(pySigChan)
+    if pyReadBuffer.size != pyXYBuffer.size//2*nchans:
+        raise ValueError('read buffer has %d entries, expected %d' % (pyReadBuffer.size, pyXYBuffer.size//2*nchans))
+    pyScan_Setup(pyDevice, pyXChan, pyYChan, pySigChan, pyGain, pyRate)
+    if nchans > 1:
+        pyXYBuffer = _repeat_points(pyXYBuffer, nchans)
+    pyWFM_Load(pyDevice, (pyXChan, pyYChan), pyXYBuffer, 1)
+    pyAI_Start(pyDevice, pySigChan, pyGain, pyReadBuffer)
+    try:
+        pyWFM_Group_Control(pyDevice, WFM_GROUP, WFM_START)
+        try:
+            pyAI_Wait(pyDevice, pyReadBuffer.size/(pyRate*nchans))
+        finally:
+            # stops the group; the group and its clock stay configured
+            pyWFM_Group_Control(pyDevice, WFM_GROUP, WFM_CLEAR)
+    except Exception:
+        _scan_setup.pop(pyDevice, None)
+        raise
+    return 1
+
+
+# Driver sessions -----------------------------------------------------------
+# The module functions above convert every argument on every call and share
+# their result variables between all callers. A DaqSession binds the driver
+# prototypes once when it is opened and owns its own argument and result
+# buffers, so the scalar calls do as little work as possible and threads that
+# each use their own session cannot overwrite each other's results.
+
+# name: (argtypes) of the NI-DAQ functions bound by a session. All return an i16 status.
+_PROTOTYPES = {
+    'AI_Configure': (int16, int16, int16, int16, int16, int16),
+    'AI_Read':      (int16, int16, int16, ctypes.POINTER(int16)),
+    'AI_VRead':     (int16, int16, int16, ctypes.POINTER(float64)),
+    'AO_Write':     (int16, int16, int16),
+    'AO_VWrite':    (int16, int16, float64),
+    'DAQ_Op':       (int16, int16, int16, ctypes.POINTER(int16), uInt32, float64),
+    'SCAN_Op':      (int16, int16, ctypes.POINTER(int16), ctypes.POINTER(int16), ctypes.POINTER(int16), uInt32, float64, float64),
+    'WFM_Op':       (int16, int16, ctypes.POINTER(int16), ctypes.POINTER(int16), uInt32, uInt32, float64),
+}
+
+class DaqSession:
+    """An open handle on one DAQ device with prebound driver prototypes.
+
+    A session is not shared between threads; give every thread its own
+    session (see thread_session). Sessions on the same device can be used
+    from different threads at the same time.
+    """
+
+    def __init__(self, pyDevice=1, dll=None):
+        if dll is None:
+            dll = nidaq
+        self.device = pyDevice
+        for name, argtypes in _PROTOTYPES.items():
+            setattr(self, '_' + name, ctypes.WINFUNCTYPE(int16, *argtypes)((name, dll)))
+
+        # Preallocated result buffers and pointers to them
+        self._reading = int16(0)
+        self._pReading = ctypes.pointer(self._reading)
+        self._voltage = float64(0.0)
+        self._pVoltage = ctypes.pointer(self._voltage)
+
+    def AI_Configure(self, pyChan, pyInputMode, pyInputRange, pyPolarity, pyDriveAIS):
+        CHK( self._AI_Configure(self.device, pyChan, pyInputMode, pyInputRange, pyPolarity, pyDriveAIS) )
+        return 1
+
+    def AI_Read(self, pyChan, pyGain):
+        err = self._AI_Read(self.device, pyChan, pyGain, self._pReading)
+        if err < 0: CHK(err)
+        return self._reading.value
+
+    def AI_VRead(self, pyChan, pyGain):
+        err = self._AI_VRead(self.device, pyChan, pyGain, self._pVoltage)
+        if err < 0: CHK(err)
+        return self._voltage.value
+
+    def AO_Write(self, pyChan, pyReading):
+        err = self._AO_Write(self.device, pyChan, pyReading)
+        if err < 0: CHK(err)
+        return 1
+
+    def AO_VWrite(self, pyChan, pyVoltage):
+        err = self._AO_VWrite(self.device, pyChan, pyVoltage)
+        if err < 0: CHK(err)
+        return 1
+
+    def AI_ReadBlock(self, pyChan, pyGain, pyBuffer, pyRate):
+        """Same as pyAI_ReadBlock, on this session's device."""
+        CHK( self._DAQ_Op(self.device, pyChan, pyGain, _buffer(pyBuffer, numpy.int16), pyBuffer.size, pyRate) )
+        return pyBuffer
+
+    def AI_ScanBlock(self, pyChans, pyGain, pyBuffer, pyScanRate):
+        """Same as pyAI_ScanBlock, on this session's device."""
+        nchans = len(pyChans)
+        chanVect = (int16 * nchans)(*pyChans)
+        gainVect = (int16 * nchans)(*([pyGain]*nchans))
+        CHK( self._SCAN_Op(self.device, nchans, chanVect, gainVect, _buffer(pyBuffer, numpy.int16),
+                           pyBuffer.size, pyScanRate*nchans, pyScanRate) )
+        return pyBuffer
+
+    def AO_WriteBlock(self, pyChans, pyBuffer, pyRate):
+        """Same as pyAO_WriteBlock, on this session's device."""
+        chanVect = (int16 * len(pyChans))(*pyChans)
+        CHK( self._WFM_Op(self.device, len(pyChans), chanVect, _buffer(pyBuffer, numpy.int16), pyBuffer.size, 1, pyRate) )
+        return 1
+
+_thread_sessions = threading.local()
+
+def thread_session(pyDevice=1):
+    """Returns the calling thread's DaqSession for pyDevice, opening it on first use."""
+    sessions = _thread_sessions.__dict__
+    try:
+        return sessions[pyDevice]
+    except KeyError:
+        sessions[pyDevice] = DaqSession(pyDevice)
+        return sessions[pyDevice]
@@ -4,6 +4,8 @@
 # Mark: this is my trying to replicate the file AIonePoint.C from the NiDaq examples
 
 #import ctypes
+import threading
+import time
 import numpy
 
 #nidaq = ctypes.windll.nidaq32 # load the DLL
@@ -46,6 +48,26 @@ def CHK(err): # This is from scipy wiki
         nidaq.DAQmxGetErrorString(err,ctypes.byref(buf),buf_size)
         raise RuntimeError('nidaq call failed with error %d: %s'%(err,repr(buf.value)))
 """
+
+# Simulated timing ------------------------------------------------------------
+# Every simulated driver call takes SIM_CALL_LATENCY seconds plus
+# SIM_SAMPLE_LATENCY seconds per sample it reads or writes, so benchmarks can
+# model the driver overhead and the hardware sample clock. Both are 0 by
+# default, which makes the calls as fast as the simulation itself.
+
+SIM_CALL_LATENCY = 0.0     # seconds per driver call
+SIM_SAMPLE_LATENCY = 0.0   # seconds per sample, 1/sample rate
+
+def _wait(samples=0):
+    delay = SIM_CALL_LATENCY + samples*SIM_SAMPLE_LATENCY
+    if delay <= 0:
+        return
+    end = time.perf_counter() + delay
+    if delay > 0.002:
+        time.sleep(delay - 0.001)
+    while time.perf_counter() < end:
+        pass    # sleep is too coarse for microsecond delays
+
 def pyAI_Configure(pyDeviceNumber, pyChan, pyInputMode, pyInputRange, pyPolarity, pyDriveAIS):
     """Informs NI-DAQ of the input mode (single-ended or differential),
     input range, and input polarity selected for the device. Use this
@@ -63,6 +85,7 @@ def pyAI_Configure(pyDeviceNumber, pyChan, pyInputMode, pyInputRange, pyPolarity
 
     CHK( nidaq.AI_Configure( iDevice, iChan, iInputMode, iInputRange, iPolarity, iDriveAIS) )
     """
+    _wait()
     return 1
 
 
@@ -77,7 +100,7 @@ def pyAI_VRead(pyDevice, pyChan, pyGain):
     
     #print(dVoltage.value)
     """
-    return numpy.random.rand()*10 - 5
+    return thread_session(pyDevice).AI_VRead(pyChan, pyGain)
 
 def pyAI_Read(pyDevice, pyChan, pyGain):
     """
@@ -88,7 +111,7 @@ def pyAI_Read(pyDevice, pyChan, pyGain):
     CHK( nidaq.AI_Read(iDevice, iChan, iGain, ctypes.byref(iReading)) )
     """    
     #print(dVoltage.value)
-    return numpy.random.rand()*4096 - 2048
+    return thread_session(pyDevice).AI_Read(pyChan, pyGain)
 
 def pyAO_VWrite(pyDevice, pyChan, pyVoltage):
     """
@@ -98,7 +121,7 @@ def pyAO_VWrite(pyDevice, pyChan, pyVoltage):
 
     CHK( nidaq.AO_VWrite(iDevice, iChan, dVoltage_O) )
     """
-    return 1
+    return thread_session(pyDevice).AO_VWrite(pyChan, pyVoltage)
 
 def pyAO_Write(pyDevice, pyChan, pyReading):
     """
@@ -108,8 +131,192 @@ def pyAO_Write(pyDevice, pyChan, pyReading):
 
     CHK( nidaq.AO_Write(iDevice, iChan, iReading_O) )
     """
+    return thread_session(pyDevice).AO_Write(pyChan, pyReading)
+
+
+
+
+
+# Block (array) functions ---------------------------------------------------
+# Simulated versions of the block functions in pyNIDAQ. They check the
+# buffers the same way the real wrappers do and fill them in place with
+# vectorized numpy calls.
+
+_rng = numpy.random.default_rng()
+
+def _buffer(pyArray, pyType):
+    if not isinstance(pyArray, numpy.ndarray):
+        raise TypeError('expected a numpy array, got %s' % type(pyArray).__name__)
+    if pyArray.dtype != pyType:
+        raise TypeError('expected a %s array, got %s' % (numpy.dtype(pyType).name, pyArray.dtype.name))
+    if not pyArray.flags['C_CONTIGUOUS']:
+        raise ValueError('buffer must be C-contiguous')
+    return pyArray
+
+def pyAI_ReadBlock(pyDevice, pyChan, pyGain, pyBuffer, pyRate):
+    _buffer(pyBuffer, numpy.int16)[:] = _rng.integers(-2048, 2048, pyBuffer.size, dtype=numpy.int16).reshape(pyBuffer.shape)
+    _wait(pyBuffer.size)
+    return pyBuffer
+
+def pyAI_ScanBlock(pyDevice, pyChans, pyGain, pyBuffer, pyScanRate):
+    _buffer(pyBuffer, numpy.int16)[:] = _rng.integers(-2048, 2048, pyBuffer.size, dtype=numpy.int16).reshape(pyBuffer.shape)
+    _wait(pyBuffer.size)
+    return pyBuffer
+
+def pyAI_VScaleBlock(pyDevice, pyChan, pyGain, pyReadings, pyVoltages):
+    if pyVoltages.size != pyReadings.size:
+        raise ValueError('voltage buffer has %d entries, expected %d' % (pyVoltages.size, pyReadings.size))
+    numpy.multiply(_buffer(pyReadings, numpy.int16), 5.0/2048, out=_buffer(pyVoltages, numpy.float64))
+    return pyVoltages
+
+def pyAO_WriteBlock(pyDevice, pyChans, pyBuffer, pyRate):
+    _buffer(pyBuffer, numpy.int16)
+    _wait(pyBuffer.size)
+    return 1
+
+
+# Simulated specimen ----------------------------------------------------------
+# Scans read a fixed field of round particles at the beam position plus
+# gaussian detector noise, so averaging over the dwell samples and the SNR
+# figures behave the way they do on the microscope. Odd AI channels see the
+# particles with inverted, weaker contrast, like a second detector would.
+# SIM_DRIFT moves the specimen steadily, to try out drift registration.
+
+SIM_NOISE = 400       # standard deviation of the detector noise, in ADC counts
+SIM_PERIOD = 256      # DAC codes between particle centres, on average
+SIM_RADIUS = 80       # largest particle radius in DAC codes
+SIM_DRIFT = (0.0, 0.0)   # specimen drift in X and Y, DAC codes per second
+_sim_start = time.time()
+
+def _drift():
+    t = time.time() - _sim_start
+    return int(SIM_DRIFT[0]*t), int(SIM_DRIFT[1]*t)
+
+def _specimen(pyX, pyY, pyChan=0):
+    """Noise free signal of AI channel pyChan at DAC codes pyX, pyY (scalars or arrays)."""
+    # one particle per SIM_PERIOD cell, placed and sized by a hash of the cell
+    cx = pyX // SIM_PERIOD
+    cy = pyY // SIM_PERIOD
+    h = ((cx*73856093) ^ (cy*19349663)) & 0xffff
+    jitter = SIM_PERIOD//2 - SIM_RADIUS
+    radius = SIM_RADIUS//2 + (h >> 8) % (SIM_RADIUS//2)
+    dx = (pyX % SIM_PERIOD) - SIM_PERIOD//2 - (h % (2*jitter + 1) - jitter)
+    dy = (pyY % SIM_PERIOD) - SIM_PERIOD//2 - ((h >> 4) % (2*jitter + 1) - jitter)
+    contrast = -600 if pyChan % 2 else 1200
+    return contrast*(dx*dx + dy*dy < radius*radius) - contrast//2
+
+def _detector(pyX, pyY, pyBuffer, rng, pyChans=(0,)):
+    """Fill pyBuffer with the specimen at pyX, pyY plus noise, clipped to 12
+    bits, one sample of every channel in pyChans per position (multiplexed)."""
+    ddx, ddy = _drift()
+    x = numpy.asarray(pyX, dtype=numpy.int32)[..., None] - ddx
+    y = numpy.asarray(pyY, dtype=numpy.int32)[..., None] - ddy
+    signal = numpy.stack([_specimen(x, y, chan) for chan in pyChans], axis=-1).reshape(-1)
+    noisy = signal + rng.normal(0, SIM_NOISE, pyBuffer.size)
+    numpy.clip(noisy, -2048, 2047, out=noisy)
+    pyBuffer.reshape(-1)[:] = noisy
+    return pyBuffer
+
+
+# Buffered (hardware timed) waveform functions ------------------------------
+# Simulated versions of the buffered raster calls in pyNIDAQ. The readings
+# are generated for the whole buffer at once so the buffered scan loop can be
+# timed without the DAQPAD attached.
+
+WFM_GROUP = 1
+WFM_CLEAR = 0
+WFM_START = 1
+
+def pyWFM_Group_Setup(pyDevice, pyChans, pyGroup):
+    return 1
+
+def pyWFM_Load(pyDevice, pyChans, pyBuffer, pyIterations):
+    _buffer(pyBuffer, numpy.int16)
+    return 1
+
+def pyWFM_ClockRate(pyDevice, pyGroup, pyRate):
+    return 1
+
+def pyWFM_Group_Control(pyDevice, pyGroup, pyOperation):
+    return 1
+
+def pyScan_Op(pyDevice, pyXChan, pyYChan, pySigChan, pyGain, pyXYBuffer, pyReadBuffer, pyRate):
+    _buffer(pyXYBuffer, numpy.int16)
+    chans = (pySigChan,) if isinstance(pySigChan, int) else tuple(pySigChan)
+    # one conversion per waveform update, and every point is repeated once per channel
+    updates = pyXYBuffer.size//2*len(chans)
+    if pyReadBuffer.size != updates:
+        raise ValueError('read buffer has %d entries, expected %d' % (pyReadBuffer.size, updates))
+    _wait(updates)
+    xy = pyXYBuffer.reshape(-1, 2)
+    _detector(xy[:, 0], xy[:, 1], _buffer(pyReadBuffer, numpy.int16), _rng, chans)
     return 1
 
 
+# Driver sessions -----------------------------------------------------------
+# Simulated DaqSession with the same methods as the one in pyNIDAQ. Each
+# session draws its readings from its own generator, so sessions used from
+# different threads do not share any state. Reads return the specimen at the
+# last codes written to AO channels 0 (X) and 1 (Y); the scalar reads take
+# their noise from a pregenerated block to keep the per-call cost down.
+# The scalar module functions go through the calling thread's session, so
+# they simulate the same readings as DaqSession.
+
+class DaqSession:
+
+    NOISE_BLOCK = 65536
+
+    def __init__(self, pyDevice=1, dll=None):
+        self.device = pyDevice
+        self._rng = numpy.random.default_rng()
+        self._noise = self._rng.normal(0, SIM_NOISE, self.NOISE_BLOCK).astype(int).tolist()
+        self._next = 0
+        self._ao = [0, 0]
+
+    def AI_Configure(self, pyChan, pyInputMode, pyInputRange, pyPolarity, pyDriveAIS):
+        return 1
+
+    def AI_Read(self, pyChan, pyGain):
+        _wait(1)
+        self._next = (self._next + 1) % self.NOISE_BLOCK
+        reading = _specimen(self._ao[0], self._ao[1], pyChan) + self._noise[self._next]
+        return min(max(reading, -2048), 2047)
+
+    def AI_VRead(self, pyChan, pyGain):
+        return self.AI_Read(pyChan, pyGain)*(5.0/2048)
+
+    def AO_Write(self, pyChan, pyReading):
+        _wait(1)
+        if pyChan < 2:
+            self._ao[pyChan] = pyReading
+        return 1
+
+    def AO_VWrite(self, pyChan, pyVoltage):
+        _wait(1)
+        return 1
+
+    def AI_ReadBlock(self, pyChan, pyGain, pyBuffer, pyRate):
+        _wait(pyBuffer.size)
+        return _detector(self._ao[0], self._ao[1], _buffer(pyBuffer, numpy.int16), self._rng, (pyChan,))
+
+    def AI_ScanBlock(self, pyChans, pyGain, pyBuffer, pyScanRate):
+        _wait(pyBuffer.size)
+        scans = pyBuffer.size//len(pyChans)
+        x = numpy.full(scans, self._ao[0])
+        y = numpy.full(scans, self._ao[1])
+        return _detector(x, y, _buffer(pyBuffer, numpy.int16), self._rng, tuple(pyChans))
+
+    def AO_WriteBlock(self, pyChans, pyBuffer, pyRate):
+        _buffer(pyBuffer, numpy.int16)
+        _wait(pyBuffer.size)
+        return 1
 
+_thread_sessions = threading.local()
 
+def thread_session(pyDevice=1):
+    sessions = _thread_sessions.__dict__
+    try:
+        return sessions[pyDevice]
+    except KeyError:
+        sessions[pyDevice] = DaqSession(pyDevice)
+        return sessions[pyDevice]
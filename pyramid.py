@@ -0,0 +1,60 @@
+# Multi-resolution image pyramid for the SEM viewer
+# Written for the Amray SEM control program
+
+"""
+Keeps 2x2-averaged copies of the 8-bit display buffer at half, quarter, ...
+resolution. When rows of the base image change only the rows above them in
+each level are recomputed, so the pyramid is maintained line by line as the
+scan arrives. The viewer shows the level that matches the number of screen
+pixels it has, so drawing cost stops growing with the scan resolution.
+Colour (rows, cols, 3) display buffers are reduced the same way.
+"""
+
+from math import log2, floor
+
+from numpy import zeros, uint8, uint16, minimum, unique, concatenate, arange
+
+
+def _reduce_rows(src, dst, rows):
+    """Recompute rows of dst as the 2x2 average of the rows below them in src."""
+    h, w = src.shape[:2]
+    s = src[2*rows].astype(uint16)
+    s += src[minimum(2*rows + 1, h - 1)]
+    even = s[:, 0::2]
+    odd = s[:, 1::2]
+    if w % 2:
+        odd = concatenate([odd, s[:, -1:]], axis=1)
+    dst[rows] = (even + odd + 2) // 4
+
+
+class ImagePyramid:
+
+    def __init__(self, base, min_size=64):
+        self.levels = [base]
+        h, w = base.shape[:2]
+        while max(h, w) > min_size:
+            h, w = -(-h//2), -(-w//2)
+            self.levels.append(zeros((h, w) + base.shape[2:], dtype=uint8))
+
+    def update(self, rows):
+        """Propagate changed base rows up through every level."""
+        for k in range(1, len(self.levels)):
+            if len(rows) == 0:
+                break
+            rows = unique(rows // 2)
+            _reduce_rows(self.levels[k-1], self.levels[k], rows)
+
+    def rebuild(self):
+        self.update(arange(self.levels[0].shape[0]))
+
+    def level_for(self, source_pixels, screen_pixels):
+        """Index of the coarsest level that still has at least one pixel per
+        screen pixel, when source_pixels base pixels are shown across
+        screen_pixels pixels of the screen."""
+        if screen_pixels <= 0 or source_pixels <= screen_pixels:
+            return 0
+        return min(int(floor(log2(source_pixels/screen_pixels))), len(self.levels) - 1)
+
+    def level_for_size(self, screen_pixels):
+        """Level to use to show the whole image across screen_pixels pixels."""
+        return self.level_for(max(self.levels[0].shape[:2]), screen_pixels)
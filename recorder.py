@@ -0,0 +1,177 @@
+# Streaming frame recorder for the SEM image
+# Written for the Amray SEM control program
+
+"""
+Records completed frames (or completed lines) to disk from a background
+writer thread. The scan thread copies each frame or line into one of a fixed
+set of preallocated buffers and queues it; the writer appends the raw pixels
+to <name>.raw and one fixed-size record per block to <name>.idx. If all the
+buffers are in use the block is dropped and counted rather than making the
+scan thread wait. Frames and lines that do not fit the recording's frame
+size (the scan was switched to another resolution) are dropped the same
+way, a recording only ever has one frame size. export_tiff turns a recording into a multi-page TIFF stack.
+Given a BufferPool the buffers come from the pool and go back to it on close.
+"""
+
+import threading
+import queue
+import time
+
+from numpy import zeros, int16, int64, float64, dtype, fromfile, memmap
+
+# One index record per block written to the raw file
+INDEX_DTYPE = dtype([('frame', int64), ('row', int64), ('x0', int64), ('rows', int64),
+                     ('cols', int64), ('offset', int64), ('time', float64)])
+
+
+class FrameRecorder:
+
+    def __init__(self, name, rows, cols, per_line=False, queue_size=16, pixel_type=int16, pool=None):
+        self.name = name
+        self.rows = rows
+        self.cols = cols
+        self.per_line = per_line
+        self.pixel_type = dtype(pixel_type)
+
+        # Preallocated blocks, handed back and forth between scan thread and writer
+        shape = (1, cols) if per_line else (rows, cols)
+        self._free = queue.Queue()
+        self._buffers = [pool.acquire(shape, pixel_type) for k in range(queue_size)] if pool is not None else []
+        for k in range(queue_size):
+            self._free.put(self._buffers[k].array if self._buffers else zeros(shape, dtype=pixel_type))
+        self._full = queue.Queue(maxsize=queue_size)
+
+        self.frames_written = 0
+        self.lines_written = 0
+        self.bytes_written = 0
+        self.dropped = 0
+        self._last_frame = None
+        self._starttime = time.time()
+
+        self._raw = open(name + '.raw', 'ab')
+        self._idx = open(name + '.idx', 'ab')
+        self._offset = self._raw.tell()
+        self._writer = threading.Thread(target=self._write_loop, name='FrameRecorder')
+        self._writer.daemon = True
+        self._writer.start()
+
+    # Scan thread side ----------------------------------------------------------
+    def submit_frame(self, frame, frame_no):
+        """Queue a copy of a completed frame. Never blocks; returns False if the
+        frame had to be dropped because the writer is behind or it is not of
+        the recording's frame size."""
+        if frame.shape != (self.rows, self.cols):
+            self.dropped += 1
+            return False
+        if self.per_line:
+            for j in range(frame.shape[0]):
+                self.submit_line(frame[j], frame_no, j)
+            return True
+        return self._submit(frame, frame_no, 0, 0)
+
+    def submit_line(self, line, frame_no, row, x0=0):
+        """Queue a copy of one completed line (row of frame frame_no starting at column x0)."""
+        if row >= self.rows or x0 + len(line) > self.cols:
+            self.dropped += 1
+            return False
+        return self._submit(line.reshape(1, -1), frame_no, row, x0)
+
+    def _submit(self, data, frame_no, row, x0):
+        try:
+            block = self._free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return False
+        rows, cols = data.shape
+        block[:rows, :cols] = data
+        self._full.put_nowait((block, frame_no, row, x0, rows, cols, time.time()))
+        return True
+
+    # Writer thread ---------------------------------------------------------------
+    def _write_loop(self):
+        while True:
+            item = self._full.get()
+            if item is None:
+                break
+            block, frame_no, row, x0, rows, cols, stamp = item
+            data = block[:rows, :cols]
+            if not data.flags['C_CONTIGUOUS']:
+                data = data.copy()
+            self._raw.write(data.data)
+            record = zeros(1, dtype=INDEX_DTYPE)
+            record[0] = (frame_no, row, x0, rows, cols, self._offset, stamp)
+            self._idx.write(record.tobytes())
+            self._offset += data.nbytes
+            self.bytes_written += data.nbytes
+            if frame_no != self._last_frame:
+                self.frames_written += 1
+                self._last_frame = frame_no
+            self.lines_written += rows
+            self._free.put(block)
+        self._raw.flush()
+        self._idx.flush()
+
+    def queue_depth(self):
+        """Blocks waiting for the writer."""
+        return self._full.qsize()
+
+    def stats(self):
+        """Throughput of the writer so far."""
+        elapsed = time.time() - self._starttime
+        return {
+            'frames_written': self.frames_written,
+            'lines_written': self.lines_written,
+            'bytes_written': self.bytes_written,
+            'MB_per_second': self.bytes_written/elapsed/1e6 if elapsed > 0 else 0.0,
+            'dropped': self.dropped,
+            'queue_depth': self.queue_depth(),
+        }
+
+    def close(self):
+        """Write out everything still queued and close the files."""
+        self._full.put(None)
+        self._writer.join()
+        self._raw.close()
+        self._idx.close()
+        for buffer in self._buffers:
+            buffer.release()
+        self._buffers = []
+        return self.stats()
+
+
+# Reading recordings back -------------------------------------------------------
+def read_index(name):
+    return fromfile(name + '.idx', dtype=INDEX_DTYPE)
+
+
+def iter_frames(name, rows, cols, pixel_type=int16):
+    """Yield (frame_no, frame) for every frame of a recording, assembling line
+    records into frames. The raw file is memory-mapped, not read into memory."""
+    index = read_index(name)
+    if len(index) == 0:
+        return
+    raw = memmap(name + '.raw', dtype=pixel_type, mode='r')
+    itemsize = dtype(pixel_type).itemsize
+    frame = zeros((rows, cols), dtype=pixel_type)
+    current = index[0]['frame']
+    for rec in index:
+        if rec['frame'] != current:
+            yield current, frame
+            current = rec['frame']
+        start = rec['offset']//itemsize
+        block = raw[start:start + rec['rows']*rec['cols']].reshape(rec['rows'], rec['cols'])
+        frame[rec['row']:rec['row']+rec['rows'], rec['x0']:rec['x0']+rec['cols']] = block
+    yield current, frame
+
+
+def export_tiff(name, rows, cols, tiff_path, pixel_type=int16):
+    """Write every frame of a recording to a multi-page TIFF, one page at a time."""
+    from PIL import Image, TiffImagePlugin
+
+    count = 0
+    with TiffImagePlugin.AppendingTiffWriter(tiff_path, True) as tf:
+        for frame_no, frame in iter_frames(name, rows, cols, pixel_type):
+            Image.fromarray(frame).save(tf, format='tiff')
+            tf.newFrame()
+            count += 1
+    return count
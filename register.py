@@ -0,0 +1,233 @@
+# Drift registration for long integrations and frame stacks
+# Written for the Amray SEM control program
+
+"""
+Long continuous scans drift, so frames that are averaged or recorded one
+after the other do not line up. DriftRegistrar estimates each completed
+frame's shift against a reference with FFT phase correlation, optionally on
+a 2**level reduced copy of both for speed, refines the peak to sub-pixel
+precision with a parabola in each direction, and shifts the frame back into
+place before it is integrated, published and recorded.
+
+The reference is the integrated image so far, so it gets less noisy as the
+integration goes on and every frame is registered to the same position.
+
+Registration runs in its own thread, like the sparse Reconstructor: the
+scan generator hands over a copy of every completed frame and the registrar
+is the only thing publishing to the stores while registration is on. The
+frame-sized working arrays (reduced and windowed frames, the spectrum's
+magnitude, the shifted frame) come from the BufferPool and the reference is
+reduced into the same array every frame; only the FFTs allocate their results.
+"""
+
+import threading
+import queue
+import time
+from functools import lru_cache
+
+from numpy import (arange, floor, clip, conj, hanning, argmax, unravel_index, float32, rint,
+                   outer, abs as absolute, take, exp, empty, subtract)
+from numpy.fft import rfft2, irfft2, fftfreq, rfftfreq
+
+from bufferpool import POOL
+
+
+def reduced_shape(shape, level):
+    """Shape of reduce_frame of a frame of shape."""
+    f = 2**max(level, 0)
+    return (shape[0]//f, shape[1]//f)
+
+
+def reduce_frame(frame, level, out=None):
+    """frame averaged over 2**level by 2**level blocks (the edge rows and
+    columns that do not fill a block are dropped), as float32, into out if given."""
+    if level <= 0:
+        if out is None:
+            return frame.astype(float32)
+        out[...] = frame
+        return out
+    f = 2**level
+    h, w = reduced_shape(frame.shape, level)
+    return frame[:h*f, :w*f].reshape(h, f, w, f).mean(axis=(1, 3), dtype=float32, out=out)
+
+
+@lru_cache(maxsize=8)
+def _window(h, w):
+    return outer(hanning(h), hanning(w)).astype(float32)
+
+
+@lru_cache(maxsize=8)
+def _lowpass(h, w, cutoff):
+    f2 = fftfreq(h)[:, None]**2 + rfftfreq(w)[None, :]**2
+    return exp(-f2/cutoff**2).astype(float32)
+
+
+def _refine(c, p, n):
+    """Parabolic sub-pixel offset of the peak at index p of the periodic 1-D slice c."""
+    a, b, d = c[(p - 1) % n], c[p], c[(p + 1) % n]
+    denom = a - 2*b + d
+    return 0.5*(a - d)/denom if denom != 0 else 0.0
+
+
+def _windowed(image, window, out):
+    subtract(image, image.mean(), out=out, casting='unsafe')
+    out *= window
+    return out
+
+
+def phase_correlate(reference, frame, whiten=0.5, cutoff=0.1, pool=POOL):
+    """Sub-pixel shift (dy, dx) such that shift_frame(frame, dy, dx) lines up
+    with reference, and the height of the correlation peak in standard
+    deviations of the correlation surface.
+
+    The cross power spectrum is divided by its magnitude to the power whiten
+    (1 would be plain phase correlation) and rolled off above cutoff cycles
+    per pixel, where SEM frames are mostly noise; that keeps the peak sharp
+    without letting the noise move it."""
+    h, w = reference.shape
+    window = _window(h, w)
+    with pool.acquire((h, w), float32) as work:
+        A = rfft2(_windowed(reference, window, work))
+        B = rfft2(_windowed(frame, window, work))
+    R = A
+    R *= conj(B, out=B)
+    with pool.acquire(R.shape, R.real.dtype) as magnitude:
+        absolute(R, out=magnitude)
+        magnitude **= whiten
+        magnitude += 1e-9
+        R /= magnitude
+    R *= _lowpass(h, w, cutoff)
+    c = irfft2(R, s=(h, w))
+    py, px = unravel_index(argmax(c), c.shape)
+    dy = py + _refine(c[:, px], py, h)
+    dx = px + _refine(c[py, :], px, w)
+    # lags past the middle are negative shifts
+    if dy > h/2:
+        dy -= h
+    if dx > w/2:
+        dx -= w
+    return dy, dx, (c[py, px] - c.mean())/(c.std() + 1e-12)
+
+
+def _shift_axis(a, s, axis, out, step):
+    """a shifted by s pixels along axis into out; step is a working array of the same shape."""
+    n = a.shape[axis]
+    x = arange(n) - s
+    i0 = floor(x)
+    f = (x - i0).astype(float32)
+    i0 = i0.astype(int)
+    if axis == 0:
+        f = f[:, None]
+    take(a, clip(i0, 0, n - 1), axis=axis, out=out, mode='clip')
+    take(a, clip(i0 + 1, 0, n - 1), axis=axis, out=step, mode='clip')
+    step -= out
+    step *= f
+    out += step
+    return out
+
+
+def shift_frame(frame, dy, dx, out=None, pool=POOL):
+    """frame shifted down by dy and right by dx pixels (out[y, x] =
+    frame[y-dy, x-dx]) with bilinear interpolation, repeating the edges,
+    as float32, into out if given."""
+    if out is None:
+        out = empty(frame.shape, dtype=float32)
+    out[...] = frame
+    if dx == 0 and dy == 0:
+        return out
+    with pool.acquire(frame.shape, float32) as source, pool.acquire(frame.shape, float32) as step:
+        for s, axis in ((dx, 1), (dy, 0)):
+            if s != 0:
+                source[...] = out
+                _shift_axis(source, s, axis, out, step)
+    return out
+
+
+class DriftRegistrar(threading.Thread):
+    """Background thread that registers completed frames, integrates them and
+    publishes them to their stores. Frames arriving while one is still being
+    registered are dropped and counted."""
+
+    MIN_PEAK = 8.0    # peaks lower than this many standard deviations (no common structure) leave the frame unshifted
+
+    def __init__(self, level=1, pool=POOL, verbose=True):
+        threading.Thread.__init__(self, name='DriftRegistrar')
+        self.daemon = True
+        self.level = level
+        self.pool = pool
+        self.verbose = verbose    # print the shift of every frame
+        self.jobs = queue.Queue(maxsize=1)
+        self.reference = None
+        self.shift = (0.0, 0.0)   # shift applied to the last frame
+        self.cost = 0.0           # seconds spent registering the last frame
+        self.frames = 0
+        self.dropped = 0
+        self.start()
+
+    def submit(self, stores, integrators, region, frames, recorder=None, reset=False):
+        """Queue the (channels, height, width) frames of region (ylow, xlow)
+        for registration against the first channel's reference, which is
+        started over from this frame if reset. Returns False if dropped."""
+        if self.jobs.full():
+            self.dropped += 1
+            return False
+        buffer = self.pool.acquire(frames.shape, frames.dtype)
+        buffer.array[...] = frames
+        self.jobs.put((stores, integrators, region, buffer, recorder, reset))
+        return True
+
+    def drain(self):
+        """Wait until every queued frame has been published."""
+        self.jobs.join()
+
+    def register(self, frame, reset=False):
+        """Shift (dy, dx) of frame against the reference, (0, 0) for the first frame after a reset."""
+        shape = reduced_shape(frame.shape, self.level)
+        if reset or self.reference is None or self.reference.shape != shape:
+            self.reference = None
+            return 0.0, 0.0
+        with self.pool.acquire(shape, float32) as reduced:
+            dy, dx, peak = phase_correlate(self.reference, reduce_frame(frame, self.level, reduced), pool=self.pool)
+        if peak < self.MIN_PEAK:
+            return 0.0, 0.0
+        f = 2**self.level
+        return dy*f, dx*f
+
+    def set_reference(self, frame):
+        """Make frame, reduced, the reference for the next frame, in the
+        reference's array if it has the right shape."""
+        shape = reduced_shape(frame.shape, self.level)
+        if self.reference is None or self.reference.shape != shape:
+            self.reference = empty(shape, dtype=float32)
+        reduce_frame(frame, self.level, self.reference)
+
+    def run(self):
+        while True:
+            stores, integrators, (ylow, xlow), buffer, recorder, reset = self.jobs.get()
+            starttime = time.time()
+            frames = buffer.array
+            dy, dx = self.register(frames[0], reset)
+            rows = arange(ylow, ylow + frames.shape[1])
+            with self.pool.acquire(frames.shape[1:], float32) as moved:
+                for c, store in enumerate(stores):
+                    # the shifted frame goes back into the buffer it came in
+                    rint(shift_frame(frames[c], dy, dx, moved, self.pool), out=frames[c], casting='unsafe')
+                    if integrators is not None:
+                        out = integrators[c].integrate(rows, frames[c], xlow)
+                    else:
+                        out = frames[c]
+                    store.publish_lines(ylow, out, xlow)
+                    if c == 0:
+                        # the integrated image is the reference for the next frame
+                        self.set_reference(out)
+            buffer.release()
+            self.shift = (dy, dx)
+            self.cost = time.time() - starttime
+            self.frames += 1
+            if self.verbose:
+                print("registration shift: (%.2f, %.2f) pixels in %.1f ms" % (dy, dx, 1000*self.cost))
+            if recorder is not None:
+                recorder.submit_frame(stores[0].frame, stores[0].frames)
+            for store in stores:
+                store.end_frame()
+            self.jobs.task_done()
@@ -0,0 +1,203 @@
+# Incremental display renderer for the SEM image
+# Written for the Amray SEM control program
+
+"""
+Converts the lines published to a FrameStore into an 8-bit display buffer.
+Only the rows that changed since the last render are converted, through a
+precomputed lookup table, into a persistent single-channel buffer that the
+viewer's image is pointed at. The renderer also keeps track of how fast
+lines are arriving so the viewer can repaint often while the scan is fast
+and back off when nothing is changing.
+
+Frames larger than the screen (record frames of 2048x2048 and up) are shown
+at a stride: only every step-th row and column is read from the store, so a
+memory-mapped frame is never read in full just to be displayed.
+
+With fill_unscanned set (used by the progressive scan pattern) rows that
+have not been scanned yet in the current frame are shown as a copy of the
+nearest row that has, so the display always shows an approximation of the
+whole field that sharpens as the frame fills in.
+
+Every converted row is also counted into a LineHistogram of the display.
+With auto set the renderer rebuilds its table from that histogram's
+percentiles whenever the clip limits move by more than AUTO_TOLERANCE raw
+values, and converts the whole display again with the new table.
+
+OverlayRenderer shows several detector channels at once as a colour image:
+each channel is rendered by its own FrameRenderer and only the rows that
+changed in any of them are mixed into the (rows, cols, 3) display, every
+channel in its own colour.
+"""
+
+import time
+
+from histogram import LineHistogram, percentile_lut
+
+from numpy import (arange, zeros, uint8, uint16, clip, nonzero, searchsorted, minimum, maximum,
+                   where, array, union1d)
+
+# Colour of each channel in the overlay view: green, magenta, blue, orange.
+# The first two add up to grey where the channels agree
+OVERLAY_COLOURS = ((0, 255, 0), (255, 0, 255), (0, 128, 255), (255, 128, 0))
+
+
+def raw_lut():
+    """The fixed 12-bit to 8-bit mapping, (raw+2048)/16, as a 4096-entry table."""
+    return (arange(4096) // 16).astype(uint8)
+
+
+class FrameRenderer:
+
+    MIN_INTERVAL = 40       # ms, fastest repaint
+    MAX_INTERVAL = 1000     # ms, slowest repaint
+    TARGET_ROWS = 16        # rows we would like to have changed per repaint
+    FILL_MIN_ROWS = 16      # rows of a new frame needed before unscanned rows are filled in
+    AUTO_TOLERANCE = 16     # raw values the auto contrast limits have to move before the table is rebuilt
+
+    def __init__(self, store, lut=None, max_size=None):
+        self.store = store
+        self.lut = raw_lut() if lut is None else lut
+        self.step = 1
+        if max_size:
+            self.step = max(1, -(-max(store.rows, store.cols)//max_size))
+        self.display = zeros((-(-store.rows//self.step), -(-store.cols//self.step)), dtype=uint8)
+        self.histogram = LineHistogram(*self.display.shape)
+        self.auto = None        # (low, high) percentiles for automatic contrast, None to keep lut
+        self.limits = None      # raw values mapped to 0 and 255 by lut, None for the fixed table
+        self.last_seq = 0
+        self.fill_unscanned = False
+        self.interval = self.MAX_INTERVAL
+        self.row_rate = 0.0     # rows/second arriving from the scanner
+        self.render_time = 0.0  # seconds spent in the last update
+        self._last_time = time.time()
+
+    def update(self):
+        """Convert the rows published since the last update into the display
+        buffer. Returns the indices of the display rows that were converted."""
+        starttime = time.time()
+        seq = self.store.seq & ~1    # rows still being written are picked up next time
+        rows = self.store.changed_rows(self.last_seq)
+        if self.step > 1:
+            rows = rows[rows % self.step == 0]
+        if len(rows):
+            # raw values run from -2048 to 2047, the table is indexed from 0
+            frame = self.store.frame
+            if self.step > 1:
+                rows = rows//self.step
+                bins = clip(frame[rows*self.step, ::self.step], -2048, 2047) + 2048
+            else:
+                bins = clip(frame[rows], -2048, 2047) + 2048
+            self.histogram.update(rows, bins)
+            self.display[rows] = self.lut[bins]
+        self.last_seq = seq
+        if self.auto is not None and len(rows):
+            self._auto_lut()
+        if self.fill_unscanned and len(rows):
+            if self._fill():
+                rows = arange(self.display.shape[0])
+
+        endtime = time.time()
+        elapsed = endtime - self._last_time
+        self._last_time = endtime
+        if elapsed > 0:
+            self.row_rate = len(rows)/elapsed
+        self.render_time = endtime - starttime
+        self._adapt_interval(len(rows))
+        return rows
+
+    def _fill(self):
+        """Copy the nearest scanned row of this frame into every display row
+        not scanned yet. Returns True if any row was filled."""
+        scanned = self.store.scanned_this_frame()[::self.step]
+        have = nonzero(scanned)[0]
+        if len(have) < min(self.FILL_MIN_ROWS, len(scanned)) or len(have) == len(scanned):
+            # keep showing the last frame until the new one has a few rows
+            return False
+        missing = nonzero(~scanned)[0]
+        # nearest scanned row, looking both up and down
+        above = have[maximum(searchsorted(have, missing) - 1, 0)]
+        below = have[minimum(searchsorted(have, missing), len(have) - 1)]
+        nearest = where(abs(missing - above) <= abs(below - missing), above, below)
+        self.display[missing] = self.display[nearest]
+        return True
+
+    def invalidate(self):
+        """Force every row to be converted again, e.g. after the LUT changes."""
+        self.last_seq = -1
+
+    def set_lut(self, lut, limits=None):
+        """Use lut from the next update on, for every row."""
+        self.lut = lut
+        self.limits = limits
+        self.invalidate()
+
+    def _auto_lut(self):
+        lut, limits = percentile_lut(self.histogram, *self.auto)
+        if self.limits is None or max(abs(limits[0] - self.limits[0]),
+                                      abs(limits[1] - self.limits[1])) > self.AUTO_TOLERANCE:
+            self.set_lut(lut, limits)
+
+    def _adapt_interval(self, nrows):
+        if nrows == 0:
+            self.interval = min(self.interval*2, self.MAX_INTERVAL)
+        else:
+            wanted = 1000*self.TARGET_ROWS/self.row_rate
+            self.interval = int(min(max(wanted, self.MIN_INTERVAL), self.MAX_INTERVAL))
+
+    def paint(self, im, ax, canvas, data=None):
+        """Push the display buffer (or data, e.g. a pyramid level made from it)
+        to a matplotlib image and blit just its axes."""
+        im.set_data(self.display if data is None else data)
+        ax.draw_artist(im)
+        canvas.blit(ax.bbox)
+
+
+class OverlayRenderer:
+
+    def __init__(self, stores, lut=None, max_size=None, colours=OVERLAY_COLOURS):
+        self.renderers = [FrameRenderer(store, lut, max_size) for store in stores]
+        self.store = stores[0]
+        self.step = self.renderers[0].step
+        self.colours = array(colours[:len(stores)], dtype=uint16)
+        self.display = zeros(self.renderers[0].display.shape + (3,), dtype=uint8)
+        self.fill_unscanned = False
+        self.auto = None
+        self.interval = FrameRenderer.MAX_INTERVAL
+        self.render_time = 0.0
+
+    @property
+    def histogram(self):
+        """The first channel's histogram, for the readout."""
+        return self.renderers[0].histogram
+
+    @property
+    def limits(self):
+        return self.renderers[0].limits
+
+    def update(self):
+        """Update every channel and mix the rows that changed in any of them
+        into the colour display. Returns the indices of those rows."""
+        starttime = time.time()
+        rows = arange(0)
+        for renderer in self.renderers:
+            renderer.fill_unscanned = self.fill_unscanned
+            renderer.auto = self.auto
+            rows = union1d(rows, renderer.update())
+        if len(rows):
+            mixed = zeros((len(rows), self.display.shape[1], 3), dtype=uint16)
+            for renderer, colour in zip(self.renderers, self.colours):
+                mixed += renderer.display[rows, :, None]*colour // 255
+            self.display[rows] = minimum(mixed, 255)
+        self.interval = min(renderer.interval for renderer in self.renderers)
+        self.render_time = time.time() - starttime
+        return rows
+
+    def invalidate(self):
+        for renderer in self.renderers:
+            renderer.invalidate()
+
+    def set_lut(self, lut, limits=None):
+        for renderer in self.renderers:
+            renderer.set_lut(lut, limits)
+
+    paint = FrameRenderer.paint
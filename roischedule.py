@@ -0,0 +1,64 @@
+# Interleaved scanning of several partial fields for the SEM scan generator
+# Written for the Amray SEM control program
+
+"""
+Watching several features at once: every partial field (ROI) is scanned as
+a ScanProgram of its own, with its own size and dwell, and the full field is
+scanned slowly in the background between their lines to keep the rest of
+the image current. They all publish into the same FrameStore, so ROI lines
+land in place in the full-field image and the display only redraws the rows
+that changed.
+
+RoiScheduler decides which program the next block of lines comes from. The
+beam time is shared by stride scheduling: every program has a weight (the
+ROI's priority, or the background's share) and a pass value that grows by
+the samples scanned divided by the weight, and the program with the lowest
+pass value goes next. Over any stretch of time each program gets beam time
+in proportion to its weight, the lines of the programs interleave finely,
+and of two ROIs of the same priority the smaller or shorter dwell one
+refreshes more often.
+"""
+
+import time
+
+
+class RoiScheduler:
+
+    def __init__(self, programs, weights):
+        self.programs = programs
+        self.weights = [max(w, 1e-6) for w in weights]
+        self.restart()
+
+    def restart(self):
+        """Start every program over from its first line."""
+        n = len(self.programs)
+        self.passes = [0.0]*n      # samples scanned over weight
+        self.lines = [0]*n         # next scan line of every program
+        self.refreshes = [0]*n     # completed scans of every program
+        self.started = [time.time()]*n
+        self.periods = [0.0]*n     # seconds the last complete scan took
+
+    def next(self):
+        """(program index, scan line) to scan next."""
+        passes = self.passes
+        i = min(range(len(passes)), key=passes.__getitem__)
+        return i, self.lines[i]
+
+    def advance(self, i, kend):
+        """Program i has been scanned up to scan line kend. Returns True if
+        that completed a scan of it."""
+        program = self.programs[i]
+        self.passes[i] += (kend - self.lines[i])*program.line_length/self.weights[i]
+        if kend < len(program):
+            self.lines[i] = kend
+            return False
+        now = time.time()
+        self.lines[i] = 0
+        self.refreshes[i] += 1
+        self.periods[i] = now - self.started[i]
+        self.started[i] = now
+        return True
+
+    def rates(self):
+        """Complete scans per second of every program, from the last one."""
+        return [1.0/p if p > 0 else 0.0 for p in self.periods]
@@ -0,0 +1,869 @@
+# Scan engine for the Amray SEM, without the GUI
+# Written for the Amray SEM control program
+
+"""
+The scan engine without any GUI: the DAQPAD configuration and scan settings,
+the ScanGenerator thread that drives the beam and fills the frame stores,
+and Scanner, which wraps it for scripts and batch acquisition. sem_v1.py
+builds its viewer on the same ScanGenerator.
+
+Nothing here imports Tk, matplotlib or PIL, and the DAQ driver itself is
+only loaded when the first ScanGenerator is made (use_driver picks the real
+pyNIDAQ or the simulation in pyNIDAQ_testing), so a script starts as fast as
+numpy imports.
+
+Command line:
+    python scanner.py PRESET FRAMES OUTPUT [--simulate] [--pattern=P] [--integrate=MODE]
+                      [--mosaic=TILE] [--overlap=PIXELS] [--verbose]
+
+acquires FRAMES frames at PRESET (run1..run4 or rec1..rec6, see RUN_SCANS
+and REC_SCANS) and writes them to OUTPUT: a TIFF if OUTPUT ends in .tif
+(a multi-page one for more than one frame, which needs PIL), otherwise a
+recording OUTPUT.raw/OUTPUT.idx as written by FrameRecorder. With --mosaic
+the preset's field is scanned as TILE pixel tiles stitched into one frame
+(see mosaic.py), written as a TIFF or as the raw int16 mosaic, and FRAMES
+has to be 1. The time taken to import, to start the scanner and to acquire
+is printed at the end; --verbose also prints the timing of every frame.
+Frames of Rec presets too large for RAM are scanned into scratch files in a
+temporary directory, which is removed when the scanner is closed.
+"""
+
+import time
+_import_start = time.perf_counter()
+
+import sys
+import os
+import shutil
+import tempfile
+import threading
+import queue
+
+from numpy import int16, memmap
+
+from framestore import FrameStore, DiskFrameStore, write_tiff
+from scanpattern import compile_scan
+from sparse import compile_sparse, Reconstructor
+from integrate import Integrator
+from register import DriftRegistrar
+from phase import LinePhase
+from recorder import FrameRecorder, export_tiff, iter_frames
+from bufferpool import POOL
+from instrument import ScanStats
+from roischedule import RoiScheduler
+from mosaic import MosaicStitcher, tile_grid
+
+_import_time = time.perf_counter() - _import_start
+
+# The DAQ driver module, loaded by use_driver
+pyNIDAQ = None
+
+def use_driver(simulated=False):
+    """Load the DAQPAD driver, or the simulated one in pyNIDAQ_testing."""
+    global pyNIDAQ
+    if simulated:
+        import pyNIDAQ_testing as driver
+    else:
+        import pyNIDAQ as driver
+    pyNIDAQ = driver
+    return driver
+
+"""************************ Global Variables ***********"""
+
+# DAQPAD-1200 configuration
+XChannel = 0    # Analog out channel of DAQ
+YChannel = 1    # Analog out channel of DAQ
+SigChannel = 0    # Signal intensity IN channel of DAQ 
+SigChannels = (SigChannel,)   # Detector channels sampled at every pixel, e.g. (0, 1) for SE and BSE.
+                              # They are read multiplexed and share the DAQPAD's MaxSampleRate
+MaxSampleRate = 100000  # AI conversions per second the DAQPAD takes, over all channels
+
+# Buffered scan settings
+SCAN_MODE = 'buffered'  # 'buffered' uses the DAQPAD waveform generator, 'point' writes/reads one pixel at a time
+BufferLines = 1         # Lines per buffer in buffered mode, set to the resolution for frame sized buffers
+
+# Scan pattern settings, see scanpattern.py
+ScanPattern = 'raster'  # 'raster', 'serpentine', 'interlaced', 'progressive' or 'sparse'
+FlybackSamples = 0      # Samples per line spent returning X to the start of the next line
+SettleSamples = 0       # Samples per line discarded while the beam settles at the start of a line
+PhaseCorrection = 1     # Estimate and remove the forward/reverse line shift of serpentine scans
+
+# Sparse preview settings, see sparse.py. ScanPattern = 'sparse' samples only
+# SparseFraction of every line and reconstructs the rest in the background
+SparseFraction = 0.25   # Fraction of the pixels sampled
+SparseMask = 'lattice'  # 'lattice' (low-discrepancy) or 'random'
+
+# Several partial fields at once, see roischedule.py. set_rois takes
+# (xlow, ylow, size, dwell, priority) for every ROI, and the full field is
+# scanned at the preset's dwell between their lines
+RoiBackgroundShare = 0.1   # Fraction of the beam time spent on the full field
+
+# Mosaics, see mosaic.py. Scanner.mosaic scans the field as overlapping
+# partial field tiles and stitches them into a disk-backed frame
+MosaicOverlap = 64      # Pixels neighbouring tiles overlap by at least
+MosaicMaxShift = 16     # Pixels of drift between neighbouring tiles that registration accepts
+
+# Integration of repeated scans, see integrate.py. The frame store holds the
+# integrated image, so the display and the saver both show it
+IntegrationMode = 'none'   # 'none', 'frames', 'running', 'recursive' or 'lines'
+IntegrationCount = 4       # N frames (or lines) averaged
+
+# Drift registration, see register.py. Every completed frame is shifted onto
+# the integrated image before it is integrated, shown and recorded
+RegisterDrift = 0       # 1 to register frames
+RegisterLevel = 1       # Pyramid level the shift is measured on, 0 for full resolution
+
+# Dwell time. RunDwellTime/RecDwellTime are in units of DwellUnit; every pixel
+# is sampled dwell_samples(dwell, rate) times at the scan rate of the channels
+# being scanned and the samples reduced to one value by DwellReduce
+DwellUnit = 10e-6       # seconds
+DwellReduce = 'mean'    # 'mean' or 'median'
+
+def scan_rate(nchans):
+    """Samples per second of every channel when nchans channels share
+    MaxSampleRate: one sample is one DwellUnit with one channel, two with two."""
+    return MaxSampleRate//max(nchans, 1)
+
+def dwell_samples(dwell, rate):
+    """Samples per pixel for a dwell time of dwell DwellUnits at rate, at least one."""
+    return max(1, int(dwell*DwellUnit*rate + 0.5))
+
+def check_dwell(dwell, rate):
+    """Warn when a dwell of dwell DwellUnits is shorter than one sample at
+    rate, the shortest dwell there is; such dwells are scanned at one sample."""
+    if dwell*DwellUnit*rate < 1:
+        print("dwell %.0f us is shorter than one sample at %d samples/s, scanning at %.0f us"
+              % (1e6*dwell*DwellUnit, rate, 1e6/rate))
+
+# Timing of every scan line, frame and display update, see instrument.py.
+# Costs next to nothing while off
+Instrument = 0
+Verbose = 1             # Print the timing and dwell of every frame and reconfiguration
+
+# Scan presets: button number: (pixels across, dwell in DwellUnits)
+RUN_SCANS = {1: (128, 1), 2: (256, 5), 3: (512, 5), 4: (1024, 5)}
+REC_SCANS = {1: (1024, 10), 2: (1024, 20), 3: (2048, 10), 4: (2048, 20), 5: (4096, 10), 6: (8192, 10)}
+
+# Frames with more pixels than this are kept in a memory-mapped file instead of RAM
+RAM_FRAME_LIMIT = 1024*1024
+
+
+class ScanGenerator(threading.Thread):
+    """Long-lived acquisition worker. It is started once and never torn down;
+    the viewer or a Scanner posts commands (set_resolution, set_roi,
+    set_rois, set_pattern, set_integration, set_registration, set_instrumentation,
+    continuous, single_frame, pause, stop)
+    which are applied at the next line boundary. Each command
+    returns a threading.Event that is set once the command has been applied.
+    """
+
+    def __init__(self, stores, xres, yres):
+        if pyNIDAQ is None:
+            use_driver()
+        threading.Thread.__init__(self, name='ScanGenerator')
+        self.daemon = True
+        self.commands = queue.Queue()
+        self.stores = stores     # one FrameStore per channel in SigChannels
+        self.store = stores[0]
+        self.retired = []        # stores replaced by set_resolution, released by release_retired
+        self.retire_lock = threading.Lock()
+        self.xres = xres
+        self.yres = yres
+        self.roi = None          # (xlow, ylow, size) of the partial field, None for the full field
+        self.rois = None         # (xlow, ylow, size, dwell, priority) of every ROI, None when not interleaving ROIs
+        self.scheduler = None    # RoiScheduler of the ROIs and the background, while there are ROIs
+        self.sources = None      # (program, wave, readings, pixels, XForward, XReverse, phase) per scheduled program
+        self.dwell_time = 1      # DwellUnits per pixel
+        self.dwell = 1           # samples per pixel at self.rate, set by configure
+        self.rate = scan_rate(len(stores))   # samples per second of every channel
+        self.pattern = ScanPattern
+        self.mode = 'paused'     # 'continuous', 'single', 'paused' or 'stopped'
+        self.latency = 0.0       # seconds between the last command being posted and applied
+        self.phases = {}         # LinePhase per (xres, field width), kept across reconfigurations
+        self.reconstructor = None   # background inpainting of sparse frames, started when first needed
+        self.register = RegisterDrift
+        self.registrar = None       # background drift registration, started when first needed
+        self.raw = None             # unintegrated frames handed to the registrar, one per channel
+        self.new_reference = True   # the registrar starts a new reference from the next frame
+        self.integration = (IntegrationMode, IntegrationCount)
+        self.integrators = None     # average repeated scans before they are published, one per channel
+        self.repeat = 0             # scans of the current line so far, in 'lines' integration
+        self.buffers = {}           # pooled line and frame buffers by name
+        self.pixels_scanned = 0     # pixels read since the program started, for benchmarks
+        self.stats = ScanStats() if Instrument else None   # line, frame and render timings, None while off
+        self.driver_end = 0.0       # when the driver calls of the current block finished, while instrumented
+        self.recorder = None        # FrameRecorder completed frames (or lines) are streamed to, None when not recording
+        self.configure()
+        self.integrate()
+
+    # Caller side ------------------------------------------------------------
+    def post(self, command, *args):
+        done = threading.Event()
+        self.commands.put((command, args, done, time.time()))
+        return done
+
+    def set_resolution(self, stores, xres, yres, dwell=1):
+        """Scan into new FrameStores (one per channel in SigChannels) of xres
+        by yres pixels with a dwell time of dwell DwellUnits per pixel, from
+        the top of the field."""
+        return self.post('resolution', stores, xres, yres, dwell)
+
+    def release_retired(self):
+        """Release the stores replaced by set_resolution so far. Their
+        readers (the viewer's renderer and post-processing, a Scanner) call
+        this once they have switched to the new stores; the scan thread
+        cannot tell when that is."""
+        with self.retire_lock:
+            retired, self.retired = self.retired, []
+        for store in retired:
+            store.release()
+
+    def set_roi(self, roi):
+        """Scan only the partial field roi = (xlow, ylow, size), or the full field if roi is None."""
+        return self.post('roi', roi)
+
+    def set_rois(self, rois):
+        """Interleave the lines of several partial fields, rois = [(xlow,
+        ylow, size, dwell, priority), ...] with dwell in DwellUnits, with a
+        slow refresh of the full field. None (or no ROIs) scans the full
+        field again. Integration and drift registration are off meanwhile."""
+        return self.post('rois', tuple(rois) if rois else None)
+
+    def set_pattern(self, pattern):
+        """Switch to another scan pattern (see scanpattern.PATTERNS), from the top of the field."""
+        return self.post('pattern', pattern)
+
+    def set_integration(self, mode, count):
+        """Average repeated scans (see integrate.MODES), starting over from the next scan."""
+        return self.post('integration', mode, count)
+
+    def set_registration(self, on):
+        """Register every frame for drift before it is integrated (on = 1) or not (0)."""
+        return self.post('registration', on)
+
+    def set_instrumentation(self, on):
+        """Start recording timings into a fresh ScanStats (on = 1) or stop (0)."""
+        return self.post('instrument', on)
+
+    def query_stats(self):
+        """Summary of the recorded timings (see ScanStats.snapshot) with the
+        depth of every queue between the threads and the buffer pool's
+        statistics, or None while off."""
+        stats = self.stats
+        if stats is None:
+            return None
+        snapshot = stats.snapshot()
+        recorder = self.recorder
+        snapshot['queues'] = {
+            'commands': self.commands.qsize(),
+            'reconstructor': self.reconstructor.jobs.qsize() if self.reconstructor is not None else 0,
+            'registrar': self.registrar.jobs.qsize() if self.registrar is not None else 0,
+            'recorder': recorder.queue_depth() if recorder is not None else 0,
+        }
+        scheduler = self.scheduler
+        if scheduler is not None:
+            snapshot['roi_refresh_hz'] = scheduler.rates()
+        snapshot['pool'] = POOL.stats()
+        return snapshot
+
+    def continuous(self):
+        return self.post('continuous')
+
+    def single_frame(self):
+        """Scan one frame from the top of the field, then pause."""
+        return self.post('single')
+
+    def pause(self):
+        return self.post('pause')
+
+    def stop(self):
+        return self.post('stop')
+
+    # Worker side ----------------------------------------------------------------
+    def pooled(self, name, shape, dtype=int16):
+        """Zeroed buffer name of shape from the pool, keeping the one it
+        already has if that is the right shape."""
+        buffer = self.buffers.get(name)
+        if buffer is not None:
+            if buffer.array.shape == shape and buffer.array.dtype == dtype:
+                return buffer.array
+            buffer.release()
+        buffer = self.buffers[name] = POOL.acquire(shape, dtype, zero=True)
+        return buffer.array
+
+    def configure(self):
+        """Look up the compiled scan for the current resolution and field and
+        size the buffers for it."""
+        if self.reconstructor is not None:
+            # the reconstructor may still be publishing the last sparse frame
+            self.reconstructor.drain()
+        if self.registrar is not None:
+            self.registrar.drain()
+        # the channels share the DAQPAD's sample rate, so the samples per
+        # pixel depend on how many of them there are
+        nchans = len(self.stores)
+        self.channels = tuple(SigChannels[:nchans])
+        self.rate = scan_rate(nchans)
+        self.dwell = dwell_samples(self.dwell_time, self.rate)
+        if self.rois:
+            # the full field is the background the ROIs are interleaved with
+            self.program = compile_scan(self.xres, self.yres, None, self.roi_pattern(), self.dwell, FlybackSamples, SettleSamples)
+            self.XForward = self.program.x_forward.tolist()
+            self.XReverse = self.program.x_reverse.tolist()
+        elif self.pattern == 'sparse':
+            self.program = compile_sparse(self.xres, self.yres, self.roi, SparseFraction, SparseMask, self.dwell, FlybackSamples, SettleSamples)
+            self.samples = self.pooled('samples', (len(self.stores), self.program.height, self.program.samples))
+            if self.reconstructor is None:
+                self.reconstructor = Reconstructor(verbose=Verbose)
+        else:
+            self.program = compile_scan(self.xres, self.yres, self.roi, self.pattern, self.dwell, FlybackSamples, SettleSamples)
+            self.XForward = self.program.x_forward.tolist()
+            self.XReverse = self.program.x_reverse.tolist()
+        self.Xlow = self.program.xlow
+        self.Ylow = self.program.ylow
+        self.Xhigh = self.Xlow + self.program.width
+        self.Yhigh = self.Ylow + self.program.height
+
+        # SCAN_MODE selects between the point by point scan and the buffered
+        # scan, which uses the DAQPAD waveform generator and buffers
+        lines = BufferLines if SCAN_MODE == 'buffered' else 1
+        self.wave = self.pooled('wave', (lines, self.program.line_length, 2))
+        # multiplexed: one sample of every channel per sample point
+        self.readings = self.pooled('readings', (lines, self.program.line_length, nchans))
+        self.pixels = self.pooled('pixels', (nchans, lines, self.program.width))   # private line buffers, published when complete
+        self.phase = self.phases.setdefault((self.xres, self.program.width), LinePhase())
+
+        # While registering, frames are collected here instead of being
+        # published, and the registrar publishes them once they are shifted
+        self.registering = (self.register and self.pattern != 'sparse' and not self.rois
+                            and not isinstance(self.store, DiskFrameStore))
+        if self.registering:
+            self.raw = self.pooled('raw', (nchans, self.yres, self.xres))
+            if self.registrar is None:
+                self.registrar = DriftRegistrar(RegisterLevel, verbose=Verbose)
+        self.new_reference = True
+        if self.stats is not None:
+            self.stats.requested_dwell = self.dwell/self.rate
+        self.k = 0   # next scan line
+        self.repeat = 0
+        self.noise = 0.0   # sum of the per-line dwell sample variances this frame
+        self.noise_lines = 0
+        self.configure_rois(lines, nchans)
+
+    def roi_pattern(self):
+        """Pattern the ROIs and their background are scanned in; sparse
+        frames are reconstructed whole, so they are scanned as raster."""
+        return self.pattern if self.pattern != 'sparse' else 'raster'
+
+    def configure_rois(self, lines, nchans):
+        """Compile a program with line buffers of its own for every ROI, and
+        the scheduler that interleaves them with the background, the program
+        configure has just set up."""
+        for name in [name for name in self.buffers if '/' in name]:
+            self.buffers.pop(name).release()
+        if not self.rois:
+            self.scheduler = None
+            self.sources = None
+            return
+        sources = []
+        weights = []
+        for i, (xlow, ylow, size, dwell, priority) in enumerate(self.rois):
+            program = compile_scan(self.xres, self.yres, (xlow, ylow, size), self.roi_pattern(),
+                                   dwell_samples(dwell, self.rate), FlybackSamples, SettleSamples)
+            sources.append((program,
+                            self.pooled('wave/%d' % i, (lines, program.line_length, 2)),
+                            self.pooled('readings/%d' % i, (lines, program.line_length, nchans)),
+                            self.pooled('pixels/%d' % i, (nchans, lines, program.width)),
+                            program.x_forward.tolist(), program.x_reverse.tolist(),
+                            self.phases.setdefault((self.xres, program.width), LinePhase())))
+            weights.append(priority)
+        sources.append((self.program, self.wave, self.readings, self.pixels,
+                        self.XForward, self.XReverse, self.phase))
+        weights.append(RoiBackgroundShare/(1 - RoiBackgroundShare)*sum(weights))
+        self.sources = sources
+        self.scheduler = RoiScheduler([source[0] for source in sources], weights)
+
+    def select(self, i):
+        """Scan the lines of scheduled program i from here on."""
+        (self.program, self.wave, self.readings, self.pixels,
+         self.XForward, self.XReverse, self.phase) = self.sources[i]
+        self.Xlow = self.program.xlow
+        self.Ylow = self.program.ylow
+        self.Xhigh = self.Xlow + self.program.width
+        self.Yhigh = self.Ylow + self.program.height
+
+    def integrate(self):
+        """Set up fresh accumulators for the integration mode and count.
+        Memory-mapped record frames are never integrated."""
+        mode, count = self.integration
+        if self.integrators is not None:
+            if self.registrar is not None:
+                # the registrar may still be integrating the last frame
+                self.registrar.drain()
+            for integrator in self.integrators:
+                integrator.release()
+        if mode == 'none' or isinstance(self.store, DiskFrameStore) or self.rois:
+            self.integrators = None
+        else:
+            self.integrators = [Integrator(store.rows, store.cols, mode, count, POOL) for store in self.stores]
+        self.new_reference = True
+
+    def apply_commands(self):
+        """Apply every queued command. Waits for one if the scan is paused."""
+        block = (self.mode == 'paused')
+        while True:
+            try:
+                command, args, done, posted = self.commands.get(block=block)
+            except queue.Empty:
+                return
+            block = False
+            if command == 'resolution':
+                old = self.stores
+                self.stores, self.xres, self.yres, self.dwell_time = args
+                self.store = self.stores[0]
+                self.roi = None
+                self.rois = None
+                self.configure()
+                check_dwell(self.dwell_time, self.rate)
+                # the background threads are done publishing to the old
+                # stores, their readers release them with release_retired
+                with self.retire_lock:
+                    self.retired.extend(store for store in old if store not in self.stores)
+                self.integrate()
+            elif command == 'roi':
+                self.roi = args[0]
+                if self.rois:
+                    self.rois = None
+                    self.configure()
+                    self.integrate()
+                else:
+                    self.configure()
+            elif command == 'rois':
+                self.rois = args[0]
+                self.roi = None
+                self.configure()
+                for roi in self.rois or ():
+                    check_dwell(roi[3], self.rate)
+                self.integrate()
+            elif command == 'pattern':
+                self.pattern = args[0]
+                self.configure()
+            elif command == 'registration':
+                self.register = args[0]
+                self.configure()
+            elif command == 'instrument':
+                self.stats = ScanStats() if args[0] else None
+                if self.stats is not None:
+                    self.stats.requested_dwell = self.dwell/self.rate
+            elif command == 'integration':
+                self.integration = args
+                self.integrate()
+                self.repeat = 0
+            elif command == 'continuous':
+                self.mode = 'continuous'
+            elif command == 'single':
+                self.mode = 'single'
+                self.k = 0
+                if self.scheduler is not None:
+                    self.scheduler.restart()
+            elif command == 'pause':
+                self.mode = 'paused'
+            elif command == 'stop':
+                self.mode = 'stopped'
+            self.latency = time.time() - posted
+            if Verbose and command in ('resolution', 'roi', 'rois', 'pattern', 'registration'):
+                print("scan reconfigured in %.1f ms" % (1000*self.latency))
+            done.set()
+            if self.mode == 'stopped':
+                return
+
+    def run(self):
+        while True:
+            self.apply_commands()
+            if self.mode == 'stopped':
+                break
+            if self.mode == 'paused':
+                continue
+            if self.scheduler is not None:
+                try:
+                    self.scan_rois()
+                except RuntimeError as error:
+                    # the scheduler only advances once the lines are in
+                    print("scan error, retrying: ", error)
+                continue
+            if self.k == 0:
+                self.starttime = time.time()
+            stats = self.stats
+            if stats is not None:
+                linestart = time.perf_counter()
+            try:
+                if SCAN_MODE == 'buffered':
+                    kend = self.scan_buffered(self.k)
+                else:
+                    kend = self.scan_points(self.k)
+            except RuntimeError as error:
+                # a driver call failed or timed out: scan the lines again,
+                # after the commands that came in meanwhile (stop among them)
+                print("scan error, retrying: ", error)
+                continue
+            if stats is not None:
+                # driver time per sample times the samples per pixel
+                dwell = (self.driver_end - linestart)*self.program.dwell/(self.program.line_length*(kend - self.k))
+                stats.record_line(linestart, self.driver_end, time.perf_counter(), dwell)
+            self.repeat += 1
+            integrators = self.integrators
+            if integrators is None or integrators[0].mode != 'lines' or self.repeat >= integrators[0].n:
+                # line integration scans the same lines again until it has N of them
+                self.repeat = 0
+                self.k = kend
+            if self.k >= len(self.program):
+                self.end_frame()
+
+        print("scan thread terminating")
+        return # Thread will terminate when it returns
+
+    def scan_rois(self):
+        """Scan a block of lines of whichever ROI, or the background, the
+        scheduler picks. A frame ends whenever the background completes."""
+        scheduler = self.scheduler
+        i, k = scheduler.next()
+        self.select(i)
+        background = (i == len(self.sources) - 1)
+        if background and k == 0:
+            self.starttime = time.time()
+        stats = self.stats
+        if stats is not None:
+            linestart = time.perf_counter()
+        if SCAN_MODE == 'buffered':
+            kend = self.scan_buffered(k)
+        else:
+            kend = self.scan_points(k)
+        if stats is not None:
+            dwell = (self.driver_end - linestart)*self.program.dwell/(self.program.line_length*(kend - k))
+            stats.record_line(linestart, self.driver_end, time.perf_counter(), dwell)
+        if scheduler.advance(i, kend) and background:
+            if Verbose:
+                print("ROI refreshes/second: " + ", ".join("%.1f" % rate for rate in scheduler.rates()[:-1]))
+            self.end_frame()
+
+    def end_frame(self):
+        endtime = time.time()
+        if self.stats is not None:
+            self.stats.record_frame(time.perf_counter())
+        deltatime = endtime - self.starttime
+        #print("idle event")
+        if Verbose:
+            print("frame time: ", deltatime)
+            if SCAN_MODE == 'buffered':
+                print("pixels/second: ", (self.Xhigh-self.Xlow)*(self.Yhigh-self.Ylow)/(endtime-self.starttime))
+        self.report_dwell()
+
+        if self.program.pattern == 'sparse':
+            # The reconstructor publishes, records and ends the frame
+            if Verbose:
+                print("sampled pixels/second: ", self.samples.size/(endtime-self.starttime))
+            self.reconstructor.submit(self.stores, self.program, self.samples, self.recorder)
+            self.k = 0
+            if self.mode == 'single':
+                self.mode = 'paused'
+            return
+
+        frame = self.raw[0] if self.registering else self.store.frame
+        if self.program.pattern == 'serpentine' and PhaseCorrection:
+            shift = self.phase.update(frame, self.program)
+            if Verbose:
+                print("line phase shift: %.2f pixels" % shift)
+
+        if self.registering:
+            # The registrar integrates, publishes, records and ends the frame.
+            # Line integration has already been done here
+            integrators = self.integrators
+            if integrators is not None and integrators[0].mode == 'lines':
+                integrators = None
+            raw = self.raw[:, self.Ylow:self.Yhigh, self.Xlow:self.Xhigh]
+            if self.registrar.submit(self.stores, integrators, (self.Ylow, self.Xlow), raw, self.recorder, self.new_reference):
+                self.new_reference = False
+            elif Verbose:
+                print("registration behind, frame dropped")
+            self.k = 0
+            if self.mode == 'single':
+                self.mode = 'paused'
+            return
+
+        recorder = self.recorder
+        if recorder is not None and not recorder.per_line:
+            recorder.submit_frame(self.store.frame, self.store.frames)
+        for store in self.stores:
+            store.end_frame()
+        self.k = 0
+        if self.mode == 'single':
+            self.mode = 'paused'
+
+    def report_dwell(self):
+        """Print the effective dwell time and, when there is more than one
+        sample per pixel, the frame's signal to noise ratio: the spread of the
+        pixel values over the noise left in a pixel after reducing its samples.
+        Only the noise sums are reset unless Verbose."""
+        dwell = 1e6*self.dwell/self.rate
+        if Verbose:
+            if self.dwell == 1 or self.noise_lines == 0:
+                print("effective dwell: %.1f us" % dwell)
+            else:
+                noise = (self.noise/self.noise_lines/self.dwell)**0.5
+                step = max(1, max(self.Xhigh-self.Xlow, self.Yhigh-self.Ylow)//256)
+                signal = self.store.frame[self.Ylow:self.Yhigh:step, self.Xlow:self.Xhigh:step].std()
+                print("effective dwell: %.1f us (%d samples), SNR: %.1f" % (dwell, self.dwell, signal/max(noise, 1e-9)))
+        self.noise = 0.0
+        self.noise_lines = 0
+
+    def scan_points(self, k):
+        """Scan line k of the program, writing one X code per driver call.
+        Pad samples are read one at a time and the dwell samples of every
+        pixel in one block read. Returns the next scan line."""
+        daq = pyNIDAQ.thread_session(1)
+        program = self.program
+        if program.pattern == 'sparse':
+            XCodes = program.x_line(k).tolist()
+        elif program.reversed[k]:
+            XCodes = self.XReverse
+        else:
+            XCodes = self.XForward
+        samples = self.readings[0]
+        channels = self.channels
+        daq.AO_Write(YChannel, int(program.y_codes[program.order[k]]))
+        dwell = program.dwell
+        block = dwell > 1 or len(channels) > 1
+        i = 0
+        while i < program.line_length: # For every sample along the line
+            
+            # Write out the analog signal
+            daq.AO_Write(XChannel, XCodes[i])
+            
+            if block and program.valid.start <= i < program.valid.stop:
+                # Read the signal in for the dwell time of the pixel, every channel multiplexed
+                if len(channels) > 1:
+                    daq.AI_ScanBlock(channels, 1, samples[i:i+dwell], self.rate)
+                else:
+                    daq.AI_ReadBlock(channels[0], 1, samples[i:i+dwell], self.rate)
+                i += dwell
+            else:
+                samples[i, 0] = daq.AI_Read(channels[0], 1)
+                #samples[i, 0] = daq.AI_Read(channels[0], 10)
+                i += 1
+        self.publish(k, k+1)
+        return k + 1
+
+    def scan_buffered(self, k):
+        """Scan up to BufferLines lines of the program from scan line k in one
+        buffer. The compiled waveform is clocked out by the DAQPAD while the
+        signal channels are read into self.readings, which is then reduced to
+        pixels and published to the stores. Returns the next scan line.
+        """
+        kend = min(k + BufferLines, len(self.program))
+        n = kend - k
+        wave = self.program.fill_wave(k, kend, self.wave)
+        channels = self.channels if len(self.channels) > 1 else self.channels[0]
+        pyNIDAQ.pyScan_Op(1, XChannel, YChannel, channels, 1, wave, self.readings[:n].reshape(-1), self.rate)
+        self.publish(k, kend)
+        return kend
+
+    def publish(self, k, kend):
+        """Demultiplex the samples of scan lines k..kend-1, reduce them to
+        pixels and publish every channel to its store."""
+        if self.stats is not None:
+            self.driver_end = time.perf_counter()
+        program = self.program
+        rows = program.order[k:kend]
+        for c, store in enumerate(self.stores):
+            readings = self.readings[:, :, c]    # strided view of one channel, nothing is copied
+            pixels = program.pixels(readings, k, kend, self.pixels[c], DwellReduce)
+            if c == 0:
+                self.pixels_scanned += pixels.size
+            if c == 0 and program.dwell > 1:
+                self.noise += (kend - k)*program.sample_variance(readings, k, kend)
+                self.noise_lines += kend - k
+            if program.pattern == 'sparse':
+                # kept until the frame is complete, then reconstructed
+                self.samples[c, k:kend] = pixels
+                continue
+            if program.pattern == 'serpentine' and PhaseCorrection:
+                self.phase.correct(pixels, program.reversed[k:kend])
+            if self.integrators is not None and (not self.registering or self.integrators[c].mode == 'lines'):
+                pixels = self.integrators[c].integrate(rows, pixels, self.Xlow)
+            if self.registering:
+                self.raw[c][rows, self.Xlow:self.Xhigh] = pixels
+                continue
+            if program.contiguous:
+                store.publish_lines(rows[0], pixels, self.Xlow)
+            else:
+                for m in range(kend-k):
+                    store.publish_line(rows[m], pixels[m], self.Xlow)
+            recorder = self.recorder
+            if c == 0 and recorder is not None and recorder.per_line:
+                for m in range(kend-k):
+                    recorder.submit_line(pixels[m], store.frames, rows[m], self.Xlow)
+
+
+def new_stores(xres, yres, on_disk=False, directory=''):
+    """A FrameStore of xres by yres pixels for every channel in SigChannels,
+    memory-mapped to SEM_<date>_<time>_rec[_chN].dat in directory if on_disk."""
+    stores = []
+    for c, chan in enumerate(SigChannels):
+        if on_disk:
+            name = time.strftime("SEM_%Y%m%d_%H%M%S_rec") + ("_ch%d" % chan if c else "") + ".dat"
+            stores.append(DiskFrameStore(os.path.join(directory, name), yres, xres))
+        else:
+            stores.append(FrameStore(yres, xres, pool=POOL))
+    return stores
+
+
+class Scanner:
+    """A ScanGenerator for scripts: select a preset, acquire frames, close.
+    The generator itself is in scangen for everything else (set_pattern,
+    set_integration, set_roi, ...)."""
+
+    def __init__(self, simulated=False):
+        use_driver(simulated)
+        xres, dwell = RUN_SCANS[1]
+        self.scratch = None     # temporary directory of the disk-backed frames, removed by close
+        self.scangen = ScanGenerator(new_stores(xres, xres), xres, xres)
+        self.scangen.start()
+
+    @property
+    def stores(self):
+        return self.scangen.stores
+
+    def preset(self, name):
+        """Switch to a Run (run1..run4) or Rec (rec1..rec6) preset. Rec frames
+        larger than RAM_FRAME_LIMIT go to memory-mapped scratch files."""
+        presets = RUN_SCANS if name.startswith('run') else REC_SCANS if name.startswith('rec') else None
+        number = name[3:]
+        if presets is None or not number.isdigit() or int(number) not in presets:
+            raise ValueError('unknown preset %r' % (name,))
+        res, dwell = presets[int(number)]
+        on_disk = res*res > RAM_FRAME_LIMIT
+        if on_disk and self.scratch is None:
+            self.scratch = tempfile.mkdtemp(prefix='scanner_')
+        self.scangen.set_resolution(new_stores(res, res, on_disk, self.scratch), res, res, dwell).wait()
+        self.scangen.release_retired()
+
+    def acquire(self, frames, name, timeout=None):
+        """Scan frames complete frames of the first channel into the recording
+        name.raw/name.idx, one single frame scan after the other so none is
+        dropped. Frames larger than RAM_FRAME_LIMIT are recorded a line at a
+        time. Returns the recorder's statistics."""
+        store = self.scangen.store
+        per_line = store.rows*store.cols > RAM_FRAME_LIMIT
+        recorder = FrameRecorder(name, store.rows, store.cols, per_line=per_line,
+                                 queue_size=64 if per_line else 4, pool=POOL)
+        try:
+            for f in range(frames):
+                self.scan_frame(timeout)
+                # the frame is copied out before the next scan starts
+                for j in range(store.rows) if per_line else (None,):
+                    while not (recorder.submit_line(store.frame[j], f, j) if per_line
+                               else recorder.submit_frame(store.frame, f)):
+                        time.sleep(0.001)
+        finally:
+            stats = recorder.close()
+        return stats
+
+    def scan_frame(self, timeout=None):
+        """Scan one frame of the current field and wait until it is complete."""
+        store = self.scangen.store
+        done = store.frames
+        self.scangen.single_frame()
+        deadline = None if timeout is None else time.time() + timeout
+        while store.frames == done:
+            if deadline is not None and time.time() > deadline:
+                raise RuntimeError('frame not completed within %g s' % timeout)
+            time.sleep(0.005)
+
+    def mosaic(self, path, tile, overlap=MosaicOverlap, timeout=None):
+        """Scan the current preset's field as tile by tile partial fields
+        overlapping by at least overlap pixels, one after the other, and
+        stitch them into the memory-mapped mosaic path. Every tile is handed
+        to a MosaicStitcher as soon as it is scanned, so stitching overlaps
+        the scanning of the next tile. Returns the stitcher's statistics."""
+        scangen = self.scangen
+        store = scangen.store
+        tile = min(tile, store.rows, store.cols)
+        stitcher = MosaicStitcher(path, store.rows, store.cols, MosaicMaxShift, POOL, verbose=Verbose)
+        try:
+            for row, column, ylow, xlow in tile_grid(store.rows, store.cols, tile, overlap):
+                scangen.set_roi((xlow, ylow, tile)).wait()
+                self.scan_frame(timeout)
+                stitcher.submit(store.frame[ylow:ylow+tile, xlow:xlow+tile], row, column, ylow, xlow)
+        finally:
+            scangen.set_roi(None).wait()
+            stats = stitcher.close()
+        return stats
+
+    def close(self):
+        """Stop the scan generator, release its stores and remove the scratch files."""
+        self.scangen.stop().wait()
+        self.scangen.join(5)
+        self.scangen.release_retired()
+        for store in self.stores:
+            store.release()
+        if self.scratch is not None:
+            shutil.rmtree(self.scratch, ignore_errors=True)
+            self.scratch = None
+
+
+def main(argv):
+    global Verbose
+    args = [a for a in argv if not a.startswith('--')]
+    options = dict(a[2:].split('=', 1) if '=' in a else (a[2:], '1') for a in argv if a.startswith('--'))
+    if len(args) != 3 or ('mosaic' in options and args[1] != '1'):
+        print(__doc__)
+        return 2
+    preset, frames, output = args[0], int(args[1]), args[2]
+    Verbose = 1 if 'verbose' in options else 0
+
+    starttime = time.perf_counter()
+    scanner = Scanner(simulated='simulate' in options)
+    if 'pattern' in options:
+        scanner.scangen.set_pattern(options['pattern'])
+    if 'integrate' in options:
+        scanner.scangen.set_integration(options['integrate'], IntegrationCount)
+    scanner.preset(preset)
+    ready = time.perf_counter()
+
+    tiff = output.lower().endswith(('.tif', '.tiff'))
+    name = os.path.splitext(output)[0] if tiff else output
+    if 'mosaic' in options:
+        path = name + '.dat' if tiff else output
+        stats = scanner.mosaic(path, int(options['mosaic']), int(options.get('overlap', MosaicOverlap)))
+        rows, cols = scanner.scangen.store.rows, scanner.scangen.store.cols
+        scanner.close()
+        acquired = time.perf_counter()
+        if tiff:
+            write_tiff(memmap(path, dtype=int16, mode='r', shape=(rows, cols)), output)
+            os.remove(path)
+        print("mosaic of %d tiles, %dx%d, written to %s, %.1f ms stitching per tile"
+              % (stats['tiles'], cols, rows, output, stats['stitch_ms_per_tile']))
+        print("import %.1f ms, scanner ready %.1f ms, acquisition %.2f s, writing %.2f s"
+              % (1000*_import_time, 1000*(ready - starttime), acquired - ready, time.perf_counter() - acquired))
+        return 0
+
+    stats = scanner.acquire(frames, name)
+    rows, cols = scanner.scangen.store.rows, scanner.scangen.store.cols
+    scanner.close()
+    acquired = time.perf_counter()
+    if tiff:
+        if frames == 1:
+            for frame_no, frame in iter_frames(name, rows, cols):
+                write_tiff(frame, output)
+        else:
+            export_tiff(name, rows, cols, output)
+        os.remove(name + '.raw')
+        os.remove(name + '.idx')
+
+    print("%d frames of %dx%d written to %s" % (stats['frames_written'], cols, rows, output))
+    print("import %.1f ms, scanner ready %.1f ms, acquisition %.2f s, writing %.2f s"
+          % (1000*_import_time, 1000*(ready - starttime), acquired - ready, time.perf_counter() - acquired))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,176 @@
+# Scan pattern compiler for the SEM scan generator
+# Written for the Amray SEM control program
+
+"""
+Compiles a (resolution, partial field, pattern, dwell) combination into
+everything the scan generator needs to drive the beam: the order in which the
+frame rows are visited, the X DAC codes of a forward and a reverse line
+(including flyback and settling pad samples), the Y DAC code of every row,
+and the map from each sample back to the frame pixel it belongs to.
+
+Every pattern here is made of whole lines, so the program stores one line of
+X codes per direction rather than the whole frame; fill_wave expands any run
+of lines into a waveform buffer and pixels() reduces the samples read back
+into frame-ordered pixel values. stream() and index_map() give the full
+sample stream and pixel map for the frame when they are wanted in one piece.
+
+compile_scan keeps the last few programs in an LRU cache, so switching
+between presets or moving the partial field back and forth does not
+recompute anything.
+
+Patterns:
+    raster      every line left to right, top to bottom
+    serpentine  every other line right to left, no flyback needed
+    interlaced  even lines, then odd lines (see INTERLACE)
+    progressive lines in bit-reversed order: the first few lines are spread
+                evenly over the whole field and every later pass fills in
+                between them, so the whole field is covered coarsely after
+                a small fraction of the frame
+"""
+
+from functools import lru_cache
+
+from numpy import arange, linspace, rint, int16, int64, zeros, full, concatenate, repeat, median
+
+PATTERNS = ('raster', 'serpentine', 'interlaced', 'progressive')
+INTERLACE = 2     # fields per frame in the interlaced pattern
+
+
+def bit_reversed_order(n):
+    """0..n-1 ordered by the bit-reversal of their index, e.g. 0, 4, 2, 6, 1, 5, 3, 7 for n = 8."""
+    bits = max(1, (n - 1).bit_length())
+    k = arange(n)
+    rev = zeros(n, dtype=int64)
+    for b in range(bits):
+        rev |= ((k >> b) & 1) << (bits - 1 - b)
+    return k[rev.argsort()]
+
+
+def dac_codes(resolution):
+    """DAC codes of resolution equally spaced positions across the full 12-bit range."""
+    return rint(linspace(-2048, 2047, resolution)).astype(int16)
+
+
+class ScanProgram:
+
+    def __init__(self, xres, yres, roi, pattern, dwell, flyback, settle):
+        if pattern not in PATTERNS:
+            raise ValueError('unknown scan pattern %r' % (pattern,))
+        self.xres = xres
+        self.yres = yres
+        self.roi = roi
+        self.pattern = pattern
+        self.dwell = dwell
+        self.flyback = flyback if pattern != 'serpentine' else 0
+        self.settle = settle
+
+        if roi is None:
+            self.xlow, self.ylow = 0, 0
+            self.width, self.height = xres, yres
+        else:
+            self.xlow, self.ylow, size = roi
+            self.width, self.height = size, size
+
+        # Frame rows in the order they are scanned
+        rows = arange(self.ylow, self.ylow + self.height)
+        if pattern == 'interlaced':
+            rows = concatenate([rows[k::INTERLACE] for k in range(INTERLACE)])
+        elif pattern == 'progressive':
+            rows = rows[bit_reversed_order(len(rows))]
+        self.order = rows
+        self.contiguous = pattern in ('raster', 'serpentine')
+
+        # Every line is: settle pad, width*dwell pixel samples, flyback pad
+        xcodes = dac_codes(xres)[self.xlow:self.xlow + self.width]
+        self.valid = slice(self.settle, self.settle + self.width*dwell)
+        self.line_length = self.settle + self.width*dwell + self.flyback
+        self.x_forward = self._line(xcodes)
+        self.x_reverse = self._line(xcodes[::-1])
+        self.y_codes = dac_codes(yres)
+
+        # Scan lines that run right to left
+        self.reversed = zeros(len(self.order), dtype=bool)
+        if pattern == 'serpentine':
+            self.reversed[1::2] = True
+
+        for a in (self.order, self.x_forward, self.x_reverse, self.y_codes, self.reversed):
+            a.flags.writeable = False   # programs are shared through the cache
+
+    def _line(self, xcodes):
+        pixels = repeat(xcodes, self.dwell)
+        settle = full(self.settle, xcodes[0], dtype=int16)
+        # flyback ramps from the end of the line back to its start
+        flyback = rint(linspace(xcodes[-1], xcodes[0], self.flyback)).astype(int16)
+        return concatenate([settle, pixels, flyback]).astype(int16)
+
+    def __len__(self):
+        """Number of scan lines."""
+        return len(self.order)
+
+    def fill_wave(self, k0, k1, wave):
+        """Write the interleaved X/Y codes of scan lines k0..k1-1 into
+        wave[:k1-k0], a (lines, line_length, 2) int16 buffer."""
+        n = k1 - k0
+        rev = self.reversed[k0:k1]
+        wave[:n, :, 0] = self.x_forward
+        if rev.any():
+            wave[:n][rev, :, 0] = self.x_reverse
+        wave[:n, :, 1] = self.y_codes[self.order[k0:k1], None]
+        return wave[:n]
+
+    def pixels(self, readings, k0, k1, out, reduce='mean'):
+        """Reduce the samples read for scan lines k0..k1-1, readings of shape
+        (lines, line_length), to pixel values in frame column order in
+        out[:k1-k0] (lines, width). Pad samples are dropped and the dwell
+        samples of every pixel are reduced to their mean or median."""
+        n = k1 - k0
+        samples = readings[:n, self.valid]
+        if self.dwell > 1:
+            out[:n] = reduce_dwell(samples.reshape(n, self.width, self.dwell), reduce)
+        else:
+            out[:n] = samples
+        rev = self.reversed[k0:k1]
+        if rev.any():
+            out[:n][rev] = out[:n][rev, ::-1]
+        return out[:n]
+
+    def sample_variance(self, readings, k0, k1):
+        """Mean variance of the dwell samples within a pixel over scan lines
+        k0..k1-1, the per-sample noise when the signal is steady during a pixel."""
+        n = k1 - k0
+        return readings[:n, self.valid].reshape(n, -1, self.dwell).var(axis=2).mean()
+
+    def stream(self):
+        """The whole frame's (samples, 2) X/Y code stream."""
+        wave = zeros((len(self), self.line_length, 2), dtype=int16)
+        return self.fill_wave(0, len(self), wave).reshape(-1, 2)
+
+    def index_map(self):
+        """Flat frame index (row*xres + column) of every sample of stream(), -1 for pad samples."""
+        line = full(self.line_length, -1, dtype=int64)
+        line[self.valid] = repeat(arange(self.xlow, self.xlow + self.width), self.dwell)
+        index = zeros((len(self), self.line_length), dtype=int64)
+        index[:] = line
+        rev = self.reversed
+        if rev.any():
+            rline = full(self.line_length, -1, dtype=int64)
+            rline[self.valid] = line[self.valid][::-1]
+            index[rev] = rline
+        valid = index >= 0
+        index += self.order[:, None]*self.xres
+        index[~valid] = -1
+        return index.reshape(-1)
+
+
+def reduce_dwell(samples, reduce='mean'):
+    """Reduce (..., dwell) samples to one value per pixel, by 'mean' or 'median'."""
+    if reduce == 'median':
+        return median(samples, axis=-1)
+    return samples.mean(axis=-1)
+
+
+@lru_cache(maxsize=16)
+def compile_scan(xres, yres, roi=None, pattern='raster', dwell=1, flyback=0, settle=0):
+    """Compiled ScanProgram for the given scan, shared with every other caller
+    asking for the same one. roi is (xlow, ylow, size) or None for the full field."""
+    return ScanProgram(xres, yres, roi, pattern, dwell, flyback, settle)
@@ -6,40 +6,53 @@ This program was written to act as the scan generator, monitor and recorder
 for a scanning electron microscope. It is written in python and depends on TKinter
 for GUI construction, matplotlib for data visualization, and a wrapper for the
 NIDAQ 6.9 driver for communication with the DAQPAD-1200 used as the analog interface.
-"""
-
-import tkinter as Tk
-from tkinter import ttk
-import matplotlib
-matplotlib.use('TkAgg')
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
 
-import PIL
+The scan engine itself is in scanner.py, which has no GUI dependencies;
+this file is the viewer. Tk, matplotlib and PIL are only imported by
+load_gui, when the viewer is started.
+"""
 
 import threading
 
 # for testing
-from numpy import arange, sin, pi, zeros, linspace, rint, int16, uint8, dstack, resize, floor, divide, tile, atleast_3d
-from numpy.random import rand
-
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-import matplotlib.cm as cm
-
-from time import sleep
+from numpy import zeros, linspace, rint, int16, uint8, dstack
 
 #for performance testing
 import time
 
-import pyNIDAQ as pyNIDAQ
+import scanner
+from scanner import SigChannels, IntegrationCount, RUN_SCANS, REC_SCANS, RAM_FRAME_LIMIT
+from framestore import DiskFrameStore, write_tiff
+from renderer import FrameRenderer, OverlayRenderer
+from histogram import manual_lut
+from pyramid import ImagePyramid
+from recorder import FrameRecorder
+from postprocess import PostPipeline
+from bufferpool import POOL
+
+
+def load_gui():
+    """Import Tk, matplotlib and PIL into this module's namespace."""
+    global Tk, ttk, matplotlib, FigureCanvasTkAgg, NavigationToolbar2TkAgg, PIL, plt, animation, cm
+    import tkinter as Tk
+    from tkinter import ttk
+    import matplotlib
+    matplotlib.use('TkAgg')
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
+
+    import PIL.Image
+
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
+    import matplotlib.cm as cm
+
 
 """************************ Global Variables ***********"""
-CONT_SCAN = 0    # Flag to tell the scan generator to run continuosly in run mode, or once in record mode
 MAP_UPDATE = 1   # Draw image to the screen or not
 
 XResolution = 1024
 YResolution = 1024
-DataMap = zeros((XResolution, YResolution), dtype=int16)
+DataMap = zeros((XResolution, YResolution), dtype=int16)   # Consistent snapshot of FRAMESTORE for display and saving
 ImgMap = zeros((XResolution, YResolution), dtype=uint8)
 
 # Partial field settings
@@ -47,75 +60,41 @@ PFIELD_ON = 0
 pfield_size = 128
 pfield_xloc = (XResolution-pfield_size)/2
 pfield_yloc = (YResolution-pfield_size)/2
+PFIELD_MIN_SIZE = 16
+# ROIs kept with "Add ROI": (xlow, ylow, size, dwell, priority). While there
+# are any, the scan generator interleaves them (and the partial field, when
+# it is on) with a slow refresh of the full field
+ROIS = []
+RoiDwell = 1        # DwellUnits per pixel of added ROIs
+RoiPriority = 1     # share of the beam time of added ROIs, relative to each other
+
+# Viewer selections, passed on to the scan generator. The defaults and
+# every other scan setting are in scanner.py
+ScanPattern = scanner.ScanPattern
+IntegrationMode = scanner.IntegrationMode
+RegisterDrift = scanner.RegisterDrift
+Instrument = scanner.Instrument
+STATUS_INTERVAL = 1000   # ms between status panel updates
+
+DISPLAY_SIZE = 1024   # Larger frames are shown at a stride so the display is at most this size
+PFIELD_VIEW_SIZE = 300   # Screen pixels across the partial field overview
+
+# Display brightness/contrast, see histogram.py
+AutoContrast = 1                    # 1 stretches the percentiles below over the display, 0 uses the sliders
+ContrastPercentiles = (0.5, 99.5)   # percent of the displayed pixels clipped to black and to white
+HISTOGRAM_INTERVAL = 0.5            # seconds between redraws of the histogram readout
+
+# Streaming recorder, None when not recording
+RECORDER = None
+RecordLines = 0  # 1 streams every completed line, 0 every completed frame
+
+# Post-processing of completed frames in worker processes, see postprocess.py.
+# None when off
+POSTPIPE = None
+PostStages = ('denoise', 'focus')   # names in postprocess.STAGES, run in this order
+PostWorkers = 2                     # worker processes
 
 
-# DAQPAD-1200 configuration
-XChannel = 0    # Analog out channel of DAQ
-YChannel = 1    # Analog out channel of DAQ
-SigChannel = 0    # Signal intensity IN channel of DAQ 
-
-DATALOCK = threading.Lock()
-
-
-
-"""***********   Scan Generator   ****************"""
-class ScanGenerator(threading.Thread):
-
-    def run(self):
-        global XResolution, YResolution, DataMap, XChannel, YChannel, CONT_SCAN
-        global PFIELD_ON, pfield_size, pfield_xloc, pfield_yloc
-        temp = zeros(1, dtype=int16)
-        
-        YVals = rint(linspace(-2048, 2047, YResolution)).astype(int16)
-        XVals = rint(linspace(-2048, 2047, XResolution)).astype(int16)
-
-        if (PFIELD_ON == 0):
-            Xlow = 0
-            Xhigh = XResolution
-            Ylow = 0
-            Yhigh = YResolution
-        elif PFIELD_ON:
-            Xlow = rint(pfield_xloc).astype(int16)
-            Xhigh = rint(pfield_xloc).astype(int16) + pfield_size
-            Ylow = rint(pfield_yloc).astype(int16)
-            Yhigh = rint(pfield_yloc).astype(int16) + pfield_size
-        
-        # CONT_SCAN == -1 means run continiously
-        # CONT_SCAN == 1 means raster over the field once
-        # Currently the scan is generated point by point. Future revisions will use the DAQPAD waveform generator and buffers
-        while (CONT_SCAN == -1 or CONT_SCAN == 1):
-            starttime = time.time()
-            for j in range(Ylow, Yhigh): # For every horizontal line in the field
-                if (CONT_SCAN == 0): break
-                pyNIDAQ.pyAO_Write(1, YChannel, YVals[j])
-                for i in range(Xlow, Xhigh): # For every pixel along horizontal line j
-                    if (CONT_SCAN == 0): break
-                    
-                    # Write out the analog signal
-                    pyNIDAQ.pyAO_Write(1, XChannel, XVals[i])
-                    
-                    
-                    # Read the signal in for RunDwellTime 
-                    temp = pyNIDAQ.pyAI_Read(1, SigChannel, 1)
-                    #temp = pyNIDAQ.pyAI_Read(1, SigChannel, 10)
-                    DATALOCK.acquire()
-                    DataMap[j, i] = temp
-                    DATALOCK.release()
-
-            endtime = time.time()
-            deltatime = starttime - endtime
-            #print("idle event")
-            print("draw time: ", deltatime)
-            
-            if (CONT_SCAN == 1):
-                DATALOCK.acquire()
-                CONT_SCAN = 0
-                DATALOCK.release()
-            sleep(0.01)
-                    
-        print("scan thread terminating")
-        return # Thread will terminate when it returns
-
 
 class App:
 
@@ -123,8 +102,11 @@ class App:
     """************************* Button function declarations"""""""""""""""""""""
 
     def __init__(self, master):
+        global ImgMap
 
-        #self.scangen = ScanGenerator()        
+        # The scan generator runs for the life of the program, paused until a scan is selected
+        self.scangen = scanner.ScanGenerator(scanner.new_stores(XResolution, YResolution), XResolution, YResolution)
+        self.scangen.start()
 
         self.RunDwellTime = 1
         self.RecDwellTime = 10
@@ -143,14 +125,39 @@ class App:
         ttk.Button(buttonframe, text="Scan 4", command= lambda:self.SetRunScan(4)).grid(column=0, row=3, sticky=(Tk.N, Tk.W))
         ttk.Button(buttonframe, text="RUN", command= lambda:self.run_button_press()).grid(column=0, row=4, sticky=(Tk.N, Tk.W))
 
-        #ttk.Button(buttonframe, text="Rec Scan1", command= lambda:self.SetRecScan(1)).grid(column=0, row=5, sticky=(Tk.N, Tk.W))
-        #ttk.Button(buttonframe, text="Rec Scan2", command= lambda:self.SetRecScan(2)).grid(column=0, row=6, sticky=(Tk.N, Tk.W))
-        #ttk.Button(buttonframe, text="Rec Scan3", command= lambda:self.SetRecScan(3)).grid(column=0, row=7, sticky=(Tk.N, Tk.W))
-        #ttk.Button(buttonframe, text="Rec Scan4", command= lambda:self.SetRecScan(4)).grid(column=0, row=8, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="Raster", command= lambda:self.SetScanPattern('raster')).grid(column=1, row=0, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="Serpentine", command= lambda:self.SetScanPattern('serpentine')).grid(column=1, row=1, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="Interlaced", command= lambda:self.SetScanPattern('interlaced')).grid(column=1, row=2, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="Progressive", command= lambda:self.SetScanPattern('progressive')).grid(column=1, row=3, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="Sparse", command= lambda:self.SetScanPattern('sparse')).grid(column=1, row=4, sticky=(Tk.N, Tk.W))
+
+        ttk.Button(buttonframe, text="Integrate Off", command= lambda:self.SetIntegration('none')).grid(column=1, row=5, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="Frame Avg", command= lambda:self.SetIntegration('frames')).grid(column=1, row=6, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="Running Avg", command= lambda:self.SetIntegration('running')).grid(column=1, row=7, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="Recursive Avg", command= lambda:self.SetIntegration('recursive')).grid(column=1, row=8, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="Line Avg", command= lambda:self.SetIntegration('lines')).grid(column=1, row=9, sticky=(Tk.N, Tk.W))
+
+        # One view button per detector channel, and the colour overlay of all of them
+        for c, chan in enumerate(SigChannels):
+            ttk.Button(buttonframe, text="View AI%d" % chan, command= lambda c=c:self.SetView(c)).grid(column=1, row=10+c, sticky=(Tk.N, Tk.W))
+        if len(SigChannels) > 1:
+            ttk.Button(buttonframe, text="Overlay", command= lambda:self.SetView('overlay')).grid(column=1, row=11+len(SigChannels), sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="View Processed", command= lambda:self.SetView('processed')).grid(column=1, row=10+len(SigChannels), sticky=(Tk.N, Tk.W))
+
+        ttk.Button(buttonframe, text="Rec Scan1", command= lambda:self.SetRecScan(1)).grid(column=0, row=5, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="Rec Scan2", command= lambda:self.SetRecScan(2)).grid(column=0, row=6, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="Rec Scan3", command= lambda:self.SetRecScan(3)).grid(column=0, row=7, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="Rec Scan4", command= lambda:self.SetRecScan(4)).grid(column=0, row=8, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="Rec Scan5", command= lambda:self.SetRecScan(5)).grid(column=0, row=9, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="Rec Scan6", command= lambda:self.SetRecScan(6)).grid(column=0, row=10, sticky=(Tk.N, Tk.W))
         #ttk.Button(buttonframe, text="RECORD", command= lambda:self.rec_button_press()).grid(column=0, row=9, sticky=(Tk.N, Tk.W))
-        ttk.Button(buttonframe, text="IMG ON/OFF", command= lambda:self.toggle_map_update()).grid(column=0, row=9, sticky=(Tk.N, Tk.W))
-        ttk.Button(buttonframe, text="SAVE", command= lambda:self.save_image()).grid(column=0, row=10, sticky=(Tk.N, Tk.W))
-        ttk.Button(buttonframe, text="QUIT", command= lambda:self.quit()).grid(column=0, row=11, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="IMG ON/OFF", command= lambda:self.toggle_map_update()).grid(column=0, row=11, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="SAVE", command= lambda:self.save_image()).grid(column=0, row=12, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="STREAM ON/OFF", command= lambda:self.toggle_recording()).grid(column=0, row=13, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="DRIFT REG ON/OFF", command= lambda:self.toggle_registration()).grid(column=0, row=14, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="POSTPROC ON/OFF", command= lambda:self.toggle_postprocessing()).grid(column=0, row=15, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="STATS ON/OFF", command= lambda:self.toggle_instrumentation()).grid(column=0, row=16, sticky=(Tk.N, Tk.W))
+        ttk.Button(buttonframe, text="QUIT", command= lambda:self.quit()).grid(column=0, row=17, sticky=(Tk.N, Tk.W))
         
         for child in buttonframe.winfo_children(): child.grid_configure(padx=5, pady=5)
 
@@ -163,10 +170,17 @@ class App:
         self.fig = plt.figure(figsize=(9.2,9.2), frameon=True)
         self.ax = self.fig.add_axes([0,0,1,1])
         self.ax.axis('off')
-        self.im = self.ax.imshow(dstack([ImgMap, ImgMap, ImgMap]), interpolation='nearest', cmap = cm.Greys_r, vmin=0, vmax=256)
+        self.view = 0    # channel shown, or 'overlay'
+        self.view_stores = (self.scangen.store,)
+        self.resume_recording = None   # first store of a pending resolution change to record again from
+        self.renderer = FrameRenderer(self.scangen.store, max_size=DISPLAY_SIZE)
+        self.pyramid = ImagePyramid(self.renderer.display)
+        self.level = 0
+        ImgMap = self.renderer.display
+        self.im = self.ax.imshow(self.renderer.display, interpolation='nearest', cmap = cm.Greys_r, vmin=0, vmax=255)
         self.canvas = FigureCanvasTkAgg(self.fig, master=imageframe)
         self.canvas.get_tk_widget().grid(column=0, row=0, sticky=(Tk.N, Tk.W, Tk.E, Tk.S))
-        self.update_map()
+        self.canvas.draw()
 
         # Partial field settings ----------------------------------------------------------------------------------
         pfield_frame = ttk.Frame(root, padding="3 3 12 12")
@@ -181,187 +195,182 @@ class App:
         ttk.Button(pfield_frame, text="<", command= lambda:self.pfield_west()).grid(column=0, row=2, sticky=(Tk.E))
         ttk.Button(pfield_frame, text=">", command= lambda:self.pfield_east()).grid(column=2, row=2, sticky=(Tk.W))
         ttk.Button(pfield_frame, text="v", command= lambda:self.pfield_south()).grid(column=1, row=3, sticky=(Tk.N))
-        # ttk.Button(pfield_frame, text="+", command= lambda:self.SetRunScan(1)).grid(column=0, row=5, sticky=(Tk.W))
-        # ttk.Button(pfield_frame, text="-", command= lambda:self.SetRunScan(1)).grid(column=2, row=5, sticky=(Tk.W))
+        ttk.Button(pfield_frame, text="Add ROI", command= lambda:self.roi_add()).grid(column=0, row=4, sticky=(Tk.W))
+        ttk.Button(pfield_frame, text="Clear ROIs", command= lambda:self.roi_clear()).grid(column=2, row=4, sticky=(Tk.W))
+        ttk.Button(pfield_frame, text="+", command= lambda:self.pfield_resize(2)).grid(column=0, row=5, sticky=(Tk.W))
+        ttk.Button(pfield_frame, text="-", command= lambda:self.pfield_resize(0.5)).grid(column=2, row=5, sticky=(Tk.W))
 
         self.pfield_fig = plt.figure(figsize=(3,3), frameon=True)
         self.pfield_ax = self.pfield_fig.add_axes([0,0,1,1])
         self.pfield_ax.axis('off')
-        self.pfield_im = self.pfield_ax.imshow(dstack([ImgMap, ImgMap, ImgMap]), interpolation='nearest', cmap = cm.Greys_r, vmin=0, vmax=256)
+        coarse = self.pyramid.levels[self.pyramid.level_for_size(PFIELD_VIEW_SIZE)]
+        self.pfield_map = dstack([coarse, coarse, coarse])    # overview with the partial field outline, reused by every redraw
+        self.pfield_im = self.pfield_ax.imshow(self.pfield_map, interpolation='nearest', cmap = cm.Greys_r, vmin=0, vmax=256)
         self.pfield_canvas = FigureCanvasTkAgg(self.pfield_fig, master=pfield_frame)
         self.pfield_canvas.get_tk_widget().grid(column=0, row=6, columnspan=3, rowspan=3, sticky=(Tk.N, Tk.W, Tk.E, Tk.S))
+
+        # Brightness/contrast and the live histogram of the displayed image -------------------------------------
+        self.brightness = Tk.DoubleVar(value=0.0)
+        self.contrast = Tk.DoubleVar(value=1.0)
+        ttk.Button(pfield_frame, text="Auto B/C", command= lambda:self.SetAutoContrast()).grid(column=1, row=9, sticky=(Tk.N))
+        ttk.Label(pfield_frame, text="Brightness").grid(column=0, row=10, sticky=(Tk.W))
+        ttk.Scale(pfield_frame, from_=-1.0, to=1.0, variable=self.brightness,
+                  command= lambda value:self.SetManualContrast()).grid(column=1, row=10, columnspan=2, sticky=(Tk.W, Tk.E))
+        ttk.Label(pfield_frame, text="Contrast").grid(column=0, row=11, sticky=(Tk.W))
+        ttk.Scale(pfield_frame, from_=0.5, to=16.0, variable=self.contrast,
+                  command= lambda value:self.SetManualContrast()).grid(column=1, row=11, columnspan=2, sticky=(Tk.W, Tk.E))
+
+        self.hist_fig = plt.figure(figsize=(3,1.5), frameon=True)
+        self.hist_ax = self.hist_fig.add_axes([0,0,1,1])
+        self.hist_ax.axis('off')
+        self.hist_ax.set_xlim(-2048, 2047)
+        self.hist_line, = self.hist_ax.plot(linspace(-2016, 2016, 64), zeros(64), drawstyle='steps-mid', color='k')
+        self.hist_low = self.hist_ax.axvline(-2048, color='b')
+        self.hist_high = self.hist_ax.axvline(2047, color='r')
+        self.hist_canvas = FigureCanvasTkAgg(self.hist_fig, master=pfield_frame)
+        self.hist_canvas.get_tk_widget().grid(column=0, row=12, columnspan=3, sticky=(Tk.N, Tk.W, Tk.E, Tk.S))
+        self.hist_time = 0.0
+        self.apply_contrast()
+
+        # Status panel, filled in while instrumentation is on
+        self.status = Tk.StringVar(value="")
+        self.status_job = None
+        ttk.Label(pfield_frame, textvariable=self.status, font=('TkFixedFont', 8), justify=Tk.LEFT).grid(column=0, row=13, columnspan=3, sticky=(Tk.N, Tk.W))
+        if Instrument:
+            self.update_status()
         self.update_map()
         
     def SetRunScan(self,i):
         """Set the scan parameters to a predefined value from a list of scan rates.
         """
-        global XResolution, YResolution, DataMap, ImgMap, CONT_SCAN, PFIELD_ON, pfield_xloc, pfield_yloc
+        global XResolution, YResolution, PFIELD_ON, pfield_xloc, pfield_yloc, ROIS
         
-        if i == 1:
-            if PFIELD_ON:
-                PFIELD_ON = 0
-                self.pfieldmap_redraw()
-            CONT_SCAN = 0
-            try:
-                while self.scangen.isAlive():
-                    sleep(1)
-            except AttributeError:
-                pass
-            RunDwellTime = 1
-            XResolution = 128
-            YResolution = 128
-            pfield_xloc = rint((XResolution-pfield_size)/2)
-            pfield_yloc = rint((YResolution-pfield_size)/2)
-            print(XResolution, YResolution)
-            ImgMap = zeros((XResolution, YResolution), dtype=uint8)
-            DataMap = zeros((XResolution, YResolution), dtype=int16)
-            print('Run scan rate 1 selected')
-            CONT_SCAN = -1
-            self.scangen = ScanGenerator()
-            self.scangen.start()
-
-        elif i == 2:
-            if PFIELD_ON:
-                PFIELD_ON = 0
-                self.pfieldmap_redraw()
-            CONT_SCAN = 0
-            try:
-                while self.scangen.isAlive():
-                    sleep(1)
-            except AttributeError:
-                pass
-            RunDwellTime = 5
-            XResolution = 256
-            YResolution = 256
-            pfield_xloc = rint((XResolution-pfield_size)/2)
-            pfield_yloc = rint((YResolution-pfield_size)/2)
-            print(XResolution, YResolution)
-            ImgMap = zeros((XResolution, YResolution), dtype=uint8)
-            DataMap = zeros((XResolution, YResolution), dtype=int16)
-            print('Run scan rate 2 selected')
-            CONT_SCAN = -1
-            self.scangen = ScanGenerator()
-            self.scangen.start()
-
-        elif i == 3:
-            if PFIELD_ON:
-                PFIELD_ON = 0
-                self.pfieldmap_redraw()
-            CONT_SCAN = 0
-            try:
-                while self.scangen.isAlive():
-                    sleep(1)
-            except AttributeError:
-                pass
-            RunDwellTime = 5
-            XResolution = 512
-            YResolution = 512
-            pfield_xloc = rint((XResolution-pfield_size)/2)
-            pfield_yloc = rint((YResolution-pfield_size)/2)
-            print(XResolution, YResolution)
-            ImgMap = zeros((XResolution, YResolution), dtype=uint8)
-            DataMap = zeros((XResolution, YResolution), dtype=int16)
-            print('Run scan rate 3 selected')
-            CONT_SCAN = -1
-            self.scangen = ScanGenerator()
-            self.scangen.start()
-
-        elif i == 4:
-            if PFIELD_ON:
-                PFIELD_ON = 0
-                self.pfieldmap_redraw()
-            CONT_SCAN = 0
-            try:
-                while self.scangen.isAlive():
-                    sleep(1)
-            except AttributeError:
-                pass
-            RunDwellTime = 5
-            XResolution = 1024
-            YResolution = 1024
-            pfield_xloc = rint((XResolution-pfield_size)/2)
-            pfield_yloc = rint((YResolution-pfield_size)/2)
-            print(XResolution, YResolution)
-            ImgMap = zeros((XResolution, YResolution), dtype=uint8)
-            DataMap = zeros((XResolution, YResolution), dtype=int16)
-            print('Run scan rate 4 selected')
-            CONT_SCAN = -1
-            self.scangen = ScanGenerator()
-            self.scangen.start()
-        else:
+        if i not in RUN_SCANS:
             print('Invalid Run scan rate selected')
+            return
+        XResolution, RunDwellTime = RUN_SCANS[i]
+        YResolution = XResolution
+
+        if PFIELD_ON or ROIS:
+            PFIELD_ON = 0
+            ROIS = []
+            self.pfieldmap_redraw()
+        self.RunDwellTime = RunDwellTime
+        pfield_xloc = rint((XResolution-pfield_size)/2)
+        pfield_yloc = rint((YResolution-pfield_size)/2)
+        print(XResolution, YResolution)
+        self.set_resolution(self.new_stores(), RunDwellTime)
+        self.scangen.continuous()
+        print('Run scan rate %d selected' % i)
+
+    def SetScanPattern(self, pattern):
+        """Select the order the scan visits the field in. 'progressive' covers
+        the whole field coarsely first and refines it, and the display fills
+        the rows not scanned yet from the nearest scanned ones. 'sparse' is a
+        fast preview that samples SparseFraction of the pixels and fills in
+        the rest."""
+        global ScanPattern
+        ScanPattern = pattern
+        self.scangen.set_pattern(pattern)
+        print('Scan pattern %s selected' % pattern)
+
+    def SetIntegration(self, mode):
+        """Select how repeated scans are averaged, over IntegrationCount frames or lines."""
+        global IntegrationMode
+        IntegrationMode = mode
+        self.scangen.set_integration(mode, IntegrationCount)
+        print('Integration %s over %d selected' % (mode, IntegrationCount))
 
     def SetRecScan(self,i):
-        """Set the scan parameters to a predefined value from a list of scan rates.
+        """Set the scan parameters to a predefined value from a list of scan rates
+        and record a single frame. Frames larger than RAM_FRAME_LIMIT are filled
+        line by line into a memory-mapped file, SEM_<date>_<time>_rec.dat.
         """
-        #global XResolution, YResolution, DataMap
-
-        if i == 1:
-            RecDwellTime = 10
-            XResolution = 1024
-            YResolution = 1024
-            print(XResolution, YResolution)
-            self.ax.set_xlim(0, XResolution)
-            self.ax.set_ylim(YResolution, 0)
-            print('Rec scan rate 1 selected')
-        elif i == 2:
-            RecDwellTime = 20
-            XResolution = 1024
-            YResolution = 1024
-            print(XResolution, YResolution)
-            self.ax.set_xlim(0, XResolution)
-            self.ax.set_ylim(YResolution, 0)
-            print('Rec scan rate 2 selected')
-        elif i == 3:
-            RecDwellTime = 10
-            XResolution = 2048
-            YResolution = 2048
-            print(XResolution, YResolution)
-            self.ax.set_xlim(0, XResolution)
-            self.ax.set_ylim(YResolution, 0)
-            print('Rec scan rate 3 selected')
-        elif i == 4:
-            RecDwellTime = 20
-            XResolution = 2048
-            YResolution = 2048
-            print(XResolution, YResolution)
-            self.ax.set_xlim(0, XResolution)
-            self.ax.set_ylim(YResolution, 0)
-            print('Rec scan rate 4 selected')
-        else:
+        global XResolution, YResolution, PFIELD_ON, ROIS
+
+        if i not in REC_SCANS:
             print('Invalid Rec scan rate selected')
+            return
+        XResolution, RecDwellTime = REC_SCANS[i]
+        YResolution = XResolution
+
+        if PFIELD_ON or ROIS:
+            PFIELD_ON = 0
+            ROIS = []
+            self.pfieldmap_redraw()
+        if ScanPattern == 'sparse':
+            # sparse is for previews only, record frames are always fully scanned
+            self.SetScanPattern('raster')
+        self.RecDwellTime = RecDwellTime
+        print(XResolution, YResolution)
+        self.set_resolution(self.new_stores(XResolution*YResolution > RAM_FRAME_LIMIT), RecDwellTime)
+        self.scangen.single_frame()
+        print('Rec scan rate %d selected' % i)
+
+    def set_resolution(self, stores, dwell):
+        """Scan into stores at the current resolution. A recording that is
+        running is stopped first; update_map starts it again at the new
+        frame size, in a new file, once the scan has switched to stores,
+        since a recording has one frame size throughout."""
+        if RECORDER is not None:
+            self.toggle_recording()
+            self.resume_recording = stores[0]
+        elif self.resume_recording is not None:
+            # still waiting for an earlier change, record from this one instead
+            self.resume_recording = stores[0]
+        return self.scangen.set_resolution(stores, XResolution, YResolution, dwell)
+
+    def new_stores(self, on_disk=False):
+        """A FrameStore of the current resolution for every channel in
+        SigChannels, memory-mapped to SEM_<date>_<time>_rec[_chN].dat if on_disk."""
+        return scanner.new_stores(XResolution, YResolution, on_disk)
+
+    def SetAutoContrast(self):
+        """Stretch the ContrastPercentiles of the displayed image over the display."""
+        global AutoContrast
+        AutoContrast = 1
+        self.apply_contrast()
+
+    def SetManualContrast(self):
+        """Map the display from the brightness and contrast sliders."""
+        global AutoContrast
+        AutoContrast = 0
+        self.apply_contrast()
+
+    def apply_contrast(self):
+        if AutoContrast:
+            self.renderer.auto = ContrastPercentiles
+            self.renderer.set_lut(*manual_lut())    # until the histogram has something in it
+        else:
+            self.renderer.auto = None
+            self.renderer.set_lut(*manual_lut(self.brightness.get(), self.contrast.get()))
+
+    def draw_histogram(self):
+        """Redraw the histogram readout of the displayed image and its clip limits."""
+        counts = self.renderer.histogram.readout(64)
+        self.hist_line.set_ydata(counts)
+        self.hist_ax.set_ylim(0, max(counts.max(), 1)*1.05)
+        low, high = self.renderer.limits or (-2048, 2047)
+        self.hist_low.set_xdata([low, low])
+        self.hist_high.set_xdata([high, high])
+        self.hist_canvas.draw_idle()
+
+    def SetView(self, view):
+        """Show channel number view of SigChannels, all of them in colour with
+        'overlay', or the post-processed first channel with 'processed'."""
+        self.view = view
+        print('Viewing %s' % (view if view in ('overlay', 'processed') else 'AI%d' % SigChannels[view]))
 
     # depricated
     def run_button_press(self):
-        global CONT_SCAN
-        DATALOCK.acquire()
-        if (CONT_SCAN == 0):
-            CONT_SCAN = -1
-            sleep(0.5)
-            self.scangen = ScanGenerator()
-            self.scangen.start()
-            print("Contscan = ", CONT_SCAN)
-        elif (CONT_SCAN == -1):
-            CONT_SCAN = 0
-        DATALOCK.release()
+        if self.scangen.mode == 'paused':
+            self.scangen.continuous()
+        else:
+            self.scangen.pause()
 
     # depricated
     def rec_button_press(self):
-        global CONT_SCAN
-        DATALOCK.acquire()
-        if (CONT_SCAN == 0):
-            CONT_SCAN = 1
-            sleep(0.5)
-            self.scangen = ScanGenerator()
-            self.scangen.start()
-            print("Contscan = ", CONT_SCAN)
-        elif (CONT_SCAN == -1):
-            CONT_SCAN = 0
-            sleep(1)
-            CONT_SCAN = 1
-            self.scangen = ScanGenerator()
-            self.scangen.start()
-        DATALOCK.release()
+        self.scangen.single_frame()
 
     def toggle_map_update(self):
         global MAP_UPDATE
@@ -371,113 +380,331 @@ class App:
             MAP_UPDATE = 1
 
     def update_map(self):
+        """Convert and repaint only the lines the scan generator has published
+        since the last call. Reschedules itself at a rate that follows how fast
+        lines are arriving."""
         global ImgMap
+        delay = 1000
+        if self.resume_recording is not None and self.scangen.store is self.resume_recording:
+            self.resume_recording = None
+            self.toggle_recording()
         if MAP_UPDATE:
-            #starttime = time.time()
-            divide((DataMap+2048), 16, ImgMap)
-            self.im.set_data(dstack([ImgMap, ImgMap, ImgMap]))
-            self.canvas.draw()
-            #endtime = time.time()
-            #deltatime = starttime - endtime
-            #print("idle event")
-            #print("draw time: ", deltatime)
-        root.after(1000, self.update_map)
+            stores = self.scangen.stores
+            postpipe = POSTPIPE
+            if postpipe is not None and postpipe.store is not stores[0]:
+                # Resolution changed, move the pipeline to the new stores
+                if isinstance(stores[0], DiskFrameStore):
+                    print("Post-processing is not available for frames recorded to disk")
+                    self.toggle_postprocessing()
+                else:
+                    postpipe.set_store(stores[0])
+                postpipe = POSTPIPE
+            if self.view == 'overlay':
+                stores = tuple(stores)
+            elif self.view == 'processed':
+                stores = (postpipe.out if postpipe is not None else stores[0],)
+            else:
+                stores = (stores[min(self.view, len(stores)-1)],)
+            if stores != self.view_stores:
+                # Resolution or view changed, start over with a full draw
+                self.view_stores = stores
+                if len(stores) > 1:
+                    self.renderer = OverlayRenderer(stores, max_size=DISPLAY_SIZE)
+                else:
+                    self.renderer = FrameRenderer(stores[0], max_size=DISPLAY_SIZE)
+                self.pyramid = ImagePyramid(self.renderer.display)
+                self.level = 0
+                ImgMap = self.renderer.display
+                self.im.set_data(ImgMap)
+                self.im.set_extent((-0.5, stores[0].cols-0.5, stores[0].rows-0.5, -0.5))
+                self.canvas.draw()
+                self.apply_contrast()
+            # neither the renderer nor post-processing reads replaced stores any more
+            self.scangen.release_retired()
+            self.renderer.fill_unscanned = (ScanPattern == 'progressive' and not PFIELD_ON and not ROIS)
+            rows = self.renderer.update()
+            self.pyramid.update(rows)
+            stats = self.scangen.stats
+            if stats is not None and len(rows):
+                stats.record_render(self.renderer.render_time, len(rows))
+            level = self.view_level()
+            if len(rows) or level != self.level:
+                self.level = level
+                self.renderer.paint(self.im, self.ax, self.canvas, self.pyramid.levels[level])
+            if len(rows) and time.time() - self.hist_time > HISTOGRAM_INTERVAL:
+                self.hist_time = time.time()
+                self.draw_histogram()
+            delay = self.renderer.interval
+        root.after(delay, self.update_map)
+
+    def view_level(self):
+        """Pyramid level that matches the screen pixels across the visible part of the image."""
+        x0, x1 = self.ax.get_xlim()
+        source = abs(x1 - x0)/self.renderer.step
+        return self.pyramid.level_for(source, self.ax.bbox.width)
 
     def save_image(self):
-        image = PIL.Image.fromarray(DataMap)
-        image.save("Test.tif", "tiff")
+        """Save every channel: Test.tif for the first one and Test_chN.tif for
+        the others, or next to the memory-mapped files of a record scan."""
+        global DataMap
+        for c, store in enumerate(self.scangen.stores):
+            if isinstance(store, DiskFrameStore):
+                # Written a strip at a time from the file, off the Tk thread
+                tiff_path = store.path[:-len('.dat')] + '.tif'
+                threading.Thread(target=write_tiff, args=(store.frame, tiff_path)).start()
+                print("Saving ", tiff_path)
+                continue
+            if c == 0:
+                if DataMap.shape != store.frame.shape:
+                    DataMap = zeros(store.frame.shape, dtype=int16)
+                data, seq = store.snapshot(DataMap)
+                tiff_path = "Test.tif"
+            else:
+                with POOL.acquire(store.frame.shape, store.frame.dtype) as data:
+                    store.snapshot(data)
+                    PIL.Image.fromarray(data).save("Test_ch%d.tif" % SigChannels[c], "tiff")
+                continue
+            image = PIL.Image.fromarray(data)
+            image.save(tiff_path, "tiff")
+
+    def toggle_recording(self):
+        """Start streaming every completed frame (or line) to SEM_<date>_<time>.raw/.idx,
+        or stop the stream that is running and print the writer's statistics."""
+        global RECORDER
+        if RECORDER is None:
+            name = time.strftime("SEM_%Y%m%d_%H%M%S")
+            store = self.scangen.store
+            per_line = RecordLines or store.rows*store.cols > RAM_FRAME_LIMIT
+            RECORDER = FrameRecorder(name, store.rows, store.cols, per_line=per_line, pool=POOL)
+            self.scangen.recorder = RECORDER
+            print("Recording to ", name)
+        else:
+            recorder = RECORDER
+            RECORDER = None
+            self.scangen.recorder = None
+            # Closing waits for the queue to drain, keep that off the Tk thread
+            threading.Thread(target=lambda: print("Recording stopped: ", recorder.close())).start()
+
+    def toggle_postprocessing(self):
+        """Start post-processing every completed frame of the first channel with
+        PostStages in PostWorkers processes, or stop it and print its timings.
+        The result is shown with View Processed."""
+        global POSTPIPE
+        if POSTPIPE is None:
+            if isinstance(self.scangen.store, DiskFrameStore):
+                print("Post-processing is not available for frames recorded to disk")
+                return
+            POSTPIPE = PostPipeline(self.scangen.store, PostStages, PostWorkers)
+            print("Post-processing ", ", ".join(PostStages))
+        else:
+            postpipe = POSTPIPE
+            POSTPIPE = None
+            postpipe.stop()
+            # Closing waits for the pool to finish, keep that off the Tk thread
+            threading.Thread(target=lambda: print("Post-processing stopped: ", postpipe.close())).start()
+
+    def toggle_instrumentation(self):
+        """Start or stop recording scan and display timings, shown in the status panel."""
+        global Instrument
+        Instrument = 0 if Instrument else 1
+        self.scangen.set_instrumentation(Instrument).wait()
+        if self.status_job is not None:
+            root.after_cancel(self.status_job)
+            self.status_job = None
+        if Instrument:
+            self.update_status()
+        else:
+            self.status.set("")
+
+    def update_status(self):
+        """Show the scan generator's timing summary. Reschedules itself while
+        instrumentation is on."""
+        stats = self.scangen.query_stats()
+        if stats is None:
+            return
+        postpipe = POSTPIPE
+        stats['queues']['postprocess'] = postpipe.queue_depth() if postpipe is not None else 0
+        lines = ["%.1f fps, %d lines" % (stats['fps'], stats['lines_recorded'])]
+        if 'line_ms_median' in stats:
+            lines += ["line %.2f ms (p99 %.2f, max %.2f)" % (stats['line_ms_median'], stats['line_ms_p99'], stats['line_ms_max']),
+                      "driver %.0f%%, longest gap %.1f ms" % (100*stats['driver_fraction'], stats['gap_ms_max']),
+                      "dwell %.1f us of %.1f us" % (stats['achieved_dwell_us'], stats['requested_dwell_us']),
+                      "jitter " + " ".join(str(n) for n in stats['line_jitter'])]
+        if 'render_ms_median' in stats:
+            lines.append("render %.2f ms (max %.2f)" % (stats['render_ms_median'], stats['render_ms_max']))
+        if 'roi_refresh_hz' in stats:
+            rates = stats['roi_refresh_hz']
+            lines.append("ROIs " + " ".join("%.1f" % hz for hz in rates[:-1]) + " Hz, full field %.2f Hz" % rates[-1])
+        lines.append("queues " + " ".join("%s %d" % item for item in stats['queues'].items()))
+        pool = stats['pool']
+        lines.append("buffers %.1f MB in use, %.1f MB idle, %d allocations, %d reuses"
+                     % (pool['in_use_MB'], pool['idle_MB'], pool['allocations'], pool['reuses']))
+        self.status.set("\n".join(lines))
+        self.status_job = root.after(STATUS_INTERVAL, self.update_status)
+
+    def toggle_registration(self):
+        """Turn drift registration of every frame on or off. Mostly useful
+        with frame integration, where drift would blur the average."""
+        global RegisterDrift
+        RegisterDrift = 0 if RegisterDrift else 1
+        self.scangen.set_registration(RegisterDrift)
+        print("Drift registration ", "on" if RegisterDrift else "off")
 
     def quit(self):
-        global CONT_SCAN
-        CONT_SCAN = 0
-        try:
-            while self.scangen.isAlive():
-                sleep(1)
-        except AttributeError:
-            pass
+        self.scangen.stop()
+        self.scangen.join(5)
+        if RECORDER is not None:
+            print("Recording stopped: ", RECORDER.close())
+        if POSTPIPE is not None:
+            print("Post-processing stopped: ", POSTPIPE.close())
+        print("buffer pool: ", POOL.stats())
         root.quit()
 
     # Partial field functions ---------------------------------------------------
     def pfield_toggle(self):
-        global PFIELD_ON, ImgMap, pfield_size, pfield_xloc, pfield_yloc, XResolution, YResolution
+        global PFIELD_ON
 
         PFIELD_ON = (PFIELD_ON != 1)
         #pfield_xloc = (XResolution-pfield_size)/2
         #pfield_yloc = (YResolution-pfield_size)/2
-        self.scangen_restart()
+        self.scangen_update_roi()
+        self.scangen.continuous()
         self.pfieldmap_redraw()
 
-    def scangen_restart(self):
-        global CONT_SCAN
-        CONT_SCAN = 0
-        try:
-            while self.scangen.isAlive():
-                sleep(1)
-        except AttributeError:
-            pass
-        CONT_SCAN = -1
-        self.scangen = ScanGenerator()
-        self.scangen.start()
+    def pfield_roi(self):
+        """The partial field as (xlow, ylow, size), kept inside the frame."""
+        size = min(pfield_size, XResolution, YResolution)
+        xlow = int(min(max(rint(pfield_xloc), 0), XResolution - size))
+        ylow = int(min(max(rint(pfield_yloc), 0), YResolution - size))
+        return (xlow, ylow, size)
+
+    def scangen_update_roi(self):
+        """Send the partial field, and the ROIs if there are any, to the scan
+        generator, which switches to them at the next line without stopping."""
+        if ROIS:
+            rois = list(ROIS)
+            if PFIELD_ON:
+                rois.append(self.pfield_roi() + (RoiDwell, RoiPriority))
+            self.scangen.set_rois(rois)
+        elif PFIELD_ON:
+            self.scangen.set_roi(self.pfield_roi())
+        else:
+            self.scangen.set_roi(None)
+
+    def roi_add(self):
+        """Keep the partial field as a ROI and turn the partial field off, so
+        it can be placed on the next feature."""
+        global PFIELD_ON
+        if not PFIELD_ON:
+            print("Turn the partial field on and place it to add a ROI")
+            return
+        ROIS.append(self.pfield_roi() + (RoiDwell, RoiPriority))
+        PFIELD_ON = 0
+        print("ROI %d added: " % len(ROIS), ROIS[-1])
+        self.scangen_update_roi()
+        self.scangen.continuous()
+        self.pfieldmap_redraw()
+
+    def roi_clear(self):
+        global ROIS
+        ROIS = []
+        self.scangen_update_roi()
+        self.pfieldmap_redraw()
+
+    def pfield_resize(self, factor):
+        """Scale the partial field by factor about its centre."""
+        global pfield_size, pfield_xloc, pfield_yloc
+        size = int(min(max(pfield_size*factor, PFIELD_MIN_SIZE), XResolution, YResolution))
+        pfield_xloc = pfield_xloc + (pfield_size - size)/2
+        pfield_yloc = pfield_yloc + (pfield_size - size)/2
+        pfield_size = size
+        if PFIELD_ON:
+            self.scangen_update_roi()
+            self.pfieldmap_redraw()
     
     def pfieldmap_redraw(self):
-        pfield_map = dstack([ImgMap, ImgMap, ImgMap])
-
+        """Redraw the partial field overview from a coarse pyramid level, with
+        the partial field outlined in green when it is on and the ROIs in blue."""
+        level = self.pyramid.level_for_size(PFIELD_VIEW_SIZE)
+        coarse = self.pyramid.levels[level]
+        if self.pfield_map.shape[:2] != coarse.shape[:2]:
+            self.pfield_map = zeros(coarse.shape[:2] + (3,), dtype=uint8)
+        pfield_map = self.pfield_map
+        pfield_map[...] = coarse[:, :, None] if coarse.ndim == 2 else coarse
+
+        scale = self.renderer.step * 2**level
+        for roi in ROIS:
+            self.outline(pfield_map, roi[:3], scale, 2)
         if PFIELD_ON:
-            pfield_map[ (pfield_yloc-5):(pfield_yloc+pfield_size+5), (pfield_xloc-5):(pfield_xloc), 1 ] = 256
-            pfield_map[ (pfield_yloc+pfield_size):(pfield_yloc+pfield_size+5), (pfield_xloc-5):(pfield_xloc+pfield_size+5), 1 ] = 256
-            pfield_map[ (pfield_yloc-5):(pfield_yloc+pfield_size+5), (pfield_xloc+pfield_size):(pfield_xloc+pfield_size+5), 1 ] = 256
-            pfield_map[ (pfield_yloc-5):(pfield_yloc), (pfield_xloc-5):(pfield_xloc+pfield_size+5), 1 ] = 256
-            self.pfield_im.set_data(pfield_map)
-            self.pfield_canvas.draw()
-        else:
-            self.pfield_im.set_data(dstack([ImgMap, ImgMap, ImgMap]))
-            self.pfield_canvas.draw()
+            self.outline(pfield_map, self.pfield_roi(), scale, 1)
+        self.pfield_im.set_data(pfield_map)
+        self.pfield_im.set_extent((-0.5, coarse.shape[1]-0.5, coarse.shape[0]-0.5, -0.5))
+        self.pfield_canvas.draw()
+
+    def outline(self, pfield_map, roi, scale, colour):
+        """Draw the outline of roi = (xlow, ylow, size) into colour channel
+        colour of the overview, which is scale frame pixels per pixel."""
+        xloc, yloc, size = roi
+        # Corners in overview pixels
+        x0 = int(xloc//scale)
+        y0 = int(yloc//scale)
+        x1 = int((xloc+size)//scale)
+        y1 = int((yloc+size)//scale)
+        b = max(1, 5//scale)
+        pfield_map[ max(0, y0-b):(y1+b), max(0, x0-b):(x0), colour ] = 255
+        pfield_map[ (y1):(y1+b), max(0, x0-b):(x1+b), colour ] = 255
+        pfield_map[ max(0, y0-b):(y1+b), (x1):(x1+b), colour ] = 255
+        pfield_map[ max(0, y0-b):(y0), max(0, x0-b):(x1+b), colour ] = 255
 
     def pfield_north(self):
-        global PFIELD_ON, ImgMap, pfield_size, pfield_xloc, pfield_yloc, XResolution, YResolution
+        global pfield_yloc
 
         if (PFIELD_ON and (pfield_yloc - pfield_size/2 >=0)):
             pfield_yloc = pfield_yloc - pfield_size/2
-            self.scangen_restart()
+            self.scangen_update_roi()
             self.pfieldmap_redraw()
 
 
     def pfield_west(self):
-        global PFIELD_ON, ImgMap, pfield_size, pfield_xloc, pfield_yloc, XResolution, YResolution
+        global pfield_xloc
 
         if (PFIELD_ON and (pfield_xloc - pfield_size/2 >=0)):
             pfield_xloc = pfield_xloc - pfield_size/2
-            self.scangen_restart()
+            self.scangen_update_roi()
             self.pfieldmap_redraw()
             
     def pfield_east(self):
-        global PFIELD_ON, ImgMap, pfield_size, pfield_xloc, pfield_yloc, XResolution, YResolution
+        global pfield_xloc
 
         if (PFIELD_ON and (pfield_xloc + pfield_size/2 < XResolution)):
             pfield_xloc = pfield_xloc + pfield_size/2
-            self.scangen_restart()
+            self.scangen_update_roi()
             self.pfieldmap_redraw()
 
     def pfield_south(self):
-        global PFIELD_ON, ImgMap, pfield_size, pfield_xloc, pfield_yloc, XResolution, YResolution
+        global pfield_yloc
 
         if (PFIELD_ON and (pfield_yloc + pfield_size/2 < YResolution)):
             pfield_yloc = pfield_yloc + pfield_size/2
-            self.scangen_restart()
+            self.scangen_update_roi()
             self.pfieldmap_redraw()
 
                 
     """""""""""""""""""""""""""""""""" Window Construction """""""""""""""""""""""""""""""""
 
-        
-root = Tk.Tk()
-root.title("SEM control v1.16")
-w, h = root.winfo_screenwidth(), root.winfo_screenheight()
-root.overrideredirect(1)
-root.geometry("%dx%d+0+0" % (w,h))
-root.focus_set()
 
-app = App(root)
+# Guarded so the post-processing worker processes can import this module
+# without opening another window
+if __name__ == '__main__':
+    load_gui()
+    root = Tk.Tk()
+    root.title("SEM control v1.16")
+    w, h = root.winfo_screenwidth(), root.winfo_screenheight()
+    root.overrideredirect(1)
+    root.geometry("%dx%d+0+0" % (w,h))
+    root.focus_set()
+
+    app = App(root)
 
-root.mainloop()
-root.destroy()
+    root.mainloop()
+    root.destroy()
@@ -0,0 +1,277 @@
+# Sparse (subsampled) preview scans for the SEM scan generator
+# Written for the Amray SEM control program
+
+"""
+A fast preview mode that samples only a fraction of the pixels of every line
+and reconstructs the rest, for beam sensitive samples and for finding a
+region quickly.
+
+compile_sparse builds a SparseProgram: the same raster of lines as a
+ScanProgram, but every line visits the same number of columns, chosen from
+a low-discrepancy mask. The columns of row r are evenly spaced across the
+line with a per-row offset of r times the golden ratio, so the samples are
+spread evenly over the field in both directions; 'random' picks them at
+random instead.
+
+The scan generator collects the sampled values of a frame and hands them to
+a Reconstructor, a background thread that fills in the missing pixels and
+publishes the whole frame to the store. inpaint interpolates linearly along
+the rows and along the columns between the sampled pixels and averages the
+two. Which samples every pixel lies between, and how far, only depends on
+the program's sample mask, so an InpaintPlan works that out once per
+program; every frame is then a few gathers into working buffers from the
+BufferPool.
+"""
+
+import threading
+import queue
+import time
+from functools import lru_cache
+
+from numpy import (arange, zeros, full, concatenate, repeat, rint, floor, int16, int64, float32,
+                   interp, where, sort, lexsort, searchsorted, clip, maximum, take)
+from numpy.random import default_rng
+
+from scanpattern import dac_codes, reduce_dwell
+from bufferpool import POOL
+
+MASKS = ('lattice', 'random')
+GOLDEN = 0.6180339887498949
+
+
+def sample_columns(rows, cols, count, mask='lattice', seed=0):
+    """(rows, count) array of the sorted columns sampled on every row."""
+    count = max(1, min(count, cols))
+    if mask == 'lattice':
+        offset = (arange(rows)*GOLDEN) % 1.0
+        columns = floor((arange(count)[None, :] + offset[:, None])*cols/count).astype(int64)
+    elif mask == 'random':
+        keys = default_rng(seed).random((rows, cols))
+        columns = sort(keys.argpartition(count - 1, axis=1)[:, :count], axis=1)
+    else:
+        raise ValueError('unknown sample mask %r' % (mask,))
+    return columns
+
+
+class SparseProgram:
+
+    pattern = 'sparse'
+    contiguous = True
+
+    def __init__(self, xres, yres, roi, fraction, mask, dwell, flyback, settle):
+        self.xres = xres
+        self.yres = yres
+        self.roi = roi
+        self.fraction = fraction
+        self.mask = mask
+        self.dwell = dwell
+        self.flyback = flyback
+        self.settle = settle
+
+        if roi is None:
+            self.xlow, self.ylow = 0, 0
+            self.width, self.height = xres, yres
+        else:
+            self.xlow, self.ylow, size = roi
+            self.width, self.height = size, size
+
+        self.order = arange(self.ylow, self.ylow + self.height)
+        self.reversed = zeros(self.height, dtype=bool)
+        self.samples = max(1, int(rint(fraction*self.width)))    # pixels sampled per line
+        self.columns = sample_columns(self.height, self.width, self.samples, mask)
+        self.valid = slice(self.settle, self.settle + self.samples*dwell)
+        self.line_length = self.settle + self.samples*dwell + self.flyback
+        self.x_codes = dac_codes(xres)[self.xlow:self.xlow + self.width]
+        self.y_codes = dac_codes(yres)
+
+        for a in (self.order, self.reversed, self.columns, self.x_codes, self.y_codes):
+            a.flags.writeable = False   # programs are shared through the cache
+
+    def __len__(self):
+        """Number of scan lines."""
+        return self.height
+
+    def x_line(self, k):
+        """X codes of scan line k: settle pad, the sampled pixels, flyback ramp."""
+        xcodes = self.x_codes[self.columns[k]]
+        settle = full(self.settle, xcodes[0], dtype=int16)
+        flyback = rint(interp(arange(self.flyback), [0, max(self.flyback - 1, 1)],
+                              [xcodes[-1], self.x_codes[self.columns[(k + 1) % self.height, 0]]])).astype(int16)
+        return concatenate([settle, repeat(xcodes, self.dwell), flyback]).astype(int16)
+
+    def sample_variance(self, readings, k0, k1):
+        """Mean variance of the dwell samples within a pixel, as ScanProgram.sample_variance."""
+        n = k1 - k0
+        return readings[:n, self.valid].reshape(n, -1, self.dwell).var(axis=2).mean()
+
+    def fill_wave(self, k0, k1, wave):
+        """Write the interleaved X/Y codes of scan lines k0..k1-1 into
+        wave[:k1-k0], a (lines, line_length, 2) int16 buffer."""
+        n = k1 - k0
+        for m in range(n):
+            wave[m, :, 0] = self.x_line(k0 + m)
+        wave[:n, :, 1] = self.y_codes[self.order[k0:k1], None]
+        return wave[:n]
+
+    def pixels(self, readings, k0, k1, out, reduce='mean'):
+        """Reduce the samples read for scan lines k0..k1-1 to the sampled
+        pixel values in out[:k1-k0, :samples], in column order."""
+        n = k1 - k0
+        samples = readings[:n, self.valid]
+        if self.dwell > 1:
+            out[:n, :self.samples] = reduce_dwell(samples.reshape(n, self.samples, self.dwell), reduce)
+        else:
+            out[:n, :self.samples] = samples
+        return out[:n, :self.samples]
+
+    def stream(self):
+        """The whole frame's (samples, 2) X/Y code stream, as ScanProgram.stream."""
+        wave = zeros((len(self), self.line_length, 2), dtype=int16)
+        return self.fill_wave(0, len(self), wave).reshape(-1, 2)
+
+    def index_map(self):
+        """Flat frame index (row*xres + column) of every sample of stream(),
+        -1 for pad samples, as ScanProgram.index_map."""
+        index = full((len(self), self.line_length), -1, dtype=int64)
+        index[:, self.valid] = repeat(self.order[:, None]*self.xres + self.xlow + self.columns, self.dwell, axis=1)
+        return index.reshape(-1)
+
+
+@lru_cache(maxsize=16)
+def compile_sparse(xres, yres, roi=None, fraction=0.25, mask='lattice', dwell=1, flyback=0, settle=0):
+    """Compiled SparseProgram sampling fraction of every line, shared through
+    an LRU cache like compile_scan."""
+    return SparseProgram(xres, yres, roi, fraction, mask, dwell, flyback, settle)
+
+
+def _interp_table(line, pos, sample, nlines, length):
+    """Table for interpolating samples known at (line, pos), sorted by line
+    and then pos, linearly along every line of an (nlines, length) grid,
+    holding the end values out to the edges. Returns (src, lo, weight): the
+    knots are samples[src], and grid point g lies between knots lo[g] and
+    lo[g]+1 with weight[g] on the second. Also returns a mask of the lines
+    that had any sample."""
+    first = concatenate([[True], line[1:] != line[:-1]])
+    last = concatenate([line[1:] != line[:-1], [True]])
+    # pad every line with its end values so no line borrows from its neighbours
+    xp = concatenate([line[first]*length, line*length + pos, line[last]*length + length - 1])
+    src = concatenate([sample[first], sample, sample[last]])
+    order = xp.argsort(kind='stable')
+    xp, src = xp[order], src[order]
+    # one more knot past the end, so lo+1 is always a knot
+    xp = concatenate([xp, xp[-1:] + 1])
+    src = concatenate([src, src[-1:]])
+    grid = arange(nlines*length)
+    lo = clip(searchsorted(xp, grid, side='right') - 1, 0, len(xp) - 2)
+    weight = clip((grid - xp[lo])/maximum(xp[lo + 1] - xp[lo], 1), 0, 1).astype(float32)
+    have = zeros(nlines, dtype=bool)
+    have[line] = True
+    return (src, lo.reshape(nlines, length), weight.reshape(nlines, length)), have
+
+
+class InpaintPlan:
+    """Interpolation tables of one sample mask: samples[r, i] taken at column
+    columns[r, i] of row r of an (rows, width) frame."""
+
+    def __init__(self, columns, width):
+        rows, count = columns.shape
+        self.shape = (rows, width)
+        r = repeat(arange(rows), count)
+        c = columns.reshape(-1)
+        sample = arange(rows*count)
+        self.across, _ = _interp_table(r, c, sample, rows, width)
+        order = lexsort((r, c))
+        (src, lo, weight), have = _interp_table(c[order], r[order], sample[order], width, rows)
+        self.down = (src, lo.T.copy(), weight.T.copy())
+        # weight of the column-wise interpolation, none in columns with no samples
+        self.mix = where(have, 0.5, 0.0).astype(float32)
+
+    @staticmethod
+    def _interpolate(samples, table, grid, step):
+        src, lo, weight = table
+        knots = samples[src].astype(float32)
+        take(knots, lo, out=grid, mode='clip')
+        take(knots[1:], lo, out=step, mode='clip')
+        step -= grid
+        step *= weight
+        grid += step
+
+    def inpaint(self, samples, out=None, pool=POOL):
+        """Reconstruct the frame from the (rows, count) samples into out: the
+        average of the row-wise and column-wise linear interpolations, or just
+        the row-wise one in columns with no samples."""
+        if out is None:
+            out = zeros(self.shape, dtype=int16)
+        samples = samples.reshape(-1)
+        with pool.acquire(self.shape, float32) as across, pool.acquire(self.shape, float32) as down, \
+             pool.acquire(self.shape, float32) as step:
+            self._interpolate(samples, self.across, across, step)
+            self._interpolate(samples, self.down, down, step)
+            down -= across
+            down *= self.mix
+            across += down
+            rint(across, out=out, casting='unsafe')
+        return out
+
+
+@lru_cache(maxsize=4)
+def inpaint_plan(program):
+    """InpaintPlan of a SparseProgram's sample mask, shared like the programs."""
+    return InpaintPlan(program.columns, program.width)
+
+
+def inpaint(samples, columns, width, out=None):
+    """Reconstruct an (rows, width) frame from samples[r, i] taken at column
+    columns[r, i] of row r, see InpaintPlan.inpaint."""
+    return InpaintPlan(columns, width).inpaint(samples, out)
+
+
+class Reconstructor(threading.Thread):
+    """Background thread that inpaints sparse frames, publishes them to
+    their FrameStore and hands the first channel's to the recorder, if
+    there is one. Frames arriving while one is still being reconstructed
+    are dropped, the preview only ever wants the newest."""
+
+    def __init__(self, pool=POOL, verbose=True):
+        threading.Thread.__init__(self, name='Reconstructor')
+        self.daemon = True
+        self.pool = pool
+        self.verbose = verbose    # print the time every frame took
+        self.jobs = queue.Queue(maxsize=1)
+        self.recon_time = 0.0   # seconds spent on the last frame
+        self.frames = 0
+        self.dropped = 0
+        self.start()
+
+    def submit(self, stores, program, samples, recorder=None):
+        """Queue the (channels, height, samples) values of a completed sparse
+        frame, one channel per store. Returns False if the frame was dropped."""
+        if self.jobs.full():
+            self.dropped += 1
+            return False
+        buffer = self.pool.acquire(samples.shape, samples.dtype)
+        buffer.array[...] = samples
+        self.jobs.put((stores, program, buffer, recorder))
+        return True
+
+    def drain(self):
+        """Wait until every queued frame has been published."""
+        self.jobs.join()
+
+    def run(self):
+        while True:
+            stores, program, buffer, recorder = self.jobs.get()
+            starttime = time.time()
+            with buffer as samples, self.pool.acquire((program.height, program.width), int16) as frame:
+                for store, channel in zip(stores, samples):
+                    inpaint_plan(program).inpaint(channel, frame, self.pool)
+                    store.publish_lines(program.ylow, frame, program.xlow)
+            self.recon_time = time.time() - starttime
+            self.frames += 1
+            if self.verbose:
+                print("reconstruction time: %.1f ms" % (1000*self.recon_time))
+            if recorder is not None:
+                recorder.submit_frame(stores[0].frame, stores[0].frames)
+            for store in stores:
+                store.end_frame()
+            self.jobs.task_done()
@@ -0,0 +1,5 @@
+# The modules under test sit in the repository root, next to sem_v1.py
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,55 @@
+# Tests for the shared buffer pool
+# Written for the Amray SEM control program
+
+import pytest
+from numpy import int16, float32
+
+from bufferpool import BufferPool
+
+
+def test_released_buffers_are_reused():
+    pool = BufferPool()
+    buffer = pool.acquire((8, 16), int16)
+    array = buffer.array
+    buffer.release()
+    again = pool.acquire((8, 16), int16)
+    assert again.array is array
+    assert pool.allocations == 1 and pool.reuses == 1
+    # another shape or dtype is a buffer of its own
+    other = pool.acquire((8, 16), float32)
+    assert other.array is not array
+    assert pool.allocations == 2
+    assert pool.stats()['in_use_MB'] == (8*16*2 + 8*16*4)/1e6
+
+
+def test_last_release_returns_the_buffer():
+    pool = BufferPool()
+    buffer = pool.acquire((4, 4), int16)
+    assert buffer.retain() is buffer
+    buffer.release()
+    assert pool.idle == 0 and buffer.array is not None
+    buffer.release()
+    assert pool.idle == 4*4*2 and buffer.array is None
+    with pytest.raises(RuntimeError):
+        buffer.release()
+
+
+def test_context_manager_zero_and_alignment():
+    pool = BufferPool()
+    with pool.acquire((3, 5), int16) as array:
+        array[...] = 7
+        assert array.ctypes.data % pool.ALIGN == 0
+    with pool.acquire((3, 5), int16, zero=True) as array:
+        assert (array == 0).all()
+    assert pool.in_use == 0
+
+
+def test_idle_memory_is_bounded():
+    pool = BufferPool()
+    pool.MAX_IDLE = 100
+    pool.acquire((64,), int16).release()
+    assert pool.idle == 0
+    pool.acquire((40,), int16).release()
+    assert pool.idle == 80
+    pool.trim()
+    assert pool.idle == 0
@@ -0,0 +1,55 @@
+# Tests for the FrameStore line handoff
+# Written for the Amray SEM control program
+
+import threading
+
+from numpy import int16, full
+
+from framestore import FrameStore
+
+
+def test_snapshot_copies_published_lines():
+    store = FrameStore(4, 3)
+    store.publish_line(1, [1, 2, 3])
+    store.publish_lines(2, full((2, 2), 7, dtype=int16), x0=1)
+    out, seq = store.snapshot()
+    assert seq == store.seq
+    assert out.tolist() == [[0, 0, 0], [1, 2, 3], [0, 7, 7], [0, 7, 7]]
+    assert list(store.changed_rows(2)) == [2, 3]
+
+
+def test_snapshot_is_consistent_under_a_concurrent_writer():
+    # The writer sweeps the frame top to bottom, filling every row of sweep
+    # k with k. A consistent copy is some prefix of rows at k and the rest
+    # at k-1, with no row half written.
+    rows, cols = 32, 8192
+    store = FrameStore(rows, cols)
+    stop = threading.Event()
+
+    def writer():
+        k = 0
+        line = full(cols, 0, dtype=int16)
+        while not stop.is_set():
+            k = k % 30000 + 1
+            line[:] = k
+            for j in range(rows):
+                store.publish_line(j, line)
+            store.end_frame()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        snapshots = 0
+        while snapshots < 200:
+            out, seq = store.snapshot()
+            snapshots += 1
+            assert not seq & 1
+            assert (out == out[:, :1]).all(), "torn row"
+            values = out[:, 0].astype(int)
+            steps = values[:-1] - values[1:]
+            # one sweep boundary at most, and only down by one (or the wrap)
+            assert ((steps == 0) | (steps == 1) | (values[1:] == 30000)).all()
+            assert (steps != 0).sum() <= 1
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,63 @@
+# Tests for frame and line integration
+# Written for the Amray SEM control program
+
+import pytest
+from numpy import arange, full, int16
+
+from bufferpool import BufferPool
+from integrate import Integrator
+
+
+def scans(values, rows=4, cols=5):
+    return [full((rows, cols), v, dtype=int16) for v in values]
+
+
+def integrate_frames(integrator, frames):
+    rows = arange(integrator.rows)
+    return [integrator.integrate(rows, frame).copy() for frame in frames]
+
+
+def test_none_passes_scans_through():
+    out = integrate_frames(Integrator(4, 5, 'none'), scans([10, 30]))
+    assert (out[-1] == 30).all()
+
+
+def test_frames_averages_n_then_starts_over():
+    out = integrate_frames(Integrator(4, 5, 'frames', 4), scans([10, 20, 30, 40, 100]))
+    assert [int(o[0, 0]) for o in out] == [10, 15, 20, 25, 100]
+
+
+def test_running_weights_every_scan_1_over_n():
+    out = integrate_frames(Integrator(4, 5, 'running', 4), scans([100, 200, 200]))
+    # the first scan starts the average, then every scan is weighted 1/4
+    assert [int(o[0, 0]) for o in out] == [100, 125, 144]
+
+
+def test_recursive_gives_the_exact_mean_of_the_first_n():
+    out = integrate_frames(Integrator(4, 5, 'recursive', 3), scans([30, 60, 90, 190]))
+    assert [int(o[0, 0]) for o in out] == [30, 45, 60, 103]
+
+
+def test_lines_averages_repeated_scans_of_a_line():
+    integrator = Integrator(4, 5, 'lines', 3, pool=BufferPool())
+    for v in (3, 6, 9):
+        out = integrator.integrate([2], full((1, 5), v, dtype=int16))
+    assert (out == 6).all()
+    # the next line starts its own count
+    out = integrator.integrate([3], full((1, 5), 50, dtype=int16))
+    assert (out == 50).all()
+    integrator.release()
+
+
+def test_scattered_rows_and_partial_width():
+    integrator = Integrator(8, 6, 'frames', 2)
+    rows = [6, 2, 4]
+    integrator.integrate(rows, full((3, 2), 10, dtype=int16), x0=3)
+    out = integrator.integrate(rows, full((3, 2), 20, dtype=int16), x0=3)
+    assert (out == 15).all()
+    assert integrator.count.tolist() == [0, 0, 2, 0, 2, 0, 2, 0]
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        Integrator(4, 5, 'median')
@@ -0,0 +1,44 @@
+# Tests for the serpentine line phase correction
+# Written for the Amray SEM control program
+
+from numpy import convolve, ones, repeat, zeros
+from numpy.random import default_rng
+
+from phase import estimate_shift, shift_lines, LinePhase
+from scanpattern import compile_scan
+
+
+def smooth_lines(n, width, seed=0):
+    """n random lines, smoothed so that linear interpolation is accurate."""
+    noise = default_rng(seed).normal(0, 100, (n, width + 16))
+    kernel = ones(9)/9
+    return [convolve(convolve(line, kernel, 'same'), kernel, 'same')[8:-8] for line in noise]
+
+
+def test_estimate_shift_sign_and_sub_pixel_error():
+    forward = zeros((16, 256))
+    forward[:] = smooth_lines(16, 256)
+    for true in (-3.3, -0.6, 0.0, 1.25, 4.5):
+        # reverse lines come out true pixels to the left of the forward lines
+        reverse = shift_lines(forward, -true)
+        s = estimate_shift(forward, reverse)
+        assert abs(s - true) < 0.15, (s, true)
+
+
+def test_estimate_shift_rejects_noise():
+    rng = default_rng(1)
+    assert estimate_shift(rng.normal(size=(16, 256)), rng.normal(size=(16, 256)), min_correlation=0.5) is None
+
+
+def test_line_phase_converges_on_serpentine_frames():
+    true = 2.4
+    program = compile_scan(256, 64, None, 'serpentine')
+    base = repeat(smooth_lines(32, 256, seed=2), 2, axis=0)    # line pairs see the same profile
+    phase = LinePhase()
+    for frame_no in range(12):
+        frame = base.copy()
+        # the reverse lines lag by true pixels and are corrected with the current estimate
+        frame[program.reversed] = shift_lines(shift_lines(base[program.reversed], -true), phase.shift)
+        phase.update(frame, program)
+    assert phase.shift > 0
+    assert abs(phase.shift - true) < 0.2
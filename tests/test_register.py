@@ -0,0 +1,43 @@
+# Tests for drift registration
+# Written for the Amray SEM control program
+
+from numpy import convolve, ones, apply_along_axis, float32
+from numpy.random import default_rng
+
+from bufferpool import BufferPool
+from register import phase_correlate, shift_frame, reduce_frame
+
+
+def specimen(size=128, seed=0):
+    """A smooth random image, like a defocused SEM field."""
+    image = default_rng(seed).normal(0, 100, (size, size))
+    kernel = ones(5)/5
+    for axis in (0, 1):
+        image = apply_along_axis(convolve, axis, image, kernel, 'same')
+    return image.astype(float32)
+
+
+def test_phase_correlate_recovers_a_known_shift():
+    pool = BufferPool()
+    reference = specimen()
+    for dy, dx in ((3.4, -2.6), (-5.0, 7.0), (0.0, 0.5)):
+        frame = shift_frame(reference, dy, dx, pool=pool)
+        # the shift that brings the frame back onto the reference
+        ey, ex, peak = phase_correlate(reference, frame, pool=pool)
+        assert abs(ey + dy) < 0.3 and abs(ex + dx) < 0.3, (ey, ex, dy, dx)
+        assert peak > 10
+
+
+def test_shift_frame_moves_integer_shifts_exactly():
+    frame = specimen(64)
+    moved = shift_frame(frame, 3, -2)
+    assert (moved[3:, :-2] == frame[:-3, 2:]).all()
+    back = shift_frame(moved, -3, 2)
+    assert (back[3:-3, 2:-2] == frame[3:-3, 2:-2]).all()
+
+
+def test_reduce_frame_averages_blocks():
+    frame = specimen(64)
+    reduced = reduce_frame(frame, 2)
+    assert reduced.shape == (16, 16)
+    assert abs(reduced[1, 2] - frame[4:8, 8:12].mean()) < 1e-3
@@ -0,0 +1,51 @@
+# Tests for the interleaved ROI scheduler
+# Written for the Amray SEM control program
+
+from roischedule import RoiScheduler
+
+
+class Program:
+    """Stand-in for a ScanProgram: lines of line_length samples."""
+
+    def __init__(self, lines, line_length):
+        self.lines = lines
+        self.line_length = line_length
+
+    def __len__(self):
+        return self.lines
+
+
+def run(scheduler, steps, block=1):
+    samples = [0]*len(scheduler.programs)
+    for _ in range(steps):
+        i, k = scheduler.next()
+        kend = min(k + block, len(scheduler.programs[i]))
+        samples[i] += (kend - k)*scheduler.programs[i].line_length
+        scheduler.advance(i, kend)
+    return samples
+
+
+def test_beam_time_follows_the_weights():
+    programs = [Program(64, 100), Program(16, 400), Program(256, 50)]
+    scheduler = RoiScheduler(programs, [1, 2, 0.5])
+    samples = run(scheduler, 5000, block=4)
+    total = sum(samples)
+    for share, weight in zip(samples, [1, 2, 0.5]):
+        assert abs(share/total - weight/3.5) < 0.01
+
+
+def test_lines_interleave_finely():
+    scheduler = RoiScheduler([Program(32, 10), Program(32, 10)], [1, 1])
+    order = []
+    for _ in range(8):
+        i, k = scheduler.next()
+        order.append(i)
+        scheduler.advance(i, k + 1)
+    assert order == [0, 1]*4
+
+
+def test_smaller_roi_refreshes_more_often():
+    scheduler = RoiScheduler([Program(16, 100), Program(64, 100)], [1, 1])
+    run(scheduler, 2*16*64)
+    assert scheduler.refreshes[0] == 4*scheduler.refreshes[1]
+    assert scheduler.lines == [0, 0]
@@ -0,0 +1,45 @@
+# Tests for the scan-pattern compiler
+# Written for the Amray SEM control program
+
+from numpy import zeros, int16, int64, bincount
+
+from scanpattern import bit_reversed_order, compile_scan, dac_codes
+
+
+def test_bit_reversed_order():
+    assert bit_reversed_order(8).tolist() == [0, 4, 2, 6, 1, 5, 3, 7]
+    assert bit_reversed_order(1).tolist() == [0]
+    for n in (2, 5, 12, 100):
+        assert sorted(bit_reversed_order(n).tolist()) == list(range(n))
+    assert bit_reversed_order(5)[:2].tolist() == [0, 4]
+
+
+def test_serpentine_wave_and_pixels_round_trip():
+    xres, yres, dwell = 16, 12, 3
+    program = compile_scan(xres, yres, (2, 1, 8), 'serpentine', dwell, flyback=4, settle=2)
+    assert program.reversed.tolist() == [False, True]*4
+    wave = zeros((len(program), program.line_length, 2), dtype=int16)
+    program.fill_wave(0, len(program), wave)
+
+    # a detector that reads the beam position back gives every pixel its own
+    # X code in frame column order, and its row's Y code
+    xcodes = dac_codes(xres)[2:10]
+    out = zeros((len(program), program.width), dtype=int64)
+    program.pixels(wave[..., 0].astype(int64), 0, len(program), out)
+    assert (out == xcodes).all()
+    program.pixels(wave[..., 1].astype(int64), 0, len(program), out)
+    assert (out == dac_codes(yres)[program.order][:, None]).all()
+
+
+def test_index_map_follows_stream():
+    for pattern in ('raster', 'serpentine', 'interlaced', 'progressive'):
+        program = compile_scan(12, 8, None, pattern, dwell=2, flyback=3, settle=1)
+        stream = program.stream()
+        index = program.index_map()
+        assert len(index) == len(stream)
+        valid = index >= 0
+        assert valid.sum() == 12*8*2
+        assert (stream[valid, 0] == dac_codes(12)[index[valid] % 12]).all()
+        assert (stream[valid, 1] == dac_codes(8)[index[valid] // 12]).all()
+        # every pixel gets its dwell samples
+        assert (bincount(index[valid], minlength=12*8) == 2).all()
@@ -0,0 +1,33 @@
+# Tests for the sparse preview reconstruction
+# Written for the Amray SEM control program
+
+from numpy import arange, full, int16, take_along_axis
+from numpy.random import default_rng
+
+from bufferpool import BufferPool
+from sparse import compile_sparse, inpaint, inpaint_plan, sample_columns
+
+
+def test_inpaint_keeps_the_sampled_pixels():
+    for mask in ('lattice', 'random'):
+        program = compile_sparse(96, 64, (8, 4, 48), 0.2, mask)
+        samples = default_rng(0).integers(-2048, 2048, (program.height, program.samples)).astype(int16)
+        frame = inpaint_plan(program).inpaint(samples, pool=BufferPool())
+        assert frame.shape == (48, 48)
+        assert (take_along_axis(frame, program.columns, axis=1) == samples).all()
+
+
+def test_inpaint_is_exact_on_linear_ramps():
+    columns = sample_columns(32, 40, 8)
+    ramp = arange(40)*10
+    samples = take_along_axis(full((32, 40), 1)*ramp, columns, axis=1)
+    frame = inpaint(samples, columns, 40)
+    # between the first and last sample of every row
+    for r in range(32):
+        lo, hi = columns[r, 0], columns[r, -1]
+        assert (frame[r, lo:hi + 1] == ramp[lo:hi + 1]).all()
+
+
+def test_inpaint_plan_is_shared_per_program():
+    program = compile_sparse(64, 64, None, 0.25)
+    assert inpaint_plan(program) is inpaint_plan(compile_sparse(64, 64, None, 0.25))